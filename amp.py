@@ -0,0 +1,44 @@
+import torch
+
+
+class MixedPrecision(object):
+    """Opt-in autocast for the training forward passes
+
+    CPU runs in bfloat16, CUDA in float16 with dynamic loss scaling. The
+    parameters (and so the optimizer) stay in float32; callers cast the
+    network outputs back with `.float()` before softmax / log-prob / entropy.
+    """
+
+    def __init__(self, device, enabled=False):
+        self.device = torch.device(device)
+        self.enabled = enabled
+        if self.device.type == 'cuda':
+            self.dtype = torch.float16
+            self.scaler = torch.cuda.amp.GradScaler(enabled=enabled)
+        else:
+            self.dtype = torch.bfloat16
+            self.scaler = None
+
+    def autocast(self):
+        return torch.autocast(
+            device_type=self.device.type,
+            dtype=self.dtype,
+            enabled=self.enabled)
+
+    def backward(self, loss):
+        if self.scaler is not None:
+            loss = self.scaler.scale(loss)
+        loss.backward()
+
+    def step(self, optimizer, parameters, clip_grad_norm=None):
+        parameters = list(parameters)
+        if self.scaler is not None:
+            # clip the real, unscaled gradients
+            self.scaler.unscale_(optimizer)
+        if clip_grad_norm is not None:
+            torch.nn.utils.clip_grad_norm_(parameters, clip_grad_norm)
+        if self.scaler is not None:
+            self.scaler.step(optimizer)
+            self.scaler.update()
+        else:
+            optimizer.step()
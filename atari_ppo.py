@@ -11,6 +11,8 @@ import torch
 import cv2
 
 from model import *
+from resources import ResourceManager, pin_process
+from sampler import ActionSampler
 
 import torch.optim as optim
 from torch.multiprocessing import Pipe, Process
@@ -30,7 +32,8 @@ class AtariEnvironment(Process):
             child_conn,
             history_size=4,
             h=84,
-            w=84):
+            w=84,
+            cpu_set=None):
         super(AtariEnvironment, self).__init__()
         self.daemon = True
         self.env = gym.make(env_id)
@@ -47,12 +50,15 @@ class AtariEnvironment(Process):
         self.history = np.zeros([history_size, h, w])
         self.h = h
         self.w = w
+        self.cpu_set = cpu_set
 
         self.reset()
         self.lives = self.env.env.ale.lives()
 
     def run(self):
         super(AtariEnvironment, self).run()
+        if self.cpu_set is not None:
+            pin_process(self.cpu_set, 'worker {}'.format(self.env_idx))
         while True:
             action = self.child_conn.recv()
             if self.is_render:
@@ -121,9 +127,11 @@ class ActorAgent(object):
             lam=0.95,
             use_gae=True,
             use_cuda=False,
-            use_noisy_net=False):
-        self.model = CnnActorCriticNetwork(
-            input_size, output_size, use_noisy_net)
+            use_noisy_net=False,
+            model_name='cnn',
+            seed=0):
+        self.model = make_model(
+            model_name, input_size, output_size, use_noisy_net)
         self.num_env = num_env
         self.output_size = output_size
         self.input_size = input_size
@@ -137,21 +145,21 @@ class ActorAgent(object):
         self.device = torch.device('cuda' if use_cuda else 'cpu')
 
         self.model = self.model.to(self.device)
+        self.sampler = ActionSampler(
+            num_env, output_size, self.device, seed)
 
-    def get_action(self, state):
+    def get_action(self, state, with_value=False):
         state = torch.Tensor(state).to(self.device)
         state = state.float()
-        policy, value = self.model(state)
-        policy = F.softmax(policy, dim=-1).data.cpu().numpy()
-
-        action = self.random_choice_prob_index(policy)
-
-        return action
+        with torch.no_grad():
+            policy, value = self.model(state)
+        action = self.sampler.sample(policy)
 
-    @staticmethod
-    def random_choice_prob_index(p, axis=1):
-        r = np.expand_dims(np.random.rand(p.shape[1 - axis]), axis=axis)
-        return (p.cumsum(axis=axis) > r).argmax(axis=axis)
+        if with_value:
+            log_prob = self.sampler.log_prob(policy, action)
+            return action.cpu().numpy(), log_prob.cpu().numpy(), \
+                value.squeeze(1).cpu().numpy()
+        return action.cpu().numpy()
 
     def forward_transition(self, state, next_state):
         state = torch.from_numpy(state).to(self.device)
@@ -174,6 +182,7 @@ class ActorAgent(object):
         adv_batch = torch.FloatTensor(adv_batch).to(self.device)
 
         sample_range = np.arange(len(s_batch))
+        resample_noise(self.model, 'update')
 
         with torch.no_grad():
             # for multiply advantage
@@ -256,10 +265,14 @@ if __name__ == '__main__':
     use_gae = True
     is_load_model = False
     is_render = False
+    use_cpu_affinity = False
     use_standardization = True
     lr_schedule = False
     life_done = True
     use_noisy_net = True
+    model_name = 'cnn'
+    # 'call', 'update' or 'rollout'
+    noise_resample = 'call'
 
     model_path = 'models/{}.model'.format(env_id)
 
@@ -289,17 +302,24 @@ if __name__ == '__main__':
         gamma,
         use_cuda=use_cuda,
         use_gae=use_gae,
-        use_noisy_net=use_noisy_net)
+        use_noisy_net=use_noisy_net,
+        model_name=model_name)
+    set_noise_resample(agent.model, noise_resample)
 
     if is_load_model:
         agent.model.load_state_dict(torch.load(model_path))
 
+    resources = ResourceManager(num_worker, enabled=use_cpu_affinity)
+    resources.apply_learner()
+
     works = []
     parent_conns = []
     child_conns = []
     for idx in range(num_worker):
         parent_conn, child_conn = Pipe()
-        work = AtariEnvironment(env_id, is_render, idx, child_conn)
+        work = AtariEnvironment(
+            env_id, is_render, idx, child_conn,
+            cpu_set=resources.worker_cores(idx))
         work.start()
         works.append(work)
         parent_conns.append(parent_conn)
@@ -317,6 +337,7 @@ if __name__ == '__main__':
     while True:
         total_state, total_reward, total_done, total_next_state, total_action = [], [], [], [], []
         global_step += (num_worker * num_step)
+        resample_noise(agent.model, 'rollout')
 
         for _ in range(num_step):
             actions = agent.get_action(states)
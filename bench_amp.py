@@ -0,0 +1,66 @@
+import argparse
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torch.optim as optim
+from torch.distributions.categorical import Categorical
+
+from amp import MixedPrecision
+from model import MODELS, make_model
+from profile_models import input_size, make_input
+
+
+def bench(name, batch, use_amp, device, n_iter, output_size=12):
+    model = make_model(name, input_size(name), output_size).to(device)
+    optimizer = optim.Adam(model.parameters(), lr=1e-4)
+    amp = MixedPrecision(device, use_amp)
+    x = make_input(name, batch, device)
+    y = torch.randint(output_size, (batch,), device=device)
+    adv = torch.randn(batch, device=device)
+    target = torch.randn(batch, device=device)
+
+    def step():
+        with amp.autocast():
+            policy, value = model(x)
+        policy, value = policy.float(), value.float()
+        m = Categorical(F.softmax(policy, dim=-1))
+        loss = -(m.log_prob(y) * adv).mean() + \
+            0.5 * F.mse_loss(value.sum(1), target) - 0.02 * m.entropy().mean()
+        optimizer.zero_grad()
+        amp.backward(loss)
+        amp.step(optimizer, model.parameters(), 0.5)
+
+    for _ in range(3):
+        step()
+    times = []
+    for _ in range(n_iter):
+        start = time.perf_counter()
+        step()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='fp32 vs mixed precision actor-critic training step')
+    parser.add_argument('--models', nargs='+', default=['cnn', 'deep_cnn'],
+                        choices=sorted(MODELS))
+    parser.add_argument('--batch-sizes', type=int, nargs='+',
+                        default=[256])
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--iter', type=int, default=20)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    dtype = MixedPrecision(device, True).dtype
+    for name in args.models:
+        for batch in args.batch_sizes:
+            fp32 = bench(name, batch, False, device, args.iter)
+            mixed = bench(name, batch, True, device, args.iter)
+            print('{:10s} batch {:4d}: fp32 {:8.2f} ms   {} {:8.2f} ms   '
+                  'x{:.2f}'.format(name, batch, fp32 * 1e3, dtype,
+                                   mixed * 1e3, fp32 / mixed))
@@ -0,0 +1,197 @@
+"""Forward / backward / optimizer-step time and peak memory of model.py
+
+    python bench_model.py --out bench_model.json
+
+Every architecture (and the ICM of mario_curio) is measured with and
+without NoisyLinear heads at the rollout batch (num_worker) and the PPO
+minibatch (batch_size). Times are medians over --iter steps. Peak memory
+is torch.cuda.max_memory_allocated on CUDA; on the CPU it is the sum of
+parameters, gradients, Adam state, inputs and the tensors autograd saves
+for backward, which is what a training step keeps alive at its peak.
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torch.optim as optim
+
+from model import MODELS, CuriosityModel, make_model
+from profile_models import _sync, count_parameters, input_size, make_input
+
+MODEL_NAMES = sorted(MODELS) + ['icm']
+
+
+def make_case(name, use_noisy_net, output_size, device):
+    """(model, inputs for a batch, loss of the model output)"""
+    if name == 'icm':
+        model = CuriosityModel(input_size('cnn'), output_size)
+
+        def make_batch(batch):
+            action = torch.randint(output_size, (batch,), device=device)
+            action_onehot = F.one_hot(action, output_size).float()
+            return [make_input('cnn', batch, device),
+                    make_input('cnn', batch, device), action_onehot], action
+
+        def loss_fn(output, target):
+            real_next_state_feature, pred_next_state_feature, pred_action = output
+            # mario_curio's inverse + forward loss
+            return F.cross_entropy(pred_action, target) + F.mse_loss(
+                pred_next_state_feature, real_next_state_feature.detach())
+    else:
+        model = make_model(name, input_size(name), output_size, use_noisy_net)
+
+        def make_batch(batch):
+            return make_input(name, batch, device), torch.randint(
+                output_size, (batch,), device=device)
+
+        def loss_fn(output, target):
+            policy, value = output
+            return F.cross_entropy(policy, target) + value.pow(2).mean()
+
+    return model.to(device), make_batch, loss_fn
+
+
+def _tensor_bytes(tensors):
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+def time_inference(model, inputs, device, n_iter, warmup=3):
+    model.eval()
+    times = []
+    with torch.no_grad():
+        for i in range(warmup + n_iter):
+            start = time.perf_counter()
+            model(inputs)
+            _sync(device)
+            if i >= warmup:
+                times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def time_train_step(model, inputs, target, loss_fn, optimizer, device,
+                    n_iter, warmup=3):
+    model.train()
+    times = {'forward': [], 'backward': [], 'optimizer': []}
+    for i in range(warmup + n_iter):
+        start = time.perf_counter()
+        loss = loss_fn(model(inputs), target)
+        _sync(device)
+        forward = time.perf_counter()
+        loss.backward()
+        _sync(device)
+        backward = time.perf_counter()
+        optimizer.step()
+        optimizer.zero_grad()
+        _sync(device)
+        end = time.perf_counter()
+        if i >= warmup:
+            times['forward'].append(forward - start)
+            times['backward'].append(backward - forward)
+            times['optimizer'].append(end - backward)
+    return {k: float(np.median(v)) for k, v in times.items()}
+
+
+def peak_memory(model, inputs, target, loss_fn, optimizer, device):
+    """Peak bytes of one training step, see the module docstring"""
+    model.train()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        loss = loss_fn(model(inputs), target)
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device), 'cuda_allocator'
+
+    params = list(model.parameters())
+    param_ptrs = set(p.data_ptr() for p in params)
+    saved = {}
+
+    def pack(t):
+        if t.data_ptr() not in param_ptrs:
+            saved[t.data_ptr()] = t.numel() * t.element_size()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        loss = loss_fn(model(inputs), target)
+    loss.backward()
+    optimizer.step()
+    optimizer.zero_grad()
+
+    inputs = inputs if isinstance(inputs, list) else [inputs]
+    optimizer_state = [v for state in optimizer.state.values()
+                       for v in state.values() if torch.is_tensor(v)]
+    total = (2 * _tensor_bytes(params) + _tensor_bytes(optimizer_state) +
+             _tensor_bytes(inputs) + sum(saved.values()))
+    return total, 'estimate'
+
+
+def bench(name, use_noisy_net, batch, output_size=12, device='cpu',
+          n_iter=20, learning_rate=0.0001):
+    device = torch.device(device)
+    torch.manual_seed(0)
+    model, make_batch, loss_fn = make_case(
+        name, use_noisy_net, output_size, device)
+    optimizer = optim.Adam(model.parameters(), lr=learning_rate)
+    inputs, target = make_batch(batch)
+
+    step = time_train_step(
+        model, inputs, target, loss_fn, optimizer, device, n_iter)
+    peak, peak_source = peak_memory(
+        model, inputs, target, loss_fn, optimizer, device)
+    return {
+        'model': name,
+        'noisy': use_noisy_net,
+        'batch': batch,
+        'device': device.type,
+        'params': count_parameters(model),
+        'inference_ms': time_inference(model, inputs, device, n_iter) * 1e3,
+        'forward_ms': step['forward'] * 1e3,
+        'backward_ms': step['backward'] * 1e3,
+        'optimizer_ms': step['optimizer'] * 1e3,
+        'step_ms': sum(step.values()) * 1e3,
+        'peak_bytes': peak,
+        'peak_source': peak_source,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--models', nargs='+', default=MODEL_NAMES,
+                        choices=MODEL_NAMES)
+    parser.add_argument('--num-worker', type=int, default=16,
+                        help='rollout batch')
+    parser.add_argument('--batch-size', type=int, default=256,
+                        help='PPO minibatch')
+    parser.add_argument('--output-size', type=int, default=12)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--iter', type=int, default=20)
+    parser.add_argument('--out', help='write the results as JSON')
+    args = parser.parse_args()
+
+    results = []
+    for name in args.models:
+        # the ICM has no noisy layers
+        for use_noisy_net in ([False] if name == 'icm' else [False, True]):
+            for batch in [args.num_worker, args.batch_size]:
+                r = bench(name, use_noisy_net, batch, args.output_size,
+                          args.device, args.iter)
+                print('{model:9s} noisy={noisy:d} batch {batch:4d}: inference '
+                      '{inference_ms:8.2f} ms  forward {forward_ms:8.2f} ms  '
+                      'backward {backward_ms:8.2f} ms  optimizer '
+                      '{optimizer_ms:7.2f} ms  peak {mb:8.1f} MB ({peak_source})'
+                      .format(mb=r['peak_bytes'] / 2 ** 20, **r))
+                results.append(r)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({
+                'torch': torch.__version__,
+                'num_threads': torch.get_num_threads(),
+                'results': results,
+            }, f, indent=2)
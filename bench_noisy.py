@@ -0,0 +1,68 @@
+import argparse
+import time
+
+import torch
+
+from model import NoisyLinear, DenseNoisyLinear
+
+
+def bench(layer, x, n_iter):
+    layer.train()
+    for _ in range(3):
+        layer(x).sum().backward()
+
+    start = time.perf_counter()
+    for _ in range(n_iter):
+        layer.zero_grad()
+        layer(x).sum().backward()
+    return (time.perf_counter() - start) / n_iter
+
+
+def check_parity(in_features, out_features, batch):
+    dense = DenseNoisyLinear(in_features, out_features)
+    factorised = NoisyLinear(in_features, out_features, resample='update')
+    factorised.load_state_dict(dense.state_dict())
+
+    dense.eval()
+    factorised.eval()
+    dense.sample_noise()
+    factorised.in_noise.copy_(dense.in_noise)
+    factorised.out_noise.copy_(dense.out_noise)
+
+    x = torch.randn(batch, in_features)
+    return (dense(x) - factorised(x)).abs().max().item()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='NoisyLinear vs DenseNoisyLinear forward + backward')
+    parser.add_argument('--in-features', type=int, default=3136)
+    parser.add_argument('--out-features', type=int, default=512)
+    parser.add_argument('--batch-sizes', type=int, nargs='+',
+                        default=[16, 256])
+    parser.add_argument('--iter', type=int, default=50)
+    parser.add_argument('--threads', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    noise_bytes = args.in_features * args.out_features * 4
+    print('layer {}x{}, dense noise temporaries per call: {:.2f} MB (x2)'.format(
+        args.in_features, args.out_features, noise_bytes / 2 ** 20))
+    print('max abs diff dense vs factorised: {:.3e}'.format(
+        check_parity(args.in_features, args.out_features, 16)))
+
+    for batch in args.batch_sizes:
+        x = torch.randn(batch, args.in_features)
+        dense = DenseNoisyLinear(args.in_features, args.out_features)
+        results = [('dense', bench(dense, x, args.iter))]
+        for resample in NoisyLinear.resample_modes:
+            layer = NoisyLinear(
+                args.in_features, args.out_features, resample=resample)
+            results.append(('factorised/' + resample, bench(layer, x, args.iter)))
+
+        base = results[0][1]
+        for name, t in results:
+            print('batch {:4d}  {:20s} {:8.3f} ms  x{:.2f}'.format(
+                batch, name, t * 1e3, base / t))
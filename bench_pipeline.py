@@ -0,0 +1,317 @@
+"""Rollout / learner throughput of mario_ppo on the synthetic env
+
+    python bench_pipeline.py --num-worker 16 --step-cost 0.0005 --out bench.json
+
+Runs mario_ppo's own ActorAgent, collect_rollout and make_train_data on a
+pool of MarioEnvironment workers built around SyntheticMarioEnv, so no ROM
+or emulator is needed. Three stages are measured separately:
+
+    ipc      workers stepped with random actions, no model
+    rollout  collect_rollout: action selection, IPC and rollout storage
+    learner  transpose, forward_transition, GAE and train_model on the
+             collected rollouts
+
+With --timer-rounds N, whole updates are also timed N times with the
+PhaseTimer off and N times on (alternating), to check that the timing
+instrumentation stays under 1% of an update. The cost of one timed phase
+is measured separately and scaled by the phases per update, which gives
+a noise-free estimate next to the measured difference.
+"""
+import argparse
+import json
+import resource
+import time
+
+import numpy as np
+
+from gym_super_mario_bros.actions import COMPLEX_MOVEMENT
+
+import mario_ppo
+from env_startup import load_env_spec, wait_ready
+from metrics import MetricsWriter
+from mario_env import MarioEnvironment, Pipe
+from mario_ppo import ActorAgent, make_train_data
+from resources import set_thread_count
+from timer import PhaseTimer
+
+# mario_ppo.py's __main__ settings read as module globals
+DEFAULTS = {
+    'num_step': 128,
+    'epoch': 3,
+    'batch_size': 256,
+    'ppo_eps': 0.1,
+    'entropy_coef': 0.02,
+    'gamma': 0.99,
+    'lam': 0.95,
+    'use_gae': True,
+    'clip_grad_norm': 0.5,
+    'reward_scale': 1,
+    'learning_rate': 0.0001,
+    'is_training': True,
+}
+
+
+def start_workers(num_worker, env_id, env_kwargs):
+    works = []
+    parent_conns = []
+    for idx in range(num_worker):
+        parent_conn, child_conn = Pipe()
+        kwargs = dict(env_kwargs, seed=idx)
+        work = MarioEnvironment(
+            env_id, False, idx, child_conn, env_kwargs=kwargs)
+        work.start()
+        works.append(work)
+        parent_conns.append(parent_conn)
+    return works, parent_conns
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def bench_ipc(parent_conns, num_step):
+    start = time.perf_counter()
+    for _ in range(num_step):
+        for parent_conn in parent_conns:
+            parent_conn.send(np.random.randint(len(COMPLEX_MOVEMENT)))
+        for parent_conn in parent_conns:
+            parent_conn.recv()
+    elapsed = time.perf_counter() - start
+    return {
+        'sec': elapsed,
+        'env_steps_per_sec': len(parent_conns) * num_step / elapsed,
+    }
+
+
+def bench_rollout(agent, num_worker, num_step, updates):
+    rollouts = []
+    start = time.perf_counter()
+    for _ in range(updates):
+        rollouts.append(mario_ppo.collect_rollout(agent.model))
+    elapsed = time.perf_counter() - start
+    record = mario_ppo.timer.report(0, num_worker * num_step * updates, 0)
+    return rollouts, {
+        'sec': elapsed,
+        'env_steps_per_sec': num_worker * num_step * updates / elapsed,
+        'phases': record['phases'],
+    }
+
+
+def train(agent, rollout, num_worker, num_step, timer):
+    total_state, total_reward, total_done, total_next_state, total_action, \
+        _, total_truncated = rollout
+    with timer.phase('transpose'):
+        total_state = np.stack(total_state).transpose(
+            [1, 0, 2, 3, 4]).reshape([-1, 4, 84, 84])
+        total_next_state = np.stack(total_next_state).transpose(
+            [1, 0, 2, 3, 4]).reshape([-1, 4, 84, 84])
+        total_reward = np.stack(total_reward).transpose().reshape([-1])
+        total_action = np.stack(total_action).transpose().reshape([-1])
+        total_done = np.stack(total_done).transpose().reshape([-1])
+        total_truncated = np.stack(total_truncated).transpose().reshape([-1])
+
+    with timer.phase('forward_transition'):
+        value, next_value, policy = agent.forward_transition(
+            total_state, total_next_state)
+
+    with timer.phase('make_train_data'):
+        total_target = []
+        total_adv = []
+        for idx in range(num_worker):
+            sl = slice(idx * num_step, (idx + 1) * num_step)
+            target, adv = make_train_data(
+                total_reward[sl], total_done[sl], value[sl], next_value[sl],
+                total_truncated[sl])
+            total_target.append(target)
+            total_adv.append(adv)
+
+    with timer.phase('train_model'):
+        agent.train_model(
+            total_state,
+            total_next_state,
+            np.hstack(total_target),
+            total_action,
+            np.hstack(total_adv))
+
+
+def bench_timer_overhead(agent, num_worker, num_step, rounds, n_iter=100000):
+    sec = {False: [], True: []}
+    counts = 0
+    for i in range(2 * rounds):
+        enabled = bool(i % 2)
+        timer = PhaseTimer(enabled)
+        mario_ppo.timer = timer
+        start = time.perf_counter()
+        rollout = mario_ppo.collect_rollout(agent.model)
+        train(agent, rollout, num_worker, num_step, timer)
+        sec[enabled].append(time.perf_counter() - start)
+        if enabled:
+            record = timer.report(0, num_worker * num_step, 0)
+            counts = sum(p['count'] for p in record['phases'].values())
+    mario_ppo.timer = PhaseTimer()
+
+    timer = PhaseTimer()
+    phase = timer.phase('overhead')
+    start = time.perf_counter()
+    for _ in range(n_iter):
+        with phase:
+            pass
+    phase_sec = (time.perf_counter() - start) / n_iter
+
+    off, on = float(np.median(sec[False])), float(np.median(sec[True]))
+    return {
+        'update_sec_off': off,
+        'update_sec_on': on,
+        'measured_overhead': on / off - 1,
+        'phases_per_update': counts,
+        'phase_usec': phase_sec * 1e6,
+        'estimated_overhead': phase_sec * counts / off,
+    }
+
+
+def bench_learner(agent, rollouts, num_worker, num_step, epoch):
+    timer = PhaseTimer()
+    start = time.perf_counter()
+    for rollout in rollouts:
+        train(agent, rollout, num_worker, num_step, timer)
+    elapsed = time.perf_counter() - start
+    samples = num_worker * num_step * epoch * len(rollouts)
+    record = timer.report(0, 0, samples, len(rollouts))
+    return {
+        'sec': elapsed,
+        'samples_per_sec': samples / elapsed,
+        'updates_per_sec': len(rollouts) / elapsed,
+        'phases': record['phases'],
+    }
+
+
+def run(args):
+    env_kwargs = {
+        'step_cost': args.step_cost,
+        'entropy': args.entropy,
+        'episode_length': args.episode_length,
+        'episode_length_dist': args.episode_length_dist,
+    }
+    config = dict(DEFAULTS, num_step=args.num_step)
+    num_worker, num_step = args.num_worker, args.num_step
+    if args.threads:
+        set_thread_count(args.threads)
+
+    input_size, output_size = load_env_spec(args.env_id, COMPLEX_MOVEMENT)
+    works, parent_conns = start_workers(num_worker, args.env_id, env_kwargs)
+    metrics = MetricsWriter()
+    try:
+        start = time.perf_counter()
+        states = wait_ready(parent_conns, works)
+        startup = time.perf_counter() - start
+
+        # ActorAgent, collect_rollout, train_model and make_train_data
+        # read these as module globals of mario_ppo
+        vars(mario_ppo).update(config)
+        agent = ActorAgent(
+            input_size,
+            output_size,
+            num_worker,
+            num_step,
+            config['gamma'],
+            use_cuda=args.use_cuda,
+            use_noisy_net=args.use_noisy_net,
+            model_name=args.model_name)
+
+        vars(mario_ppo).update({
+            'agent': agent,
+            'parent_conns': parent_conns,
+            'states': states,
+            'metrics': metrics,
+            'episode_rall': np.zeros(num_worker),
+            'episode_step': np.zeros(num_worker),
+            'scheduler': None,
+            'timer': PhaseTimer(),
+            'sample_env_idx': 0,
+            'sample_episode': 0,
+            'sample_rall': 0,
+            'sample_i_rall': 0,
+            'sample_step': 0,
+        })
+
+        results = {'startup_sec': startup}
+        results['ipc'] = bench_ipc(parent_conns, num_step)
+        # warm-up update, not measured
+        train(agent, mario_ppo.collect_rollout(agent.model),
+              num_worker, num_step, PhaseTimer(False))
+        rollouts, results['rollout'] = bench_rollout(
+            agent, num_worker, num_step, args.updates)
+        results['learner'] = bench_learner(
+            agent, rollouts, num_worker, num_step, config['epoch'])
+        if args.timer_rounds:
+            results['timer'] = bench_timer_overhead(
+                agent, num_worker, num_step, args.timer_rounds)
+        results['peak_rss_mb'] = peak_rss_mb()
+    finally:
+        metrics.close()
+        for work in works:
+            work.terminate()
+        for work in works:
+            work.join()
+
+    return {
+        'config': dict(config, env_id=args.env_id, num_worker=num_worker,
+                       model_name=args.model_name,
+                       use_noisy_net=args.use_noisy_net,
+                       use_cuda=args.use_cuda, updates=args.updates,
+                       threads=args.threads,
+                       **env_kwargs),
+        'results': results,
+    }
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--env-id', default='SyntheticMario-v0')
+    parser.add_argument('--num-worker', type=int, default=16)
+    parser.add_argument('--num-step', type=int, default=128)
+    parser.add_argument('--updates', type=int, default=3)
+    parser.add_argument('--model-name', default='cnn')
+    parser.add_argument('--use-noisy-net', action='store_true')
+    parser.add_argument('--use-cuda', action='store_true')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='learner thread pool size')
+    parser.add_argument('--step-cost', type=float, default=0.,
+                        help='CPU seconds per env step')
+    parser.add_argument('--entropy', type=float, default=0.1)
+    parser.add_argument('--episode-length', type=int, default=400)
+    parser.add_argument('--episode-length-dist', default='exponential',
+                        choices=['fixed', 'uniform', 'exponential'])
+    parser.add_argument('--timer-rounds', type=int, default=0,
+                        help='updates per side of the timer on/off check')
+    parser.add_argument('--out', default=None, help='write results as JSON')
+    return parser
+
+
+if __name__ == '__main__':
+    args = make_parser().parse_args()
+    report = run(args)
+    results = report['results']
+    print('startup  {:8.3f}s'.format(results['startup_sec']))
+    print('ipc      {:10.1f} env steps/s'.format(
+        results['ipc']['env_steps_per_sec']))
+    print('rollout  {:10.1f} env steps/s'.format(
+        results['rollout']['env_steps_per_sec']))
+    print('learner  {:10.1f} samples/s  {:.3f} updates/s'.format(
+        results['learner']['samples_per_sec'],
+        results['learner']['updates_per_sec']))
+    for stage in ['rollout', 'learner']:
+        for name, phase in sorted(results[stage]['phases'].items()):
+            print('  {:8s} {:20s} {:8.3f}s  {:5.1%}'.format(
+                stage, name, phase['sec'], phase['share']))
+    if 'timer' in results:
+        timer = results['timer']
+        print('timer    {:+7.2%} measured  {:+7.2%} estimated  ({} phases of '
+              '{:.2f} us per update, target < 1%)'.format(
+                  timer['measured_overhead'], timer['estimated_overhead'],
+                  timer['phases_per_update'], timer['phase_usec']))
+    print('peak RSS {:8.1f} MB'.format(results['peak_rss_mb']))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
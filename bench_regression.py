@@ -0,0 +1,185 @@
+"""Throughput regression check against a stored baseline
+
+    python bench_regression.py --update-baseline   # record, on a known-good tree
+    python bench_regression.py                     # compare, exit 1 on regression
+
+Runs bench_pipeline.py on a fixed synthetic, CPU-only workload --repeat
+times, each in a fresh process (peak RSS only grows within a process), and
+keeps the median of each metric:
+
+    env_steps_per_sec   end to end: rollout + learner      (higher is better)
+    gae_sec             make_train_data per update        (lower is better)
+    train_model_sec     train_model per update            (lower is better)
+    peak_rss_mb         peak RSS of the learner process   (lower is better)
+
+A metric regresses when it is worse than the baseline by more than
+--tolerance (relative). Baselines are machine specific: keep one file per
+machine under benchmarks/. A baseline recorded with a different workload
+or file version is refused (exit 2) rather than compared.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import bench_pipeline
+
+BASELINE_VERSION = 1
+
+# the fixed workload; changing it invalidates every stored baseline
+WORKLOAD = {
+    'env_id': 'SyntheticMario-v0',
+    'num_worker': 8,
+    'num_step': 128,
+    'updates': 3,
+    'model_name': 'cnn',
+    'use_noisy_net': True,
+    'step_cost': 0.0002,
+    'entropy': 0.1,
+    'episode_length': 400,
+    'episode_length_dist': 'fixed',
+    'threads': 4,
+}
+
+# metric -> True if higher is better
+METRICS = {
+    'env_steps_per_sec': True,
+    'gae_sec': False,
+    'train_model_sec': False,
+    'peak_rss_mb': False,
+}
+
+
+def measure():
+    args = bench_pipeline.make_parser().parse_args([])
+    for k, v in WORKLOAD.items():
+        setattr(args, k, v)
+    args.use_cuda = False
+
+    results = bench_pipeline.run(args)['results']
+    updates = WORKLOAD['updates']
+    env_steps = WORKLOAD['num_worker'] * WORKLOAD['num_step'] * updates
+    phases = results['learner']['phases']
+    return {
+        'env_steps_per_sec': env_steps / (
+            results['rollout']['sec'] + results['learner']['sec']),
+        'gae_sec': phases['make_train_data']['sec'] / updates,
+        'train_model_sec': phases['train_model']['sec'] / updates,
+        'peak_rss_mb': results['peak_rss_mb'],
+    }
+
+
+def measure_in_subprocess():
+    """measure() in a fresh interpreter, so peak RSS is this run's own"""
+    fd, path = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    try:
+        # the workers log episodes on stdout, so the result goes to a file
+        subprocess.check_call(
+            [sys.executable, os.path.abspath(__file__), '--measure-to', path])
+        with open(path) as f:
+            return json.load(f)
+    finally:
+        os.remove(path)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(metrics, baseline, tolerance):
+    """[(metric, value, baseline value, relative change, regressed)]"""
+    rows = []
+    for name, higher_is_better in sorted(METRICS.items()):
+        value, base = metrics[name], baseline[name]
+        change = (value - base) / base
+        worse = -change if higher_is_better else change
+        rows.append((name, value, base, change, worse > tolerance))
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--baseline', default=os.path.join(
+        'benchmarks', 'baseline_{}.json'.format(platform.node() or 'cpu')))
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='allowed relative slowdown / growth')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--out', help='also write this run as JSON')
+    parser.add_argument('--measure-to', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure_to:
+        # one repeat, run by measure_in_subprocess
+        with open(args.measure_to, 'w') as f:
+            json.dump(measure(), f)
+        sys.exit(0)
+
+    runs = []
+    for i in range(args.repeat):
+        start = time.perf_counter()
+        runs.append(measure_in_subprocess())
+        print('run {}/{}: {:.1f}s'.format(
+            i + 1, args.repeat, time.perf_counter() - start))
+    metrics = {name: float(np.median([r[name] for r in runs]))
+               for name in METRICS}
+
+    record = {
+        'version': BASELINE_VERSION,
+        'workload': WORKLOAD,
+        'commit': git_commit(),
+        'machine': {
+            'node': platform.node(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'python': platform.python_version(),
+        },
+        'metrics': metrics,
+        'runs': runs,
+    }
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(record, f, indent=2)
+
+    if args.update_baseline:
+        os.makedirs(os.path.dirname(args.baseline) or '.', exist_ok=True)
+        tmp_path = '{}.{}'.format(args.baseline, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(record, f, indent=2)
+        os.replace(tmp_path, args.baseline)
+        print('baseline written to {}'.format(args.baseline))
+        sys.exit(0)
+
+    if not os.path.exists(args.baseline):
+        print('no baseline at {}, record one with --update-baseline'.format(
+            args.baseline))
+        sys.exit(2)
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get('version') != BASELINE_VERSION or \
+            baseline.get('workload') != WORKLOAD:
+        print('baseline {} was recorded with another version or workload, '
+              're-record it with --update-baseline'.format(args.baseline))
+        sys.exit(2)
+
+    print('baseline {} (commit {})'.format(args.baseline, baseline['commit']))
+    regressed = False
+    for name, value, base, change, worse in compare(
+            metrics, baseline['metrics'], args.tolerance):
+        regressed |= worse
+        print('{:20s} {:12.4f}  baseline {:12.4f}  {:+7.1%}  {}'.format(
+            name, value, base, change, 'REGRESSION' if worse else 'ok'))
+    sys.exit(1 if regressed else 0)
@@ -0,0 +1,60 @@
+import argparse
+import time
+
+from gym_super_mario_bros.actions import COMPLEX_MOVEMENT
+
+from mario_env import MarioEnvironment, Pipe
+from env_startup import _make_mario_env, load_env_spec, wait_ready
+
+
+def time_to_first_step(env_id, num_worker):
+    """Seconds from starting `num_worker` workers to a first step of all"""
+    start = time.perf_counter()
+    works = []
+    parent_conns = []
+    for idx in range(num_worker):
+        parent_conn, child_conn = Pipe()
+        work = MarioEnvironment(env_id, False, idx, child_conn)
+        work.start()
+        works.append(work)
+        parent_conns.append(parent_conn)
+    started = time.perf_counter()
+
+    wait_ready(parent_conns, works)
+    ready = time.perf_counter()
+
+    for parent_conn in parent_conns:
+        parent_conn.send(0)
+    for parent_conn in parent_conns:
+        parent_conn.recv()
+    first_step = time.perf_counter()
+
+    for work in works:
+        work.terminate()
+    for work in works:
+        work.join()
+    return started - start, ready - start, first_step - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='time-to-first-step of the env worker pool')
+    parser.add_argument('--env-id', default='SuperMarioBros-v0')
+    parser.add_argument('--num-workers', type=int, nargs='+',
+                        default=[16, 64, 256])
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    load_env_spec(args.env_id, COMPLEX_MOVEMENT)
+    print('env spec: {:.3f}s'.format(time.perf_counter() - start))
+
+    start = time.perf_counter()
+    _make_mario_env(args.env_id, COMPLEX_MOVEMENT).close()
+    build = time.perf_counter() - start
+
+    for num_worker in args.num_workers:
+        started, ready, first_step = time_to_first_step(
+            args.env_id, num_worker)
+        print('{:4d} workers: started {:7.3f}s  ready {:7.3f}s  first step '
+              '{:7.3f}s  (serial construction in the parent: ~{:.3f}s)'.format(
+                  num_worker, started, ready, first_step, build * num_worker))
@@ -0,0 +1,76 @@
+"""Memory per env worker: forked from a torch process vs lean forkserver
+
+'fork' reproduces the old setup, where workers were forked from the
+training script with torch, tensorboardX and model loaded. 'forkserver'
+(the default of mario_env) starts them from a process that only imported
+mario_env.
+"""
+import argparse
+import time
+
+import torch  # noqa: F401 -- loaded like in the training scripts
+
+from mario_env import MarioEnvironment, Pipe
+from env_startup import wait_ready
+
+
+def read_kb(path, field):
+    with open(path) as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    return 0
+
+
+def has_torch(pid):
+    with open('/proc/{}/maps'.format(pid)) as f:
+        return any('libtorch' in line for line in f)
+
+
+def measure(env_id, num_worker, start_method):
+    works = []
+    parent_conns = []
+    for idx in range(num_worker):
+        parent_conn, child_conn = Pipe()
+        work = MarioEnvironment(
+            env_id, False, idx, child_conn, start_method=start_method)
+        work.start()
+        works.append(work)
+        parent_conns.append(parent_conn)
+    wait_ready(parent_conns, works)
+    # a few steps so lazily touched pages are counted
+    for _ in range(10):
+        for parent_conn in parent_conns:
+            parent_conn.send(0)
+        for parent_conn in parent_conns:
+            parent_conn.recv()
+    time.sleep(0.5)
+
+    rss, pss, torch_loaded = [], [], 0
+    for work in works:
+        rss.append(read_kb('/proc/{}/status'.format(work.pid), 'VmRSS'))
+        pss.append(read_kb('/proc/{}/smaps_rollup'.format(work.pid), 'Pss'))
+        torch_loaded += has_torch(work.pid)
+
+    for work in works:
+        work.terminate()
+    for work in works:
+        work.join()
+    return sum(rss) / num_worker, sum(pss) / num_worker, torch_loaded
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--env-id', default='SuperMarioBros-v0')
+    parser.add_argument('--num-worker', type=int, default=16)
+    parser.add_argument('--start-methods', nargs='+',
+                        default=['fork', 'forkserver', 'spawn'])
+    args = parser.parse_args()
+
+    for start_method in args.start_methods:
+        rss, pss, torch_loaded = measure(
+            args.env_id, args.num_worker, start_method)
+        print('{:10s} per worker: RSS {:8.1f} MB  PSS {:8.1f} MB  '
+              'torch mapped in {}/{} workers'.format(
+                  start_method, rss / 1024., pss / 1024., torch_loaded,
+                  args.num_worker))
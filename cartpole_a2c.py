@@ -9,6 +9,7 @@ import torch.nn as nn
 import torch
 
 from model import *
+from sampler import ActionSampler
 
 import torch.optim as optim
 from torch.multiprocessing import Pipe, Process
@@ -78,9 +79,11 @@ class ActorAgent(object):
             lam=0.95,
             use_gae=True,
             use_cuda=False,
-            use_noisy_net=False):
-        self.model = BaseActorCriticNetwork(
-            input_size, output_size, use_noisy_net)
+            use_noisy_net=False,
+            model_name='mlp',
+            seed=0):
+        self.model = make_model(
+            model_name, input_size, output_size, use_noisy_net)
         self.num_env = num_env
         self.output_size = output_size
         self.input_size = input_size
@@ -92,21 +95,21 @@ class ActorAgent(object):
             self.model.parameters(), lr=0.0224, eps=0.1, alpha=0.99)
         self.device = torch.device('cuda' if use_cuda else 'cpu')
         self.model = self.model.to(self.device)
+        self.sampler = ActionSampler(
+            num_env, output_size, self.device, seed)
 
-    def get_action(self, state):
+    def get_action(self, state, with_value=False):
         state = torch.Tensor(state).to(self.device)
         state = state.float()
-        policy, value = self.model(state)
-        policy = F.softmax(policy, dim=-1).data.cpu().numpy()
-
-        action = self.random_choice_prob_index(policy)
-
-        return action
+        with torch.no_grad():
+            policy, value = self.model(state)
+        action = self.sampler.sample(policy)
 
-    @staticmethod
-    def random_choice_prob_index(p, axis=1):
-        r = np.expand_dims(np.random.rand(p.shape[1 - axis]), axis=axis)
-        return (p.cumsum(axis=axis) > r).argmax(axis=axis)
+        if with_value:
+            log_prob = self.sampler.log_prob(policy, action)
+            return action.cpu().numpy(), log_prob.cpu().numpy(), \
+                value.squeeze(1).cpu().numpy()
+        return action.cpu().numpy()
 
     def train_model(self, s_batch, target_batch, y_batch, adv_batch):
         with torch.no_grad():
@@ -197,6 +200,7 @@ if __name__ == '__main__':
     num_step = 5
     num_worker = 16
     use_noisy_net = True
+    model_name = 'mlp'
 
     gamma = 0.99
     lam = 0.95
@@ -211,7 +215,8 @@ if __name__ == '__main__':
         gamma,
         use_gae=use_gae,
         use_cuda=use_cuda,
-        use_noisy_net=use_noisy_net)
+        use_noisy_net=use_noisy_net,
+        model_name=model_name)
     is_render = False
 
     works = []
@@ -0,0 +1,113 @@
+import glob
+import os
+import re
+import threading
+
+import numpy as np
+import torch
+
+
+def snapshot(obj):
+    """Deep copy of a (nested) training state with every tensor on the CPU"""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, np.ndarray):
+        return obj.copy()
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+class Checkpointer(object):
+    """Full training state checkpoints written on a background thread
+
+    `save` only copies the state to CPU memory; the write happens on a
+    writer thread, to a temporary file that is fsynced and atomically
+    renamed, so a crash never leaves a truncated checkpoint. If the writer
+    is still busy, the pending snapshot is replaced by the newer one. The
+    `keep` most recent checkpoints are kept. If `model_path` is given, the
+    model's state dict is also written there (as before, for evaluation).
+    """
+
+    def __init__(self, directory, prefix, keep=3, model_path=None):
+        if keep < 1:
+            raise ValueError('keep must be at least 1, got {}'.format(keep))
+        self.directory = directory
+        self.prefix = prefix
+        self.keep = keep
+        self.model_path = model_path
+        os.makedirs(directory, exist_ok=True)
+
+        self.pending = None
+        self.busy = False
+        self.cond = threading.Condition()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def path(self, step):
+        return os.path.join(
+            self.directory, '{}_{:012d}.ckpt'.format(self.prefix, int(step)))
+
+    def checkpoints(self):
+        pattern = re.compile(re.escape(self.prefix) + r'_(\d{12})\.ckpt$')
+        paths = glob.glob(os.path.join(self.directory, self.prefix + '_*.ckpt'))
+        return sorted(p for p in paths if pattern.search(p))
+
+    def latest(self):
+        paths = self.checkpoints()
+        return paths[-1] if paths else None
+
+    def save(self, state, step):
+        if self.error is not None:
+            raise self.error
+        state = snapshot(state)
+        with self.cond:
+            self.pending = (step, state)
+            self.cond.notify()
+
+    def load(self, path=None, map_location='cpu'):
+        path = path or self.latest()
+        if path is None:
+            return None
+        # the state holds NumPy RNG state and arrays, not only tensors
+        return torch.load(path, map_location=map_location, weights_only=False)
+
+    def flush(self):
+        """Block until every requested checkpoint is on disk"""
+        with self.cond:
+            while self.pending is not None or self.busy:
+                self.cond.wait()
+        if self.error is not None:
+            raise self.error
+
+    def _write(self, obj, path):
+        tmp_path = '{}.tmp{}'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            torch.save(obj, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while self.pending is None:
+                    self.cond.wait()
+                step, state = self.pending
+                self.pending = None
+                self.busy = True
+            try:
+                self._write(state, self.path(step))
+                if self.model_path is not None and 'model' in state:
+                    self._write(state['model'], self.model_path)
+                paths = self.checkpoints()
+                for path in paths[:len(paths) - self.keep]:
+                    os.remove(path)
+            except Exception as e:
+                self.error = e
+            with self.cond:
+                self.busy = False
+                self.cond.notify_all()
@@ -0,0 +1,101 @@
+"""Data-parallel learner helpers built on torch.distributed (gloo)
+
+Every rank runs its own env workers and rollout, computes gradients on its
+shard and averages them with the other ranks before the optimizer step.
+Launch with torchrun, e.g. on one box
+
+    torchrun --standalone --nproc_per_node=4 mario_ppo.py
+
+or on several nodes
+
+    torchrun --nnodes=2 --node_rank=<0|1> --nproc_per_node=4 \\
+        --master_addr=<host of node 0> --master_port=29500 mario_ppo.py
+"""
+import os
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(backend='gloo'):
+    rank = int(os.environ.get('RANK', 0))
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', '29500')
+
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank % torch.cuda.device_count())
+    return rank, world_size
+
+
+def gather_object(obj):
+    """[obj of every rank], on every rank ([obj] when not distributed)"""
+    if not dist.is_initialized():
+        return [obj]
+    objs = [None] * dist.get_world_size()
+    dist.all_gather_object(objs, obj)
+    return objs
+
+
+def broadcast_object(obj, src=0):
+    """obj of rank `src` on every rank"""
+    if not dist.is_initialized():
+        return obj
+    objs = [obj]
+    dist.broadcast_object_list(objs, src)
+    return objs[0]
+
+
+def broadcast_parameters(module, src=0):
+    """Start every rank from the weights of `src`"""
+    for tensor in list(module.parameters()) + list(module.buffers()):
+        buf = tensor.data.cpu()
+        dist.broadcast(buf, src)
+        tensor.data.copy_(buf)
+
+
+def all_reduce_gradients(parameters):
+    """Average gradients over all ranks with a single flat all-reduce"""
+    grads = [p.grad for p in parameters if p.grad is not None]
+    if not grads:
+        return
+    flat = torch.cat([g.reshape(-1) for g in grads])
+    device = flat.device
+    if device.type != 'cpu':
+        # gloo reduces host tensors
+        flat = flat.cpu()
+    dist.all_reduce(flat)
+    flat /= dist.get_world_size()
+    flat = flat.to(device)
+
+    offset = 0
+    for g in grads:
+        n = g.numel()
+        g.copy_(flat[offset:offset + n].view_as(g))
+        offset += n
+
+
+def all_reduce_moments(mean, var, count):
+    """Combine per-rank batch moments into the moments of the global batch
+
+    The result can be fed to RunningMeanStd.update_from_moments on every
+    rank, so the running statistics stay identical everywhere.
+    """
+    mean = np.asarray(mean, dtype=np.float64)
+    var = np.asarray(var, dtype=np.float64)
+    stats = torch.from_numpy(np.concatenate([
+        np.full(1, float(count)),
+        (count * mean).reshape(-1),
+        (count * (var + np.square(mean))).reshape(-1)]))
+    dist.all_reduce(stats)
+
+    total = stats[0].item()
+    n = mean.size
+    global_mean = stats[1:1 + n].numpy().reshape(mean.shape) / total
+    global_var = np.maximum(
+        stats[1 + n:].numpy().reshape(mean.shape) / total -
+        np.square(global_mean), 0)
+    return global_mean, global_var, total
@@ -0,0 +1,71 @@
+import json
+import os
+import time
+
+import numpy as np
+
+SPEC_CACHE = os.path.join(
+    os.path.expanduser('~'), '.cache', 'mario_rl', 'env_specs.json')
+
+
+def _make_mario_env(env_id, movement, **env_kwargs):
+    if env_id.startswith('Synthetic'):
+        # ROM-free stand-in, see synthetic_env.py
+        from synthetic_env import SyntheticMarioEnv
+        return SyntheticMarioEnv(n_action=len(movement), **env_kwargs)
+    import gym_super_mario_bros
+    from nes_py.wrappers import BinarySpaceToDiscreteSpaceEnv
+    return BinarySpaceToDiscreteSpaceEnv(
+        gym_super_mario_bros.make(env_id), movement)
+
+
+def load_env_spec(env_id, movement, make_env=_make_mario_env,
+                  cache_path=SPEC_CACHE):
+    """(observation shape, number of actions) of an env, without an emulator
+
+    The spec is read from a JSON cache; only on a miss is a live env built
+    (once) to fill it in.
+    """
+    key = '{}/{}'.format(env_id, json.dumps(movement, sort_keys=True))
+    try:
+        with open(cache_path) as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        cache = {}
+
+    if key not in cache:
+        env = make_env(env_id, movement)
+        cache[key] = {
+            'observation_shape': list(env.observation_space.shape),
+            'n_action': int(env.action_space.n),
+        }
+        env.close()
+
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = '{}.{}'.format(cache_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f, indent=2)
+        os.replace(tmp_path, cache_path)
+
+    spec = cache[key]
+    return tuple(spec['observation_shape']), spec['n_action']
+
+
+def wait_ready(parent_conns, works=None, timeout=600.):
+    """Wait for every worker's readiness message (its initial state)
+
+    Workers build their emulator in `run()`, so they all start up in
+    parallel; this gathers the first observation of each.
+    """
+    deadline = time.time() + timeout
+    states = []
+    for idx, parent_conn in enumerate(parent_conns):
+        while not parent_conn.poll(1.):
+            if works is not None and not works[idx].is_alive():
+                raise RuntimeError('worker {} died during startup (exit '
+                                   'code {})'.format(idx, works[idx].exitcode))
+            if time.time() > deadline:
+                raise RuntimeError('worker {} not ready after {}s'.format(
+                    idx, timeout))
+        states.append(parent_conn.recv())
+    return np.stack(states)
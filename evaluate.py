@@ -0,0 +1,237 @@
+"""Evaluate checkpoints on a pool of headless workers
+
+    python evaluate.py models/SuperMarioBros-v0_2018-09-26.model \\
+        --stages SuperMarioBros-1-1-v0 SuperMarioBros-1-2-v0 --episodes 32
+    python evaluate.py --watch checkpoints --out eval.jsonl
+
+Plays --episodes full episodes per stage (no life terminals) with batched
+inference over all workers, with greedy (argmax, NoisyLinear noise off) or
+sampled actions. Takes a model state dict (models/*.model) or a full
+training checkpoint (checkpoint.py). Reports the completion rate (flag
+reached), and the max x_pos, episode length and reward distributions.
+
+With --watch, the directory is polled for new files ending in --ext
+(.ckpt by default; the .model file next to them holds the same weights)
+and each is evaluated once, so evaluation can run next to training. A
+checkpoint that cannot be read (pruned or still being written) is retried
+on the next poll.
+"""
+import argparse
+import glob
+import json
+import os
+import pickle
+import time
+
+import numpy as np
+import torch
+
+from gym_super_mario_bros.actions import COMPLEX_MOVEMENT
+
+from env_startup import load_env_spec, wait_ready
+from mario_env import MarioEnvironment, Pipe
+from model import NoisyLinear, make_model
+from sampler import ActionSampler
+
+
+def load_policy(path, model_name, use_noisy_net, input_size, output_size,
+                device):
+    """(model, global step or None) from a state dict or a checkpoint"""
+    state = torch.load(path, map_location='cpu', weights_only=False)
+    global_step = None
+    if 'model' in state and isinstance(state['model'], dict):
+        global_step = state.get('global_step')
+        state = state['model']
+    model = make_model(model_name, input_size, output_size, use_noisy_net)
+    model.load_state_dict(state)
+    model.eval()
+    return model.to(device), global_step
+
+
+def distribution(values):
+    values = np.asarray(values, dtype=np.float64)
+    p10, p50, p90 = np.percentile(values, [10, 50, 90])
+    return {
+        'mean': float(values.mean()),
+        'std': float(values.std()),
+        'min': float(values.min()),
+        'p10': float(p10),
+        'p50': float(p50),
+        'p90': float(p90),
+        'max': float(values.max()),
+    }
+
+
+class Evaluator(object):
+    def __init__(self, stages, num_worker, movement=COMPLEX_MOVEMENT,
+                 device='cpu', seed=0, stuck_steps=0):
+        self.stages = stages
+        self.num_worker = num_worker
+        self.device = torch.device(device)
+        self.input_size, self.output_size = load_env_spec(stages[0], movement)
+        self.sampler = ActionSampler(
+            num_worker, self.output_size, self.device, seed)
+
+        self.works = []
+        self.parent_conns = []
+        for idx in range(num_worker):
+            parent_conn, child_conn = Pipe()
+            work = MarioEnvironment(
+                stages[0], False, idx, child_conn,
+                movement=movement,
+                life_done=False,
+                stuck_steps=stuck_steps,
+                report_info=True)
+            work.start()
+            self.works.append(work)
+            self.parent_conns.append(parent_conn)
+        self.states = wait_ready(self.parent_conns, self.works)
+
+    def act(self, model, greedy):
+        state = torch.from_numpy(self.states).to(self.device).float()
+        with torch.no_grad():
+            policy, _ = model(state)
+        if greedy:
+            return policy.argmax(dim=-1).cpu().numpy()
+        return self.sampler.sample(policy).cpu().numpy()
+
+    def play(self, model, stage, episodes, greedy=True):
+        """Summaries of `episodes` episodes, a fixed number per worker
+
+        Fixed per-worker quotas, rather than the first episodes to end, keep
+        the results from being biased towards short episodes.
+        """
+        # fresh episodes of this stage on every worker
+        for parent_conn in self.parent_conns:
+            parent_conn.send(('set_env', stage))
+        self.states = np.stack([c.recv() for c in self.parent_conns])
+
+        quota = [episodes // self.num_worker +
+                 (1 if i < episodes % self.num_worker else 0)
+                 for i in range(self.num_worker)]
+        results = []
+        while any(quota):
+            actions = self.act(model, greedy)
+            active = [i for i, q in enumerate(quota) if q]
+            for i in active:
+                self.parent_conns[i].send(actions[i])
+            for i in active:
+                s, r, d, rd, lr, info = self.parent_conns[i].recv()
+                self.states[i] = s
+                if info is not None:
+                    results.append(info)
+                    quota[i] -= 1
+        return results
+
+    def evaluate(self, model, episodes, greedy=True):
+        if greedy:
+            # the mean network
+            for m in model.modules():
+                if isinstance(m, NoisyLinear):
+                    m.in_noise.zero_()
+                    m.out_noise.zero_()
+        report = {}
+        for stage in self.stages:
+            start = time.perf_counter()
+            results = self.play(model, stage, episodes, greedy)
+            report[stage] = {
+                'episodes': len(results),
+                'completion_rate': float(np.mean(
+                    [r['flag_get'] for r in results])),
+                'max_pos': distribution([r['max_pos'] for r in results]),
+                'episode_length': distribution([r['steps'] for r in results]),
+                'reward': distribution([r['reward'] for r in results]),
+                'stuck_rate': float(np.mean([r['stuck'] for r in results])),
+                'sec': time.perf_counter() - start,
+            }
+        return report
+
+    def close(self):
+        for work in self.works:
+            work.terminate()
+        for work in self.works:
+            work.join()
+
+
+def print_report(path, report):
+    print('[Eval] {}'.format(path))
+    for stage, r in report.items():
+        print('    {:24s} completion {:6.1%}  max x p50 {:7.1f} p90 {:7.1f}  '
+              'length p50 {:7.1f}  reward {:7.2f}  ({} episodes, {:.1f}s)'
+              .format(stage, r['completion_rate'], r['max_pos']['p50'],
+                      r['max_pos']['p90'], r['episode_length']['p50'],
+                      r['reward']['mean'], r['episodes'], r['sec']))
+
+
+def new_checkpoints(directory, done, ext='.ckpt'):
+    """(path, mtime) of checkpoints not evaluated yet, oldest first"""
+    found = []
+    for path in glob.glob(os.path.join(directory, '*' + ext)):
+        # a .model file is rewritten in place by every save
+        try:
+            found.append((path, os.path.getmtime(path)))
+        except OSError:
+            # pruned since the glob
+            continue
+    return sorted((f for f in found if f not in done), key=lambda f: f[1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('checkpoints', nargs='*')
+    parser.add_argument('--watch', help='directory to poll for checkpoints')
+    parser.add_argument('--ext', default='.ckpt',
+                        help='checkpoint extension to watch (.ckpt, .model)')
+    parser.add_argument('--poll', type=float, default=60.)
+    parser.add_argument('--stages', nargs='+', default=['SuperMarioBros-v0'])
+    parser.add_argument('--episodes', type=int, default=16,
+                        help='per stage')
+    parser.add_argument('--num-worker', type=int, default=16)
+    parser.add_argument('--model-name', default='cnn')
+    parser.add_argument('--use-noisy-net', action='store_true')
+    parser.add_argument('--sample', action='store_true',
+                        help='sample actions instead of argmax')
+    parser.add_argument('--stuck-steps', type=int, default=0,
+                        help='end episodes without progress for this many '
+                             'steps (0: off), counted in stuck_rate')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--out', help='append one JSON line per checkpoint')
+    args = parser.parse_args()
+    if not args.checkpoints and not args.watch:
+        parser.error('give checkpoints or --watch')
+
+    evaluator = Evaluator(args.stages, args.num_worker, device=args.device,
+                          stuck_steps=args.stuck_steps)
+
+    def run(path):
+        model, global_step = load_policy(
+            path, args.model_name, args.use_noisy_net, evaluator.input_size,
+            evaluator.output_size, evaluator.device)
+        report = evaluator.evaluate(model, args.episodes, not args.sample)
+        print_report(path, report)
+        if args.out:
+            with open(args.out, 'a') as f:
+                f.write(json.dumps({
+                    'checkpoint': path,
+                    'global_step': global_step,
+                    'greedy': not args.sample,
+                    'stages': report,
+                }) + '\n')
+
+    try:
+        for path in args.checkpoints:
+            run(path)
+        done = set()
+        while args.watch:
+            for path, mtime in new_checkpoints(args.watch, done, args.ext):
+                try:
+                    run(path)
+                except (OSError, RuntimeError, EOFError,
+                        pickle.UnpicklingError) as e:
+                    print('[Eval] skipped {}: {}'.format(path, e))
+                    continue
+                done.add((path, mtime))
+            time.sleep(args.poll)
+    finally:
+        evaluator.close()
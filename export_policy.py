@@ -0,0 +1,229 @@
+"""Export a trained policy with the env preprocessing folded in
+
+    python export_policy.py models/SuperMarioBros-v0_2018-09-26.model \\
+        --out exported/mario --onnx
+
+writes <out>.pt (TorchScript) and optionally <out>.onnx. The exported
+module takes raw emulator frames, so clients need neither OpenCV nor the
+training code:
+
+    action, policy, value, history = policy(frame, history, reset)
+
+    frame    (B, 240, 256, 3) uint8 RGB
+    history  (B, 4, 84, 84) float32, the previous call's history output
+             (anything, e.g. zeros, where reset is set)
+    reset    (B,) bool, first frame of an episode: the stack is filled with
+             it, as MarioEnvironment.get_init_state does
+
+Grayscale and resize are the float forms of mario_env's pre_proc, rounded
+to uint8 levels like OpenCV. NoisyLinear noise is zeroed (the mean
+network). The export is checked against the training path (mario_env's
+pre_proc and ActionSampler, as in ActorAgent.get_action) on frames of the
+synthetic env, then its latency is measured at batch 1 to 64 on the CPU.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from evaluate import load_policy
+from mario_env import pre_proc
+from model import NoisyLinear
+from profile_models import input_size
+from sampler import ActionSampler
+from synthetic_env import SyntheticMarioEnv, H, W
+
+# cv2.COLOR_RGB2GRAY
+GRAY_WEIGHTS = (0.299, 0.587, 0.114)
+
+
+class ExportedPolicy(nn.Module):
+    def __init__(self, model, history_size=4, h=84, w=84):
+        super(ExportedPolicy, self).__init__()
+        self.model = model
+        self.history_size = history_size
+        self.h = h
+        self.w = w
+        self.register_buffer(
+            'gray_weights', torch.tensor(GRAY_WEIGHTS).view(1, 1, 1, 3))
+
+    def preprocess(self, frame):
+        gray = (frame.float() * self.gray_weights).sum(-1).round()
+        small = F.interpolate(
+            gray.unsqueeze(1), size=(self.h, self.w), mode='bilinear',
+            align_corners=False)
+        return small.round().clamp(0, 255) * (1.0 / 255.0)
+
+    def forward(self, frame, history, reset):
+        x = self.preprocess(frame)
+        shifted = torch.cat([history[:, 1:], x], 1)
+        history = torch.where(
+            reset.view(-1, 1, 1, 1), x.expand_as(shifted), shifted)
+        policy, value = self.model(history)
+        return policy.argmax(-1), policy, value, history
+
+
+def build(path, model_name, use_noisy_net, output_size):
+    model, _ = load_policy(path, model_name, use_noisy_net,
+                           input_size(model_name), output_size, 'cpu')
+    for m in model.modules():
+        if isinstance(m, NoisyLinear):
+            m.in_noise.zero_()
+            m.out_noise.zero_()
+    return ExportedPolicy(model).eval()
+
+
+def example_inputs(batch):
+    return (torch.randint(0, 256, (batch, H, W, 3), dtype=torch.uint8),
+            torch.zeros(batch, 4, 84, 84),
+            torch.ones(batch, dtype=torch.bool))
+
+
+def export_torchscript(policy, path):
+    with torch.no_grad():
+        traced = torch.jit.trace(policy, example_inputs(2))
+    traced.save(path)
+    return torch.jit.load(path)
+
+
+def export_onnx(policy, path):
+    torch.onnx.export(
+        policy, example_inputs(2), path,
+        input_names=['frame', 'history', 'reset'],
+        output_names=['action', 'policy', 'value', 'next_history'],
+        dynamic_axes={name: {0: 'batch'} for name in [
+            'frame', 'history', 'reset', 'action', 'policy', 'value',
+            'next_history']},
+        opset_version=13)
+
+
+def parity(policy, exported, output_size, num_env=8, num_step=64, seed=0):
+    """Exported module vs the training path on the same frame streams
+
+    Training path: mario_env.pre_proc + frame stack, then the model's
+    logits sampled like ActorAgent.get_action; both sides use an
+    ActionSampler of the same seed.
+    """
+    envs = [SyntheticMarioEnv(n_action=output_size, seed=seed + i)
+            for i in range(num_env)]
+    train_sampler = ActionSampler(num_env, output_size, 'cpu', seed)
+    export_sampler = ActionSampler(num_env, output_size, 'cpu', seed)
+    rng = np.random.RandomState(seed)
+
+    frames = np.stack([env.reset() for env in envs])
+    histories = np.stack([np.repeat(
+        pre_proc(f)[None], 4, 0) for f in frames]).astype(np.float32)
+    history = torch.zeros(num_env, 4, 84, 84)
+    reset = torch.ones(num_env, dtype=torch.bool)
+
+    stats = {'history_max_diff': 0., 'policy_max_diff': 0.,
+             'greedy_agree': 0, 'sampled_agree': 0, 'n': 0}
+    for _ in range(num_step):
+        with torch.no_grad():
+            policy_train, _ = policy.model(torch.from_numpy(histories))
+            action, policy_export, _, history = exported(
+                torch.from_numpy(frames), history, reset)
+        reset[:] = False
+        sampled_train = train_sampler.sample(policy_train).numpy()
+        sampled_export = export_sampler.sample(policy_export).numpy()
+
+        stats['history_max_diff'] = max(
+            stats['history_max_diff'],
+            float((history - torch.from_numpy(histories)).abs().max()))
+        stats['policy_max_diff'] = max(
+            stats['policy_max_diff'],
+            float((policy_export - policy_train).abs().max()))
+        stats['greedy_agree'] += int(
+            (action == policy_train.argmax(-1)).sum())
+        stats['sampled_agree'] += int((sampled_export == sampled_train).sum())
+        stats['n'] += num_env
+
+        # step on random actions, so both sides see the same frames
+        frames = np.stack(
+            [env.step(rng.randint(output_size))[0] for env in envs])
+        histories[:, :3] = histories[:, 1:]
+        histories[:, 3] = [pre_proc(f) for f in frames]
+
+    stats['greedy_agree'] /= float(stats['n'])
+    stats['sampled_agree'] /= float(stats['n'])
+    return stats
+
+
+def latency(fn, batch, n_iter=50, warmup=5):
+    inputs = example_inputs(batch)
+    with torch.no_grad():
+        for _ in range(warmup):
+            fn(*inputs)
+        times = []
+        for _ in range(n_iter):
+            start = time.perf_counter()
+            fn(*inputs)
+            times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('model_path')
+    parser.add_argument('--model-name', default='cnn',
+                        choices=['cnn', 'deep_cnn'])
+    parser.add_argument('--use-noisy-net', action='store_true')
+    parser.add_argument('--output-size', type=int, default=12)
+    parser.add_argument('--out', default='exported/policy')
+    parser.add_argument('--onnx', action='store_true')
+    parser.add_argument('--batch-sizes', type=int, nargs='+',
+                        default=[1, 2, 4, 8, 16, 32, 64])
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--atol', type=float, default=1e-2,
+                        help='allowed logit difference in the parity check')
+    parser.add_argument('--history-atol', type=float, default=0.01,
+                        help='allowed frame stack difference (OpenCV rounds '
+                             'to within 1/255)')
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    policy = build(args.model_path, args.model_name, args.use_noisy_net,
+                   args.output_size)
+    os.makedirs(os.path.dirname(args.out) or '.', exist_ok=True)
+    scripted = export_torchscript(policy, args.out + '.pt')
+    print('TorchScript: {}.pt'.format(args.out))
+    runners = [('eager', policy), ('torchscript', scripted)]
+    if args.onnx:
+        export_onnx(policy, args.out + '.onnx')
+        print('ONNX: {}.onnx'.format(args.out))
+        try:
+            import onnxruntime
+        except ImportError:
+            print('onnxruntime is not installed, ONNX latency skipped')
+        else:
+            session = onnxruntime.InferenceSession(
+                args.out + '.onnx', providers=['CPUExecutionProvider'])
+
+            def run_onnx(frame, history, reset):
+                return session.run(None, {
+                    'frame': frame.numpy(), 'history': history.numpy(),
+                    'reset': reset.numpy()})
+            runners.append(('onnxruntime', run_onnx))
+
+    stats = parity(policy, scripted, args.output_size)
+    print('parity: history max diff {history_max_diff:.4f}  logits max diff '
+          '{policy_max_diff:.4f}  greedy agree {greedy_agree:.2%}  sampled '
+          'agree {sampled_agree:.2%}'.format(**stats))
+
+    print('{:>6s} '.format('batch') + ''.join(
+        '{:>22s}'.format(name + ' ms') for name, _ in runners))
+    for batch in args.batch_sizes:
+        print('{:6d} '.format(batch) + ''.join(
+            '{:22.3f}'.format(latency(fn, batch) * 1e3)
+            for _, fn in runners))
+
+    if stats['history_max_diff'] > args.history_atol or \
+            stats['policy_max_diff'] > args.atol:
+        sys.exit(1)
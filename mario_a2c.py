@@ -13,9 +13,14 @@ import time
 import datetime
 
 from model import *
+from mario_env import MarioEnvironment
+from env_startup import load_env_spec, wait_ready
+from resources import ResourceManager
+from sampler import ActionSampler
+from amp import MixedPrecision
 
 import torch.optim as optim
-from torch.multiprocessing import Pipe, Process
+from torch.multiprocessing import Pipe
 
 from collections import deque
 
@@ -25,108 +30,6 @@ from nes_py.wrappers import BinarySpaceToDiscreteSpaceEnv
 from gym_super_mario_bros.actions import SIMPLE_MOVEMENT
 
 
-class MarioEnvironment(Process):
-    def __init__(
-            self,
-            env_id,
-            is_render,
-            env_idx,
-            child_conn,
-            history_size=4,
-            h=84,
-            w=84):
-        super(MarioEnvironment, self).__init__()
-        self.daemon = True
-        self.env = BinarySpaceToDiscreteSpaceEnv(
-            gym_super_mario_bros.make(env_id), SIMPLE_MOVEMENT)
-
-        self.is_render = is_render
-        self.env_idx = env_idx
-        self.steps = 0
-        self.episode = 0
-        self.rall = 0
-        self.recent_rlist = deque(maxlen=100)
-        self.child_conn = child_conn
-
-        self.history_size = history_size
-        self.history = np.zeros([history_size, h, w])
-        self.h = h
-        self.w = w
-
-        self.reset()
-
-    def run(self):
-        super(MarioEnvironment, self).run()
-        while True:
-            action = self.child_conn.recv()
-            if self.is_render:
-                self.env.render()
-            obs, reward, done, info = self.env.step(action)
-
-            if life_done:
-                # when Mario loses life, changes the state to the terminal
-                # state.
-                if self.lives > info['life'] and info['life'] > 0:
-                    force_done = True
-                    self.lives = info['life']
-                else:
-                    force_done = done
-                    self.lives = info['life']
-            else:
-                # normal terminal state
-                force_done = done
-
-            # reward range -15 ~ 15
-            log_reward = reward / 15
-            self.rall += reward
-
-            if use_icm:
-                if info['flag_get'] or self.stage < info['stage']:
-                    r = 10.
-                    self.stage = info['stage']
-                elif force_done:
-                    r = -10.
-                else:
-                    r = 0.
-
-            self.history[:3, :, :] = self.history[1:, :, :]
-            self.history[3, :, :] = self.pre_proc(obs)
-
-            self.steps += 1
-
-            if done:
-                self.recent_rlist.append(self.rall)
-                print("[Episode {}({})] Step: {}  Reward: {}  Recent Reward: {}".format(
-                    self.episode, self.env_idx, self.steps, self.rall, np.mean(self.recent_rlist)))
-
-                self.history = self.reset()
-
-            self.child_conn.send(
-                [self.history[:, :, :], r, force_done, done, log_reward])
-
-    def reset(self):
-        self.steps = 0
-        self.episode += 1
-        self.rall = 0
-        self.lives = 3
-        self.stage = 1
-        self.get_init_state(self.env.reset())
-        return self.history[:, :, :]
-
-    def pre_proc(self, X):
-        # grayscaling
-        x = cv2.cvtColor(X, cv2.COLOR_RGB2GRAY)
-        # resize
-        x = cv2.resize(x, (self.h, self.w))
-        x = np.float32(x) * (1.0 / 255.0)
-
-        return x
-
-    def get_init_state(self, s):
-        for i in range(self.history_size):
-            self.history[i, :, :] = self.pre_proc(s)
-
-
 class ActorAgent(object):
     def __init__(
             self,
@@ -138,9 +41,12 @@ class ActorAgent(object):
             lam=0.95,
             use_gae=True,
             use_cuda=False,
-            use_noisy_net=True):
-        self.model = CnnActorCriticNetwork(
-            input_size, output_size, use_noisy_net)
+            use_noisy_net=True,
+            model_name='cnn',
+            use_amp=False,
+            seed=0):
+        self.model = make_model(
+            model_name, input_size, output_size, use_noisy_net)
         if use_icm:
             self.icm = CuriosityModel(input_size, output_size)
         self.num_env = num_env
@@ -164,18 +70,24 @@ class ActorAgent(object):
         self.device = torch.device('cuda' if use_cuda else 'cpu')
 
         self.model = self.model.to(self.device)
+        self.sampler = ActionSampler(
+            num_env, output_size, self.device, seed)
         if use_icm:
             self.icm = self.icm.to(self.device)
+        self.amp = MixedPrecision(self.device, use_amp)
 
-    def get_action(self, state):
+    def get_action(self, state, with_value=False):
         state = torch.Tensor(state).to(self.device)
         state = state.float()
-        policy, value = self.model(state)
-        policy = F.softmax(policy, dim=-1).data.cpu().numpy()
-
-        action = self.random_choice_prob_index(policy)
+        with torch.no_grad():
+            policy, value = self.model(state)
+        action = self.sampler.sample(policy)
 
-        return action
+        if with_value:
+            log_prob = self.sampler.log_prob(policy, action)
+            return action.cpu().numpy(), log_prob.cpu().numpy(), \
+                value.squeeze(1).cpu().numpy()
+        return action.cpu().numpy()
 
     def compute_intrinsic_reward(self, state, next_state, action):
         state = torch.FloatTensor(state).to(self.device)
@@ -194,11 +106,6 @@ class ActorAgent(object):
             ((real_next_state_feature - pred_next_state_feature).pow(2)).sum(1) / 2.
         return intrinsic_reward.data.cpu().numpy()
 
-    @staticmethod
-    def random_choice_prob_index(p, axis=1):
-        r = np.expand_dims(np.random.rand(p.shape[1 - axis]), axis=axis)
-        return (p.cumsum(axis=axis) > r).argmax(axis=axis)
-
     def forward_transition(self, state, next_state):
         state = torch.from_numpy(state).to(self.device)
         state = state.float()
@@ -243,8 +150,12 @@ class ActorAgent(object):
             action_onehot.zero_()
             action_onehot.scatter_(1, y_batch.view(len(y_batch), -1), 1)
 
-            real_next_state_feature, pred_next_state_feature, pred_action = self.icm(
-                [s_batch, next_s_batch, action_onehot])
+            with self.amp.autocast():
+                real_next_state_feature, pred_next_state_feature, pred_action = self.icm(
+                    [s_batch, next_s_batch, action_onehot])
+            real_next_state_feature = real_next_state_feature.float()
+            pred_next_state_feature = pred_next_state_feature.float()
+            pred_action = pred_action.float()
 
             inverse_loss = ce(pred_action, y_batch)
             forward_loss = forward_mse(
@@ -253,7 +164,9 @@ class ActorAgent(object):
 
         # --------------------------------------------------------------------------------
         # for multiply advantage
-        policy, value = self.model(s_batch)
+        with self.amp.autocast():
+            policy, value = self.model(s_batch)
+        policy, value = policy.float(), value.float()
         m = Categorical(F.softmax(policy, dim=-1))
 
         # Actor loss
@@ -275,13 +188,21 @@ class ActorAgent(object):
         else:
             loss = actor_loss.mean() + 0.5 * critic_loss - entropy_coef * entropy.mean()
 
-        loss.backward()
-        torch.nn.utils.clip_grad_norm_(self.model.parameters(), clip_grad_norm)
-        self.optimizer.step()
+        self.amp.backward(loss)
+        self.amp.step(
+            self.optimizer,
+            self.model.parameters(),
+            clip_grad_norm)
 
 
-def make_train_data(reward, done, value, next_value):
+def make_train_data(reward, done, value, next_value, truncated=None):
+    """truncated: steps that ended an episode by a time limit; next_value
+    is then the value of the episode's last state, and returns do not
+    flow back from the next episode
+    """
     discounted_return = np.empty([num_step])
+    if truncated is None:
+        truncated = np.zeros([num_step])
 
     # Discounted Return
     if use_gae:
@@ -289,7 +210,8 @@ def make_train_data(reward, done, value, next_value):
         for t in range(num_step - 1, -1, -1):
             delta = reward[t] + gamma * \
                 next_value[t] * (1 - done[t]) - value[t]
-            gae = delta + gamma * lam * (1 - done[t]) * gae
+            gae = delta + gamma * lam * \
+                (1 - done[t]) * (1 - truncated[t]) * gae
 
             discounted_return[t] = gae + value[t]
 
@@ -299,6 +221,8 @@ def make_train_data(reward, done, value, next_value):
     else:
         running_add = next_value[-1]
         for t in range(num_step - 1, -1, -1):
+            if truncated[t]:
+                running_add = next_value[t]
             running_add = reward[t] + gamma * running_add * (1 - done[t])
             discounted_return[t] = running_add
 
@@ -310,24 +234,27 @@ def make_train_data(reward, done, value, next_value):
 
 if __name__ == '__main__':
     env_id = 'SuperMarioBros-v0'
-    env = BinarySpaceToDiscreteSpaceEnv(
-        gym_super_mario_bros.make(env_id), SIMPLE_MOVEMENT)
-    input_size = env.observation_space.shape  # 4
-    output_size = env.action_space.n  # 2
-
-    env.close()
+    input_size, output_size = load_env_spec(env_id, SIMPLE_MOVEMENT)
 
     writer = SummaryWriter()
     use_cuda = False
     use_gae = True
     life_done = True
+    # end episodes after stuck_steps steps without progress (0: off),
+    # 'done' as a terminal or 'truncate', see mario_env.py
+    stuck_steps = 0
+    stuck_mode = 'truncate'
+    truncate = stuck_steps > 0 and stuck_mode == 'truncate'
 
     is_load_model = False
     is_training = True
 
     is_render = True
+    use_cpu_affinity = False
     use_standardization = True
     use_noisy_net = True
+    model_name = 'cnn'
+    use_amp = False
     use_icm = True
 
     model_path = 'models/{}_{}.model'.format(env_id,
@@ -363,7 +290,9 @@ if __name__ == '__main__':
         num_step,
         gamma,
         use_cuda=use_cuda,
-        use_noisy_net=use_noisy_net)
+        use_noisy_net=use_noisy_net,
+        model_name=model_name,
+        use_amp=use_amp)
 
     if is_load_model:
         if use_cuda:
@@ -377,18 +306,30 @@ if __name__ == '__main__':
     if not is_training:
         agent.model.eval()
 
+    resources = ResourceManager(num_worker, enabled=use_cpu_affinity)
+    resources.apply_learner()
+
     works = []
     parent_conns = []
     child_conns = []
     for idx in range(num_worker):
         parent_conn, child_conn = Pipe()
-        work = MarioEnvironment(env_id, is_render, idx, child_conn)
+        work = MarioEnvironment(
+            env_id, is_render, idx, child_conn,
+            cpu_set=resources.worker_cores(idx),
+            movement=SIMPLE_MOVEMENT,
+            life_done=life_done,
+            stuck_steps=stuck_steps,
+            stuck_mode=stuck_mode,
+            report_truncated=truncate,
+            reward_type='stage' if use_icm else 'log',
+            report_done=True)
         work.start()
         works.append(work)
         parent_conns.append(parent_conn)
         child_conns.append(child_conn)
 
-    states = np.zeros([num_worker, 4, 84, 84])
+    states = wait_ready(parent_conns, works)
 
     sample_episode = 0
     sample_rall = 0
@@ -399,6 +340,7 @@ if __name__ == '__main__':
 
     while True:
         total_state, total_reward, total_done, total_next_state, total_action = [], [], [], [], []
+        total_truncated = []
         global_step += (num_worker * num_step)
 
         for _ in range(num_step):
@@ -410,26 +352,39 @@ if __name__ == '__main__':
                 parent_conn.send(action)
 
             next_states, rewards, dones, real_dones, log_rewards = [], [], [], [], []
+            last_states = []
             for parent_conn in parent_conns:
-                s, r, d, rd, lr = parent_conn.recv()
+                message = parent_conn.recv()
+                s, r, d, rd, lr = message[:5]
                 next_states.append(s)
                 rewards.append(r)
                 dones.append(d)
                 real_dones.append(rd)
                 log_rewards.append(lr)
+                # the last state of a truncated episode (report_truncated)
+                last_states.append(message[5] if len(message) > 5 else None)
 
             next_states = np.stack(next_states)
             rewards = np.hstack(rewards)
             dones = np.hstack(dones)
             real_dones = np.hstack(real_dones)
+            # truncated episodes bootstrap from their last state, not from
+            # the first state of the next episode sent in their place
+            truncated = np.array([last is not None for last in last_states])
+            bootstrap_states = next_states
+            if truncated.any():
+                bootstrap_states = next_states.copy()
+                bootstrap_states[truncated] = np.stack(
+                    [last for last in last_states if last is not None])
 
             if use_icm:
                 intrinsic_reward = agent.compute_intrinsic_reward(
-                    states, next_states, actions)
+                    states, bootstrap_states, actions)
                 rewards += intrinsic_reward
 
             total_state.append(states)
-            total_next_state.append(next_states)
+            total_next_state.append(bootstrap_states)
+            total_truncated.append(truncated)
             total_reward.append(rewards)
             total_done.append(dones)
             total_action.append(actions)
@@ -453,6 +408,8 @@ if __name__ == '__main__':
             total_reward = np.stack(total_reward).transpose().reshape([-1])
             total_action = np.stack(total_action).transpose().reshape([-1])
             total_done = np.stack(total_done).transpose().reshape([-1])
+            total_truncated = np.stack(
+                total_truncated).transpose().reshape([-1])
 
             value, next_value, policy = agent.forward_transition(
                 total_state, total_next_state)
@@ -474,7 +431,8 @@ if __name__ == '__main__':
                                                          num_step:(idx + 1) * num_step],
                                               value[idx *
                                                     num_step:(idx + 1) * num_step],
-                                              next_value[idx * num_step:(idx + 1) * num_step])
+                                              next_value[idx * num_step:(idx + 1) * num_step],
+                                              total_truncated[idx * num_step:(idx + 1) * num_step])
                 total_target.append(target)
                 total_adv.append(adv)
 
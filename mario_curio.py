@@ -13,9 +13,21 @@ import time
 import datetime
 
 from model import *
+from mario_env import MarioEnvironment
+from env_startup import load_env_spec, wait_ready
+from resources import ResourceManager
+from sampler import ActionSampler
+from amp import MixedPrecision
+from distributed import *
+from checkpoint import Checkpointer, snapshot
+from timer import PhaseTimer
+from metrics import MetricsWriter
+from memory import account, log_account
+from profile_capture import ProfilerTrigger
+from reward_norm import RewardNormalizer
 
 import torch.optim as optim
-from torch.multiprocessing import Pipe, Process
+from torch.multiprocessing import Pipe
 
 from collections import deque
 
@@ -25,110 +37,6 @@ from nes_py.wrappers import BinarySpaceToDiscreteSpaceEnv
 from gym_super_mario_bros.actions import SIMPLE_MOVEMENT, COMPLEX_MOVEMENT
 
 
-class MarioEnvironment(Process):
-    def __init__(
-            self,
-            env_id,
-            is_render,
-            env_idx,
-            child_conn,
-            history_size=4,
-            h=84,
-            w=84):
-        super(MarioEnvironment, self).__init__()
-        self.daemon = True
-        self.env = BinarySpaceToDiscreteSpaceEnv(
-            gym_super_mario_bros.make(env_id), movement)
-
-        self.is_render = is_render
-        self.env_idx = env_idx
-        self.steps = 0
-        self.episode = 0
-        self.rall = 0
-        self.recent_rlist = deque(maxlen=100)
-        self.child_conn = child_conn
-
-        self.history_size = history_size
-        self.history = np.zeros([history_size, h, w])
-        self.h = h
-        self.w = w
-
-        self.reset()
-
-    def run(self):
-        super(MarioEnvironment, self).run()
-        while True:
-            action = self.child_conn.recv()
-            if self.is_render:
-                self.env.render()
-            obs, reward, done, info = self.env.step(action)
-
-            if life_done:
-                # when Mario loses life, changes the state to the terminal
-                # state.
-                if self.lives > info['life'] and info['life'] > 0:
-                    force_done = True
-                    self.lives = info['life']
-                else:
-                    force_done = done
-                    self.lives = info['life']
-            else:
-                # normal terminal state
-                force_done = done
-
-            # reward range -15 ~ 15
-            log_reward = reward / 15
-            self.rall += log_reward
-
-            r = 0.
-
-            self.history[:3, :, :] = self.history[1:, :, :]
-            self.history[3, :, :] = self.pre_proc(obs)
-
-            self.steps += 1
-
-            if done:
-                self.recent_rlist.append(self.rall)
-                print(
-                    "[Episode {}({})] Step: {}  Reward: {}  Recent Reward: {}  Stage: {} current x:{}   max x:{}".format(
-                        self.episode,
-                        self.env_idx,
-                        self.steps,
-                        self.rall,
-                        np.mean(
-                            self.recent_rlist),
-                        info['stage'],
-                        info['x_pos'],
-                        self.max_pos))
-
-                self.history = self.reset()
-            self.child_conn.send(
-                [self.history[:, :, :], r, False, done, log_reward])
-
-    def reset(self):
-        self.steps = 0
-        self.episode += 1
-        self.rall = 0
-        self.lives = 3
-        self.stage = 1
-        self.max_pos = 0
-        self.get_init_state(self.env.reset())
-        return self.history[:, :, :]
-
-    def pre_proc(self, X):
-        # grayscaling
-        x = cv2.cvtColor(X, cv2.COLOR_RGB2GRAY)
-        # resize
-        x = cv2.resize(x, (self.h, self.w))
-        x = np.float32(x) * (1.0 / 255.0)
-
-        return x
-
-    def get_init_state(self, s):
-        for i in range(self.history_size):
-            self.history[i, :, :] = self.pre_proc(s)
-
-
 class ActorAgent(object):
     def __init__(
             self,
@@ -140,9 +48,13 @@ class ActorAgent(object):
             lam=0.95,
             use_gae=True,
             use_cuda=False,
-            use_noisy_net=True):
-        self.model = CnnActorCriticNetwork(
-            input_size, output_size, use_noisy_net)
+            use_noisy_net=True,
+            model_name='cnn',
+            use_amp=False,
+            use_distributed=False,
+            seed=0):
+        self.model = make_model(
+            model_name, input_size, output_size, use_noisy_net)
 
         self.icm = CuriosityModel(input_size, output_size)
         self.num_env = num_env
@@ -152,6 +64,7 @@ class ActorAgent(object):
         self.gamma = gamma
         self.lam = lam
         self.use_gae = use_gae
+        self.use_distributed = use_distributed
         self.optimizer = optim.Adam(
             list(
                 self.model.parameters()) +
@@ -162,17 +75,23 @@ class ActorAgent(object):
         self.device = torch.device('cuda' if use_cuda else 'cpu')
 
         self.model = self.model.to(self.device)
+        self.sampler = ActionSampler(
+            num_env, output_size, self.device, seed)
         self.icm = self.icm.to(self.device)
+        self.amp = MixedPrecision(self.device, use_amp)
 
-    def get_action(self, state):
+    def get_action(self, state, with_value=False):
         state = torch.Tensor(state).to(self.device)
         state = state.float()
-        policy, value = self.model(state)
-        policy = F.softmax(policy, dim=-1).data.cpu().numpy()
-
-        action = self.random_choice_prob_index(policy)
+        with torch.no_grad():
+            policy, value = self.model(state)
+        action = self.sampler.sample(policy)
 
-        return action
+        if with_value:
+            log_prob = self.sampler.log_prob(policy, action)
+            return action.cpu().numpy(), log_prob.cpu().numpy(), \
+                value.squeeze(1).cpu().numpy()
+        return action.cpu().numpy()
 
     def compute_intrinsic_reward(self, state, next_state, action):
         state = torch.FloatTensor(state).to(self.device)
@@ -191,11 +110,6 @@ class ActorAgent(object):
             (real_next_state_feature - pred_next_state_feature).pow(2).sum(1) / 2
         return intrinsic_reward.data.cpu().numpy()
 
-    @staticmethod
-    def random_choice_prob_index(p, axis=1):
-        r = np.expand_dims(np.random.rand(p.shape[1 - axis]), axis=axis)
-        return (p.cumsum(axis=axis) > r).argmax(axis=axis)
-
     def forward_transition(self, state, next_state):
         state = torch.from_numpy(state).to(self.device)
         state = state.float()
@@ -227,12 +141,14 @@ class ActorAgent(object):
         ce = nn.CrossEntropyLoss()
         forward_mse = nn.MSELoss()
         self.model.train()
+        resample_noise(self.model, 'update')
         self.icm.train()
 
         with torch.no_grad():
             # for multiply advantage
-            policy_old, value_old = self.model(s_batch)
-            m_old = Categorical(F.softmax(policy_old, dim=-1))
+            with self.amp.autocast():
+                policy_old, value_old = self.model(s_batch)
+            m_old = Categorical(F.softmax(policy_old.float(), dim=-1))
             log_prob_old = m_old.log_prob(y_batch)
 
         for i in range(epoch):
@@ -248,15 +164,21 @@ class ActorAgent(object):
                 action_onehot.scatter_(1, y_batch.view(
                     len(y_batch[sample_idx]), -1), 1)
 
-                real_next_state_feature, pred_next_state_feature, pred_action = self.icm(
-                    [s_batch[sample_idx], next_s_batch[sample_idx], action_onehot])
+                with self.amp.autocast():
+                    real_next_state_feature, pred_next_state_feature, pred_action = self.icm(
+                        [s_batch[sample_idx], next_s_batch[sample_idx], action_onehot])
+                real_next_state_feature = real_next_state_feature.float()
+                pred_next_state_feature = pred_next_state_feature.float()
+                pred_action = pred_action.float()
                 inverse_loss = ce(
                     pred_action, y_batch[sample_idx].detach())
                 forward_loss = forward_mse(
                     pred_next_state_feature, real_next_state_feature.detach())
                 # ---------------------------------------------------------------------------------
 
-                policy, value = self.model(s_batch[sample_idx])
+                with self.amp.autocast():
+                    policy, value = self.model(s_batch[sample_idx])
+                policy, value = policy.float(), value.float()
                 m = Categorical(F.softmax(policy, dim=-1))
                 log_prob = m.log_prob(y_batch[sample_idx])
 
@@ -276,16 +198,26 @@ class ActorAgent(object):
                 self.optimizer.zero_grad()
                 loss = (actor_loss + 0.5 * critic_loss) + icm_scale * \
                     ((1 - beta) * inverse_loss + beta * forward_loss)
-                loss.backward()
-                torch.nn.utils.clip_grad_norm_(
+                self.amp.backward(loss)
+                if self.use_distributed:
+                    all_reduce_gradients(
+                        list(self.model.parameters()) +
+                        list(self.icm.parameters()))
+                self.amp.step(
+                    self.optimizer,
                     list(self.model.parameters()) +
                     list(self.icm.parameters()),
                     clip_grad_norm)
-                self.optimizer.step()
 
 
-def make_train_data(reward, done, value, next_value):
+def make_train_data(reward, done, value, next_value, truncated=None):
+    """truncated: steps that ended an episode by a time limit; next_value
+    is then the value of the episode's last state, and returns do not
+    flow back from the next episode
+    """
     discounted_return = np.empty([num_step])
+    if truncated is None:
+        truncated = np.zeros([num_step])
 
     # Discounted Return
     if use_gae:
@@ -293,7 +225,8 @@ def make_train_data(reward, done, value, next_value):
         for t in range(num_step - 1, -1, -1):
             delta = reward[t] + gamma * \
                 next_value[t] * (1 - done[t]) - value[t]
-            gae = delta + gamma * lam * (1 - done[t]) * gae
+            gae = delta + gamma * lam * \
+                (1 - done[t]) * (1 - truncated[t]) * gae
 
             discounted_return[t] = gae + value[t]
 
@@ -303,6 +236,8 @@ def make_train_data(reward, done, value, next_value):
     else:
         running_add = next_value[-1]
         for t in range(num_step - 1, -1, -1):
+            if truncated[t]:
+                running_add = next_value[t]
             running_add = reward[t] + gamma * running_add * (1 - done[t])
             discounted_return[t] = running_add
 
@@ -312,76 +247,64 @@ def make_train_data(reward, done, value, next_value):
     return discounted_return, adv
 
 
-class RunningMeanStd(object):
-    # https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Parallel_algorithm
-    def __init__(self, epsilon=1e-4, shape=()):
-        self.mean = np.zeros(shape, 'float64')
-        self.var = np.ones(shape, 'float64')
-        self.count = epsilon
-
-    def update(self, x):
-        batch_mean = np.mean(x, axis=0)
-        batch_var = np.var(x, axis=0)
-        batch_count = x.shape[0]
-        self.update_from_moments(batch_mean, batch_var, batch_count)
-
-    def update_from_moments(self, batch_mean, batch_var, batch_count):
-        delta = batch_mean - self.mean
-        tot_count = self.count + batch_count
-
-        new_mean = self.mean + delta * batch_count / tot_count
-        m_a = self.var * (self.count)
-        m_b = batch_var * (batch_count)
-        M2 = m_a + m_b + np.square(delta) * self.count * \
-            batch_count / (self.count + batch_count)
-        new_var = M2 / (self.count + batch_count)
-
-        new_count = batch_count + self.count
-
-        self.mean = new_mean
-        self.var = new_var
-        self.count = new_count
-
-
-class RewardForwardFilter(object):
-    def __init__(self, gamma):
-        self.rewems = None
-        self.gamma = gamma
-
-    def update(self, rews):
-        if self.rewems is None:
-            self.rewems = rews
-        else:
-            self.rewems = self.rewems * self.gamma + rews
-        return self.rewems
-
-
 if __name__ == '__main__':
     env_id = 'SuperMarioBros-v0'
     movement = COMPLEX_MOVEMENT
-    env = BinarySpaceToDiscreteSpaceEnv(
-        gym_super_mario_bros.make(env_id), movement)
-    input_size = env.observation_space.shape  # 4
-    output_size = env.action_space.n  # 2
+    input_size, output_size = load_env_spec(env_id, movement)
 
-    env.close()
+    # one learner per rank, see distributed.py
+    use_distributed = False
+    rank, world_size = 0, 1
+    if use_distributed:
+        rank, world_size = init_distributed()
 
-    writer = SummaryWriter()
+    writer = SummaryWriter(comment='' if rank == 0 else '_rank{}'.format(rank))
     use_cuda = True
     use_gae = True
     life_done = True
+    # end episodes after stuck_steps steps without progress (0: off),
+    # 'done' as a terminal or 'truncate', see mario_env.py
+    stuck_steps = 0
+    stuck_mode = 'truncate'
+    truncate = stuck_steps > 0 and stuck_mode == 'truncate'
+    # directory of archived progress points shared by all workers to start
+    # episodes from (None: off), see snapshot_archive.py
+    archive_path = None
 
     is_load_model = False
     is_training = True
 
     is_render = False
+    use_cpu_affinity = False
     use_standardization = True
     use_noisy_net = False
+    model_name = 'cnn'
+    use_amp = False
+    # 'call', 'update' or 'rollout'
+    noise_resample = 'call'
 
     model_path = 'models/{}_{}.model'.format(env_id,
                                              datetime.date.today().isoformat())
     load_model_path = 'models/SuperMarioBros-v0_2018-09-26.model'
 
+    # full training state, written in the background (see checkpoint.py)
+    checkpoint_dir = 'checkpoints'
+    keep_checkpoint = 3
+    resume = False
+
+    # per-phase wall-clock timing, see timer.py
+    use_timer = True
+    timing_log = 'timing.jsonl'
+    # scalars are also appended here, see metrics.py
+    metrics_csv = 'metrics.csv'
+    # rollout / model / optimizer / worker memory per update, see memory.py
+    use_memory_report = True
+    # kill -USR1 <pid> profiles the next profile_updates updates
+    profile_updates = 3
+    trace_dir = 'traces'
+    # keep the intrinsic reward filter / moments on the learner device
+    reward_norm_on_device = False
+
     lam = 0.95
     num_worker = 16
     num_step = 128
@@ -412,9 +335,14 @@ if __name__ == '__main__':
         num_step,
         gamma,
         use_cuda=use_cuda,
-        use_noisy_net=use_noisy_net)
-    reward_rms = RunningMeanStd()
-    discounted_reward = RewardForwardFilter(gamma)
+        use_noisy_net=use_noisy_net,
+        model_name=model_name,
+        use_amp=use_amp,
+        use_distributed=use_distributed,
+        seed=rank)
+    set_noise_resample(agent.model, noise_resample)
+    reward_norm = RewardNormalizer(
+        num_worker, gamma, agent.device if reward_norm_on_device else 'cpu')
 
     if is_load_model:
         if use_cuda:
@@ -428,18 +356,30 @@ if __name__ == '__main__':
     if not is_training:
         agent.model.eval()
 
+    resources = ResourceManager(num_worker, enabled=use_cpu_affinity)
+    resources.apply_learner()
+
     works = []
     parent_conns = []
     child_conns = []
     for idx in range(num_worker):
         parent_conn, child_conn = Pipe()
-        work = MarioEnvironment(env_id, is_render, idx, child_conn)
+        work = MarioEnvironment(
+            env_id, is_render, rank * num_worker + idx, child_conn,
+            cpu_set=resources.worker_cores(idx),
+            movement=movement,
+            life_done=life_done,
+            stuck_steps=stuck_steps,
+            stuck_mode=stuck_mode,
+            report_truncated=truncate,
+            archive_path=archive_path,
+            reward_type='none')
         work.start()
         works.append(work)
         parent_conns.append(parent_conn)
         child_conns.append(child_conn)
 
-    states = np.zeros([num_worker, 4, 84, 84])
+    states = wait_ready(parent_conns, works)
 
     sample_episode = 0
     sample_rall = 0
@@ -447,11 +387,77 @@ if __name__ == '__main__':
     sample_step = 0
     sample_env_idx = 0
     global_step = 0
+    episode_rall = np.zeros(num_worker)
+    episode_i_rall = np.zeros(num_worker)
+    episode_step = np.zeros(num_worker)
     recent_prob = deque(maxlen=10)
+    metrics = MetricsWriter(writer, metrics_csv)
+    timer = PhaseTimer(use_timer, metrics, timing_log)
+    profiler = ProfilerTrigger(
+        profile_updates, trace_dir, '{}_curio_rank{}'.format(env_id, rank))
+
+    def training_state(rngs):
+        return {
+            'model': agent.model.state_dict(),
+            'icm': agent.icm.state_dict(),
+            'reward_norm': reward_norm.state_dict(),
+            'optimizer': agent.optimizer.state_dict(),
+            'scaler': agent.amp.scaler.state_dict()
+            if agent.amp.scaler is not None else None,
+            'global_step': global_step,
+            'sample_episode': sample_episode,
+            # per rank, so every rank resumes its own action streams
+            'rng': rngs,
+        }
+
+    def rng_state():
+        return snapshot({
+            'sampler': agent.sampler.state_dict(),
+            'np_rng': np.random.get_state(),
+            'torch_rng': torch.get_rng_state(),
+        })
+
+    checkpointer = Checkpointer(
+        checkpoint_dir,
+        '{}_curio'.format(env_id),
+        keep_checkpoint,
+        model_path)
+    # rank 0 reads the checkpoint and hands it to the other ranks, which
+    # need not see its filesystem
+    state = checkpointer.load() if resume and rank == 0 else None
+    if use_distributed and resume:
+        state = broadcast_object(state)
+    if state is not None:
+        agent.model.load_state_dict(state['model'])
+        agent.icm.load_state_dict(state['icm'])
+        # checkpoints written before reward_norm.py have no normaliser
+        if state.get('reward_norm') is not None:
+            reward_norm.load_state_dict(state['reward_norm'])
+        agent.optimizer.load_state_dict(state['optimizer'])
+        if state['scaler'] is not None:
+            agent.amp.scaler.load_state_dict(state['scaler'])
+        global_step = state['global_step']
+        sample_episode = state['sample_episode']
+        # older checkpoints hold rank 0's RNG state only; other ranks (and
+        # ranks added since) keep their fresh seed=rank streams
+        rngs = state.get('rng') or [state]
+        if rank < len(rngs):
+            agent.sampler.load_state_dict(rngs[rank]['sampler'])
+            np.random.set_state(rngs[rank]['np_rng'])
+            torch.set_rng_state(rngs[rank]['torch_rng'])
+        print('resumed from {} at step {}'.format(
+            checkpointer.latest() if rank == 0 else 'rank 0', global_step))
+
+    if use_distributed:
+        # same starting weights everywhere, resumed or not
+        broadcast_parameters(agent.model)
+        broadcast_parameters(agent.icm)
 
     while True:
         total_state, total_reward, total_done, total_next_state, total_action = [], [], [], [], []
-        global_step += (num_worker * num_step)
+        total_truncated = []
+        global_step += (num_worker * num_step * world_size)
+        resample_noise(agent.model, 'rollout')
 
         for _ in range(num_step):
             if not is_training:
@@ -460,104 +466,146 @@ if __name__ == '__main__':
             agent.model.eval()
             agent.icm.eval()
 
-            actions = agent.get_action(states)
-
-            for parent_conn, action in zip(parent_conns, actions):
-                parent_conn.send(action)
-
-            next_states, rewards, dones, real_dones, log_rewards = [], [], [], [], []
-            for parent_conn in parent_conns:
-                s, r, d, rd, lr = parent_conn.recv()
-                next_states.append(s)
-                rewards.append(r)
-                dones.append(d)
-                real_dones.append(rd)
-                log_rewards.append(lr)
-
-            next_states = np.stack(next_states)
-            rewards = np.hstack(rewards) * reward_scale
-            dones = np.hstack(dones)
-            real_dones = np.hstack(real_dones)
+            with timer.phase('get_action'):
+                actions = agent.get_action(states)
+
+            with timer.phase('env_send'):
+                for parent_conn, action in zip(parent_conns, actions):
+                    parent_conn.send(action)
+
+            with timer.phase('env_recv'):
+                next_states, rewards, dones, real_dones, log_rewards = [], [], [], [], []
+                last_states = []
+                for parent_conn in parent_conns:
+                    message = parent_conn.recv()
+                    s, r, d, rd, lr = message[:5]
+                    next_states.append(s)
+                    rewards.append(r)
+                    dones.append(d)
+                    real_dones.append(rd)
+                    log_rewards.append(lr)
+                    # the last state of a truncated episode (report_truncated)
+                    last_states.append(message[5] if len(message) > 5 else None)
+
+            with timer.phase('stack'):
+                next_states = np.stack(next_states)
+                rewards = np.hstack(rewards) * reward_scale
+                dones = np.hstack(dones)
+                real_dones = np.hstack(real_dones)
+                # truncated episodes bootstrap from their last state, not from
+                # the first state of the next episode sent in their place
+                truncated = np.array([last is not None for last in last_states])
+                bootstrap_states = next_states
+                if truncated.any():
+                    bootstrap_states = next_states.copy()
+                    bootstrap_states[truncated] = np.stack(
+                        [last for last in last_states if last is not None])
 
             # total reward = int reward + ext Resard
-            intrinsic_reward = agent.compute_intrinsic_reward(
-                states, next_states, actions)
+            with timer.phase('intrinsic_reward'):
+                intrinsic_reward = agent.compute_intrinsic_reward(
+                    states, bootstrap_states, actions)
             rewards += intrinsic_reward
 
             total_state.append(states)
-            total_next_state.append(next_states)
+            total_next_state.append(bootstrap_states)
+            total_truncated.append(truncated)
             total_reward.append(rewards)
             total_done.append(dones)
             total_action.append(actions)
 
             states = next_states[:, :, :, :]
 
+            # episode stats of all envs, aggregated by the metrics writer
+            episode_rall += log_rewards
+            episode_i_rall += intrinsic_reward
+            episode_step += 1
+            if real_dones.any():
+                metrics.add_values('episode/reward', episode_rall[real_dones])
+                metrics.add_values(
+                    'episode/i-reward', episode_i_rall[real_dones])
+                metrics.add_values('episode/step', episode_step[real_dones])
+                episode_rall[real_dones] = 0
+                episode_i_rall[real_dones] = 0
+                episode_step[real_dones] = 0
+
             sample_rall += log_rewards[sample_env_idx]
             sample_i_rall += intrinsic_reward[sample_env_idx]
             sample_step += 1
             if real_dones[sample_env_idx]:
                 sample_episode += 1
-                writer.add_scalar('data/reward', sample_rall, sample_episode)
-                writer.add_scalar(
+                metrics.add_scalar('data/reward', sample_rall, sample_episode)
+                metrics.add_scalar(
                     'data/i-reward', sample_i_rall, sample_episode)
-                writer.add_scalar('data/step', sample_step, sample_episode)
+                metrics.add_scalar('data/step', sample_step, sample_episode)
                 sample_rall = 0
                 sample_i_rall = 0
                 sample_step = 0
 
         if is_training:
-            total_state = np.stack(total_state).transpose(
-                [1, 0, 2, 3, 4]).reshape([-1, 4, 84, 84])
-            total_next_state = np.stack(total_next_state).transpose(
-                [1, 0, 2, 3, 4]).reshape([-1, 4, 84, 84])
-            total_reward = np.stack(total_reward).transpose().reshape([-1])
-            total_action = np.stack(total_action).transpose().reshape([-1])
-            total_done = np.stack(total_done).transpose().reshape([-1])
-
-            value, next_value, policy = agent.forward_transition(
-                total_state, total_next_state)
-
-            # running mean int reward
-            total_reward_per_env = np.array([discounted_reward.update(
-                reward_per_step) for reward_per_step in total_reward.reshape([num_worker, -1]).T])
-            total_reawrd_per_env = total_reward_per_env.reshape([-1])
-            mean, std, count = np.mean(total_reward), np.std(
-                total_reward), len(total_reward)
-            reward_rms.update_from_moments(mean, std ** 2, count)
-
-            # devided reward by running std
-            total_reward /= np.sqrt(reward_rms.var)
+            with timer.phase('transpose'):
+                total_state = np.stack(total_state).transpose(
+                    [1, 0, 2, 3, 4]).reshape([-1, 4, 84, 84])
+                total_next_state = np.stack(total_next_state).transpose(
+                    [1, 0, 2, 3, 4]).reshape([-1, 4, 84, 84])
+                total_reward = np.stack(total_reward).transpose().reshape([-1])
+                total_action = np.stack(total_action).transpose().reshape([-1])
+                total_done = np.stack(total_done).transpose().reshape([-1])
+                total_truncated = np.stack(
+                    total_truncated).transpose().reshape([-1])
+
+            with timer.phase('forward_transition'):
+                value, next_value, policy = agent.forward_transition(
+                    total_state, total_next_state)
+
+            # devide int reward by the running std of its discounted sum
+            with timer.phase('reward_norm'):
+                total_reward = reward_norm(
+                    total_reward.reshape([num_worker, num_step]),
+                    all_reduce_moments if use_distributed else None).reshape([-1])
 
             # logging utput to see how convergent it is.
             policy = policy.detach()
             m = F.softmax(policy, dim=-1)
-            recent_prob.append(m.max(1)[0].mean().cpu().numpy())
-            writer.add_scalar(
+            # kept on the device, read by the metrics writer thread
+            recent_prob.append(m.max(1)[0].mean())
+            metrics.add_scalar(
                 'data/max_prob',
-                np.mean(recent_prob),
+                torch.stack(list(recent_prob)).mean(),
                 sample_episode)
 
-            total_target = []
-            total_adv = []
-            for idx in range(num_worker):
-                target, adv = make_train_data(total_reward[idx * num_step:(idx + 1) * num_step],
-                                              total_done[idx *
-                                                         num_step:(idx + 1) * num_step],
-                                              value[idx *
-                                                    num_step:(idx + 1) * num_step],
-                                              next_value[idx * num_step:(idx + 1) * num_step])
-                total_target.append(target)
-                total_adv.append(adv)
+            with timer.phase('make_train_data'):
+                total_target = []
+                total_adv = []
+                for idx in range(num_worker):
+                    target, adv = make_train_data(total_reward[idx * num_step:(idx + 1) * num_step],
+                                                  total_done[idx *
+                                                             num_step:(idx + 1) * num_step],
+                                                  value[idx *
+                                                        num_step:(idx + 1) * num_step],
+                                                  next_value[idx * num_step:(idx + 1) * num_step],
+                                                  total_truncated[idx * num_step:(idx + 1) * num_step])
+                    total_target.append(target)
+                    total_adv.append(adv)
 
             if use_standardization:
                 adv = (adv - adv.mean()) / (adv.std() + stable_eps)
 
-            agent.train_model(
-                total_state,
-                total_next_state,
-                np.hstack(total_target),
-                total_action,
-                np.hstack(total_adv))
+            with timer.phase('train_model'):
+                agent.train_model(
+                    total_state,
+                    total_next_state,
+                    np.hstack(total_target),
+                    total_action,
+                    np.hstack(total_adv))
+
+            if use_memory_report:
+                log_account(metrics, account(
+                    [total_state, total_next_state],
+                    [agent.model, agent.icm],
+                    agent.optimizer,
+                    works,
+                    agent.device), global_step)
 
             # adjust learning rate
             if lr_schedule:
@@ -565,8 +613,26 @@ if __name__ == '__main__':
                     (global_step / max_step) * learning_rate
                 for param_group in agent.optimizer.param_groups:
                     param_group['lr'] = new_learing_rate
-                    writer.add_scalar(
+                    metrics.add_scalar(
                         'data/lr', new_learing_rate, sample_episode)
 
-            if global_step % (num_worker * num_step * 100) == 0:
-                torch.save(agent.model.state_dict(), model_path)
+            if global_step % (num_worker * num_step * world_size * 100) == 0:
+                rngs = gather_object(rng_state())
+                if rank == 0:
+                    checkpointer.save(training_state(rngs), global_step)
+
+        timer.report(global_step, env_steps=num_worker * num_step,
+                     samples=num_worker * num_step * epoch if is_training else 0)
+        if archive_path is not None:
+            archive = np.sum([work.archive_stats[:] for work in works], axis=0)
+            metrics.add_scalar('env/archive_starts', archive[0], global_step)
+            metrics.add_scalar('env/archive_replay_steps', archive[1],
+                               global_step)
+            metrics.add_scalar('env/archive_failed_replays', archive[2],
+                               global_step)
+        if stuck_steps:
+            stuck = np.sum([work.watchdog_stats[:] for work in works], axis=0)
+            metrics.add_scalar('env/stuck_episodes', stuck[0], global_step)
+            metrics.add_scalar('env/stuck_steps_saved', stuck[1], global_step)
+        metrics.flush(global_step)
+        profiler.step(global_step)
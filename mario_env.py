@@ -0,0 +1,372 @@
+"""Mario env worker process
+
+Only needs NumPy, OpenCV and the NES stack: this module must not import
+torch (directly or through model / the training scripts), so workers
+started from it with forkserver or spawn stay small.
+"""
+import multiprocessing
+import multiprocessing.process
+import multiprocessing.sharedctypes
+import os
+import sys
+import time
+import types
+from collections import deque
+
+import cv2
+import numpy as np
+
+from gym_super_mario_bros.actions import COMPLEX_MOVEMENT
+
+from env_startup import _make_mario_env
+from resources import pin_process
+from snapshot_archive import SnapshotArchive
+
+# the fork server imports this module once and forks every worker from it
+multiprocessing.get_context('forkserver').set_forkserver_preload(
+    ['mario_env'])
+
+# Pipe() for the parent / worker connections
+Pipe = multiprocessing.Pipe
+
+
+def pre_proc(X, h=84, w=84):
+    # grayscaling
+    x = cv2.cvtColor(X, cv2.COLOR_RGB2GRAY)
+    # resize
+    x = cv2.resize(x, (h, w))
+    x = np.float32(x) * (1.0 / 255.0)
+
+    return x
+
+
+class MarioEnvironment(multiprocessing.process.BaseProcess):
+    """
+    reward_type:
+        'log'   - game reward / 15 (mario_ppo)
+        'none'  - no extrinsic reward (mario_curio)
+        'stage' - +10 on stage clear, -10 on a (life) terminal (mario_a2c)
+    report_done: send the (life) terminal flag with each transition instead
+        of False, for non-episodic training.
+    env_kwargs: passed to the env; env ids starting with 'Synthetic' build
+        a SyntheticMarioEnv (see synthetic_env.py) instead of the emulator.
+    stuck_steps: no-progress watchdog, ends the episode after this many
+        steps without a new furthest x_pos in the current life and stage
+        (0: off). stuck_mode 'done' makes that a (life) terminal, 'truncate'
+        a time-limit cut: not a terminal, and with report_truncated the
+        learner gets the state before the reset to bootstrap from (the
+        state sent with the transition is already the next episode's
+        first). `watchdog_stats` (shared with the
+        parent) counts the stuck episodes and the env steps they saved,
+        estimated from the in-game timer left (`steps_per_tick` env steps
+        per timer tick).
+    archive_path: start episodes, with probability archive_prob, from a
+        point sampled from the SnapshotArchive of the env id in this
+        directory (<archive_path>/<env_id>.json), and add every
+        new x_pos bucket reached without losing a life to it (see
+        snapshot_archive.py). `archive_stats` (shared with the parent)
+        counts the archive starts, the replayed env steps and the traces
+        that did not replay to the same point (those are dropped).
+
+    report_info: append a summary of the episode (steps, reward, stage,
+        x_pos, max_pos, flag_get, stuck) to the transition that ends it,
+        None to the others.
+    report_truncated: append the last state of a truncated episode to the
+        transition that ends it, None to the others (after the episode
+        summary, if any).
+
+    Besides actions, the worker accepts control messages (tuples):
+        ('set_env', env_id) - switch to another env (e.g. another stage);
+                              replies with the new initial state
+    `step_stats` (shared with the parent) counts the env steps and the
+    seconds spent in env.step.
+    """
+
+    def __init__(
+            self,
+            env_id,
+            is_render,
+            env_idx,
+            child_conn,
+            history_size=4,
+            h=84,
+            w=84,
+            cpu_set=None,
+            movement=COMPLEX_MOVEMENT,
+            life_done=True,
+            reward_type='log',
+            report_done=False,
+            start_method='forkserver',
+            env_kwargs=None,
+            stuck_steps=0,
+            stuck_mode='truncate',
+            steps_per_tick=24,
+            archive_path=None,
+            archive_prob=0.5,
+            archive_bucket=256,
+            archive_capacity=256,
+            report_info=False,
+            report_truncated=False):
+        super(MarioEnvironment, self).__init__()
+        self.daemon = True
+        # the emulator is built in run(), inside the worker process
+        self.env_id = env_id
+        self.env = None
+        self.env_kwargs = env_kwargs or {}
+        self.movement = movement
+        self.life_done = life_done
+        self.reward_type = reward_type
+        self.report_done = report_done
+        self.start_method = start_method
+        if stuck_mode not in ('done', 'truncate'):
+            raise ValueError('unknown stuck_mode: {}'.format(stuck_mode))
+        self.stuck_steps = stuck_steps
+        self.stuck_mode = stuck_mode
+        self.steps_per_tick = steps_per_tick
+        # [stuck episodes, env steps saved], read by the parent
+        self.watchdog_stats = multiprocessing.sharedctypes.RawArray('d', 2)
+        self.archive_path = archive_path
+        self.archive_prob = archive_prob
+        self.archive_bucket = archive_bucket
+        self.archive_capacity = archive_capacity
+        self.archive = None
+        # [archive starts, replayed env steps, failed replays]
+        self.archive_stats = multiprocessing.sharedctypes.RawArray('d', 3)
+        # [env steps, seconds in env.step]
+        self.step_stats = multiprocessing.sharedctypes.RawArray('d', 2)
+        self.report_info = report_info
+        self.report_truncated = report_truncated
+
+        self.is_render = is_render
+        self.env_idx = env_idx
+        self.steps = 0
+        self.episode = 0
+        self.rall = 0
+        self.recent_rlist = deque(maxlen=100)
+        self.child_conn = child_conn
+
+        self.history_size = history_size
+        self.history = np.zeros([history_size, h, w])
+        self.h = h
+        self.w = w
+        self.cpu_set = cpu_set
+
+    def _Popen(self, process_obj):
+        return multiprocessing.get_context(
+            self.start_method).Process._Popen(process_obj)
+
+    def start(self):
+        if self.start_method == 'fork':
+            return super(MarioEnvironment, self).start()
+        # spawn / forkserver children re-import the parent's __main__, which
+        # would pull torch into every worker; hide it while starting
+        main = sys.modules['__main__']
+        sys.modules['__main__'] = types.ModuleType('__main__')
+        try:
+            super(MarioEnvironment, self).start()
+        finally:
+            sys.modules['__main__'] = main
+
+    def run(self):
+        if self.cpu_set is not None:
+            pin_process(self.cpu_set, 'worker {}'.format(self.env_idx))
+        self.env = _make_mario_env(
+            self.env_id, self.movement, **self.env_kwargs)
+        if self.archive_path is not None:
+            self.rng = np.random.RandomState(self.env_idx)
+        self.open_archive()
+        # readiness handshake, see env_startup.wait_ready
+        self.child_conn.send(self.reset())
+
+        while True:
+            action = self.child_conn.recv()
+            if isinstance(action, tuple):
+                self.control(*action)
+                continue
+            if self.is_render:
+                self.env.render()
+            start = time.perf_counter()
+            obs, reward, done, info = self.env.step(action)
+            self.step_stats[0] += 1
+            self.step_stats[1] += time.perf_counter() - start
+            if self.archive is not None:
+                # the trace from reset, stored with archived points
+                self.actions.append(action)
+
+            if self.life_done:
+                # when Mario loses life, changes the state to the terminal
+                # state.
+                if self.lives > info['life'] and info['life'] > 0:
+                    force_done = True
+                    self.lives = info['life']
+                else:
+                    force_done = done
+                    self.lives = info['life']
+            else:
+                # normal terminal state
+                force_done = done
+
+            self.max_pos = max(self.max_pos, info['x_pos'])
+            self.flag_get = self.flag_get or info['flag_get']
+            if self.archive is not None and not done:
+                self.archive_progress(info)
+            stuck = self.watchdog(info) and not done
+            if stuck:
+                self.watchdog_stats[0] += 1
+                self.watchdog_stats[1] += info.get('time', 0) * \
+                    self.steps_per_tick
+                done = True
+                force_done = self.stuck_mode == 'done'
+
+            # reward range -15 ~ 15
+            log_reward = reward / 15
+            self.rall += log_reward
+
+            if self.reward_type == 'log':
+                r = log_reward
+            elif self.reward_type == 'stage':
+                if info['flag_get'] or self.stage < info['stage']:
+                    r = 10.
+                    self.stage = info['stage']
+                elif force_done:
+                    r = -10.
+                else:
+                    r = 0.
+            else:
+                r = 0.
+
+            self.history[:3, :, :] = self.history[1:, :, :]
+            self.history[3, :, :] = self.pre_proc(obs)
+
+            self.steps += 1
+
+            episode_info = None
+            last_state = None
+            if stuck and self.stuck_mode == 'truncate':
+                last_state = self.history.copy()
+            if done:
+                self.recent_rlist.append(self.rall)
+                episode_info = {
+                    'steps': self.steps,
+                    'reward': self.rall,
+                    'stage': info['stage'],
+                    'x_pos': info['x_pos'],
+                    'max_pos': self.max_pos,
+                    'flag_get': self.flag_get,
+                    'stuck': stuck,
+                }
+                print(
+                    "[Episode {}({})] Step: {}  Reward: {}  Recent Reward: {}  Stage: {} current x:{}   max x:{}{}".format(
+                        self.episode,
+                        self.env_idx,
+                        self.steps,
+                        self.rall,
+                        np.mean(
+                            self.recent_rlist),
+                        info['stage'],
+                        info['x_pos'],
+                        self.max_pos,
+                        '  (stuck)' if stuck else ''))
+
+                self.history = self.reset()
+
+            sent_done = force_done if self.report_done else False
+            message = [self.history[:, :, :], r, sent_done, done, log_reward]
+            if self.report_info:
+                message.append(episode_info)
+            if self.report_truncated:
+                message.append(last_state)
+            self.child_conn.send(message)
+
+    def control(self, command, *args):
+        if command == 'set_env':
+            self.env.close()
+            self.env_id = args[0]
+            self.env = _make_mario_env(
+                self.env_id, self.movement, **self.env_kwargs)
+            self.open_archive()
+            self.child_conn.send(self.reset())
+        else:
+            raise ValueError('unknown control message: {}'.format(command))
+
+    def open_archive(self):
+        # traces only replay in the env they were recorded in
+        if self.archive_path is not None:
+            self.archive = SnapshotArchive(
+                os.path.join(self.archive_path, self.env_id + '.json'),
+                self.archive_capacity, self.archive_bucket)
+
+    def reset(self):
+        self.steps = 0
+        self.episode += 1
+        self.rall = 0
+        self.lives = 3
+        self.stage = 1
+        self.max_pos = 0
+        self.flag_get = False
+        self.progress = None
+        self.actions = []
+        self.start_life = None
+        self.archived = None
+        obs = self.env.reset()
+        if self.archive is not None and self.rng.rand() < self.archive_prob:
+            entry = self.archive.sample(self.rng)
+            if entry is not None:
+                obs = self.replay(obs, *entry)
+        self.get_init_state(obs)
+        return self.history[:, :, :]
+
+    def replay(self, obs, world, stage, x_pos, actions):
+        """Step through an archived trace, or reset again if it diverges"""
+        done, info = False, None
+        for action in actions:
+            obs, _, done, info = self.env.step(action)
+            if done:
+                break
+        self.archive_stats[1] += len(actions)
+        # the real env reports NumPy integers read from the NES RAM
+        if done or info is None or int(info['world']) != world or \
+                int(info['stage']) != stage or int(info['x_pos']) != x_pos:
+            self.archive_stats[2] += 1
+            self.archive.remove(world, stage, x_pos)
+            return self.env.reset()
+        self.archive_stats[0] += 1
+        self.actions = list(actions)
+        self.start_life = info['life']
+        self.stage = info['stage']
+        self.max_pos = info['x_pos']
+        self.archived = (world, stage, x_pos // self.archive_bucket)
+        return obs
+
+    def archive_progress(self, info):
+        if self.start_life is None:
+            self.start_life = info['life']
+        if info['life'] != self.start_life:
+            return
+        # NumPy integers from the NES RAM, which json cannot write
+        world, stage, x_pos = \
+            int(info['world']), int(info['stage']), int(info['x_pos'])
+        point = (world, stage, x_pos // self.archive_bucket)
+        if self.archived is None or point > self.archived:
+            self.archived = point
+            self.archive.add(world, stage, x_pos, self.actions)
+
+    def watchdog(self, info):
+        """True once stuck_steps steps passed without new progress"""
+        if not self.stuck_steps:
+            return False
+        key = (info['life'], info['stage'])
+        # x_pos restarts after a lost life or a cleared stage
+        if self.progress is None or self.progress[0] != key or \
+                info['x_pos'] > self.progress[1]:
+            self.progress = [key, info['x_pos'], 0]
+            return False
+        self.progress[2] += 1
+        return self.progress[2] >= self.stuck_steps
+
+    def pre_proc(self, X):
+        return pre_proc(X, self.h, self.w)
+
+    def get_init_state(self, s):
+        for i in range(self.history_size):
+            self.history[i, :, :] = self.pre_proc(s)
@@ -13,9 +13,22 @@ import time
 import datetime
 
 from model import *
+from mario_env import MarioEnvironment
+from env_startup import load_env_spec, wait_ready
+from resources import ResourceManager
+from sampler import ActionSampler
+from amp import MixedPrecision
+from distributed import *
+from checkpoint import Checkpointer, snapshot
+from timer import PhaseTimer
+from metrics import MetricsWriter
+from memory import account, log_account
+from profile_capture import ProfilerTrigger
+from stage_scheduler import StageScheduler
+from pipeline import RolloutPipeline
 
 import torch.optim as optim
-from torch.multiprocessing import Pipe, Process
+from torch.multiprocessing import Pipe
 
 from collections import deque
 
@@ -25,111 +38,6 @@ from nes_py.wrappers import BinarySpaceToDiscreteSpaceEnv
 from gym_super_mario_bros.actions import SIMPLE_MOVEMENT, COMPLEX_MOVEMENT
 
 
-class MarioEnvironment(Process):
-    def __init__(
-            self,
-            env_id,
-            is_render,
-            env_idx,
-            child_conn,
-            history_size=4,
-            h=84,
-            w=84):
-        super(MarioEnvironment, self).__init__()
-        self.daemon = True
-        self.env = BinarySpaceToDiscreteSpaceEnv(
-            gym_super_mario_bros.make(env_id), movement)
-
-        self.is_render = is_render
-        self.env_idx = env_idx
-        self.steps = 0
-        self.episode = 0
-        self.rall = 0
-        self.recent_rlist = deque(maxlen=100)
-        self.child_conn = child_conn
-
-        self.history_size = history_size
-        self.history = np.zeros([history_size, h, w])
-        self.h = h
-        self.w = w
-
-        self.reset()
-
-    def run(self):
-        super(MarioEnvironment, self).run()
-        while True:
-            action = self.child_conn.recv()
-            if self.is_render:
-                self.env.render()
-            obs, reward, done, info = self.env.step(action)
-
-            if life_done:
-                # when Mario loses life, changes the state to the terminal
-                # state.
-                if self.lives > info['life'] and info['life'] > 0:
-                    force_done = True
-                    self.lives = info['life']
-                else:
-                    force_done = done
-                    self.lives = info['life']
-            else:
-                # normal terminal state
-                force_done = done
-
-            # reward range -15 ~ 15
-            log_reward = reward / 15
-            self.rall += log_reward
-
-            r = log_reward
-
-            self.history[:3, :, :] = self.history[1:, :, :]
-            self.history[3, :, :] = self.pre_proc(obs)
-
-            self.steps += 1
-
-            if done:
-                self.recent_rlist.append(self.rall)
-                print(
-                    "[Episode {}({})] Step: {}  Reward: {}  Recent Reward: {}  Stage: {} current x:{}   max x:{}".format(
-                        self.episode,
-                        self.env_idx,
-                        self.steps,
-                        self.rall,
-                        np.mean(
-                            self.recent_rlist),
-                        info['stage'],
-                        info['x_pos'],
-                        self.max_pos))
-
-                self.history = self.reset()
-            else:
-                self.child_conn.send(
-                    [self.history[:, :, :], r, False, done, log_reward])
-
-    def reset(self):
-        self.steps = 0
-        self.episode += 1
-        self.rall = 0
-        self.lives = 3
-        self.stage = 1
-        self.max_pos = 0
-        self.get_init_state(self.env.reset())
-        return self.history[:, :, :]
-
-    def pre_proc(self, X):
-        # grayscaling
-        x = cv2.cvtColor(X, cv2.COLOR_RGB2GRAY)
-        # resize
-        x = cv2.resize(x, (self.h, self.w))
-        x = np.float32(x) * (1.0 / 255.0)
-
-        return x
-
-    def get_init_state(self, s):
-        for i in range(self.history_size):
-            self.history[i, :, :] = self.pre_proc(s)
-
-
 class ActorAgent(object):
     def __init__(
             self,
@@ -141,9 +49,13 @@ class ActorAgent(object):
             lam=0.95,
             use_gae=True,
             use_cuda=False,
-            use_noisy_net=True):
-        self.model = CnnActorCriticNetwork(
-            input_size, output_size, use_noisy_net)
+            use_noisy_net=True,
+            model_name='cnn',
+            use_amp=False,
+            use_distributed=False,
+            seed=0):
+        self.model = make_model(
+            model_name, input_size, output_size, use_noisy_net)
         self.num_env = num_env
         self.output_size = output_size
         self.input_size = input_size
@@ -151,36 +63,40 @@ class ActorAgent(object):
         self.gamma = gamma
         self.lam = lam
         self.use_gae = use_gae
+        self.use_distributed = use_distributed
         self.optimizer = optim.Adam(
             self.model.parameters(), lr=learning_rate)
 
         self.device = torch.device('cuda' if use_cuda else 'cpu')
 
         self.model = self.model.to(self.device)
+        self.sampler = ActionSampler(
+            num_env, output_size, self.device, seed)
+        self.amp = MixedPrecision(self.device, use_amp)
 
-    def get_action(self, state):
+    def get_action(self, state, model=None, with_value=False):
+        if model is None:
+            model = self.model
         state = torch.Tensor(state).to(self.device)
         state = state.float()
-        policy, value = self.model(state)
-        policy = F.softmax(policy, dim=-1).data.cpu().numpy()
-
-        action = self.random_choice_prob_index(policy)
-
-        return action
+        with torch.no_grad():
+            policy, value = model(state)
+        action = self.sampler.sample(policy)
 
-    @staticmethod
-    def random_choice_prob_index(p, axis=1):
-        r = np.expand_dims(np.random.rand(p.shape[1 - axis]), axis=axis)
-        return (p.cumsum(axis=axis) > r).argmax(axis=axis)
+        if with_value:
+            log_prob = self.sampler.log_prob(policy, action)
+            return action.cpu().numpy(), log_prob.cpu().numpy(), \
+                value.squeeze(1).cpu().numpy()
+        return action.cpu().numpy()
 
     def forward_transition(self, state, next_state):
         state = torch.from_numpy(state).to(self.device)
         state = state.float()
-        policy, value = agent.model(state)
+        policy, value = self.model(state)
 
         next_state = torch.from_numpy(next_state).to(self.device)
         next_state = next_state.float()
-        _, next_value = agent.model(next_state)
+        _, next_value = self.model(next_state)
 
         value = value.data.cpu().numpy().squeeze()
         next_value = next_value.data.cpu().numpy().squeeze()
@@ -193,7 +109,11 @@ class ActorAgent(object):
             next_s_batch,
             target_batch,
             y_batch,
-            adv_batch):
+            adv_batch,
+            log_prob_old=None):
+        """log_prob_old: behaviour log-probs of y_batch, for rollouts
+        sampled with older weights; recomputed with the current ones if None
+        """
         s_batch = torch.FloatTensor(s_batch).to(self.device)
         next_s_batch = torch.FloatTensor(next_s_batch).to(self.device)
         target_batch = torch.FloatTensor(target_batch).to(self.device)
@@ -204,19 +124,26 @@ class ActorAgent(object):
         ce = nn.CrossEntropyLoss()
         forward_mse = nn.MSELoss()
         self.model.train()
+        resample_noise(self.model, 'update')
 
-        with torch.no_grad():
-            # for multiply advantage
-            policy_old, value_old = self.model(s_batch)
-            m_old = Categorical(F.softmax(policy_old, dim=-1))
-            log_prob_old = m_old.log_prob(y_batch)
+        if log_prob_old is not None:
+            log_prob_old = torch.FloatTensor(log_prob_old).to(self.device)
+        else:
+            with torch.no_grad():
+                # for multiply advantage
+                with self.amp.autocast():
+                    policy_old, value_old = self.model(s_batch)
+                m_old = Categorical(F.softmax(policy_old.float(), dim=-1))
+                log_prob_old = m_old.log_prob(y_batch)
 
         for i in range(epoch):
             np.random.shuffle(sample_range)
             for j in range(int(len(s_batch) / batch_size)):
                 sample_idx = sample_range[batch_size * j:batch_size * (j + 1)]
 
-                policy, value = self.model(s_batch[sample_idx])
+                with self.amp.autocast():
+                    policy, value = self.model(s_batch[sample_idx])
+                policy, value = policy.float(), value.float()
                 m = Categorical(F.softmax(policy, dim=-1))
                 log_prob = m.log_prob(y_batch[sample_idx])
 
@@ -236,14 +163,23 @@ class ActorAgent(object):
                 self.optimizer.zero_grad()
                 loss = actor_loss + 0.5 * critic_loss - entropy_coef * entropy
 
-                loss.backward()
-                torch.nn.utils.clip_grad_norm_(
-                    self.model.parameters(), clip_grad_norm)
-                self.optimizer.step()
+                self.amp.backward(loss)
+                if self.use_distributed:
+                    all_reduce_gradients(self.model.parameters())
+                self.amp.step(
+                    self.optimizer,
+                    self.model.parameters(),
+                    clip_grad_norm)
 
 
-def make_train_data(reward, done, value, next_value):
+def make_train_data(reward, done, value, next_value, truncated=None):
+    """truncated: steps that ended an episode by a time limit; next_value
+    is then the value of the episode's last state, and returns do not
+    flow back from the next episode
+    """
     discounted_return = np.empty([num_step])
+    if truncated is None:
+        truncated = np.zeros([num_step])
 
     # Discounted Return
     if use_gae:
@@ -251,7 +187,8 @@ def make_train_data(reward, done, value, next_value):
         for t in range(num_step - 1, -1, -1):
             delta = reward[t] + gamma * \
                 next_value[t] * (1 - done[t]) - value[t]
-            gae = delta + gamma * lam * (1 - done[t]) * gae
+            gae = delta + gamma * lam * \
+                (1 - done[t]) * (1 - truncated[t]) * gae
 
             discounted_return[t] = gae + value[t]
 
@@ -261,6 +198,8 @@ def make_train_data(reward, done, value, next_value):
     else:
         running_add = next_value[-1]
         for t in range(num_step - 1, -1, -1):
+            if truncated[t]:
+                running_add = next_value[t]
             running_add = reward[t] + gamma * running_add * (1 - done[t])
             discounted_return[t] = running_add
 
@@ -301,32 +240,139 @@ class RunningMeanStd(object):
         self.count = new_count
 
 
+def collect_rollout(model):
+    global states, sample_episode, sample_rall, sample_i_rall, sample_step
+    global episode_rall, episode_step
+    total_state, total_reward, total_done, total_next_state, total_action = [], [], [], [], []
+    total_log_prob, total_truncated = [], []
+    resample_noise(model, 'rollout')
+
+    for _ in range(num_step):
+        if not is_training:
+            time.sleep(0.05)
+
+        model.eval()
+        with timer.phase('get_action'):
+            actions, log_probs, _ = agent.get_action(
+                states, model, with_value=True)
+
+        with timer.phase('env_send'):
+            for parent_conn, action in zip(parent_conns, actions):
+                parent_conn.send(action)
+
+        with timer.phase('env_recv'):
+            next_states, rewards, dones, real_dones, log_rewards = [], [], [], [], []
+            last_states = []
+            for parent_conn in parent_conns:
+                message = parent_conn.recv()
+                s, r, d, rd, lr = message[:5]
+                next_states.append(s)
+                rewards.append(r)
+                dones.append(d)
+                real_dones.append(rd)
+                log_rewards.append(lr)
+                # the last state of a truncated episode (report_truncated)
+                last_states.append(message[5] if len(message) > 5 else None)
+
+        with timer.phase('stack'):
+            next_states = np.stack(next_states)
+            rewards = np.hstack(rewards) * reward_scale
+            dones = np.hstack(dones)
+            real_dones = np.hstack(real_dones)
+            # truncated episodes bootstrap from their last state, not from
+            # the first state of the next episode sent in their place
+            truncated = np.array([last is not None for last in last_states])
+            bootstrap_states = next_states
+            if truncated.any():
+                bootstrap_states = next_states.copy()
+                bootstrap_states[truncated] = np.stack(
+                    [last for last in last_states if last is not None])
+
+            total_state.append(states)
+            total_next_state.append(bootstrap_states)
+            total_reward.append(rewards)
+            total_done.append(dones)
+            total_action.append(actions)
+            total_log_prob.append(log_probs)
+            total_truncated.append(truncated)
+
+        states = next_states[:, :, :, :]
+
+        # episode stats of all envs, aggregated by the metrics writer
+        episode_rall += log_rewards
+        episode_step += 1
+        if real_dones.any():
+            metrics.add_values('episode/reward', episode_rall[real_dones])
+            metrics.add_values('episode/step', episode_step[real_dones])
+            if scheduler is not None:
+                scheduler.record(real_dones, episode_rall, episode_step)
+            episode_rall[real_dones] = 0
+            episode_step[real_dones] = 0
+
+        sample_rall += log_rewards[sample_env_idx]
+        sample_step += 1
+        if real_dones[sample_env_idx]:
+            sample_episode += 1
+            metrics.add_scalar('data/reward', sample_rall, sample_episode)
+            metrics.add_scalar('data/step', sample_step, sample_episode)
+            sample_rall = 0
+            sample_i_rall = 0
+            sample_step = 0
+
+    return total_state, total_reward, total_done, total_next_state, \
+        total_action, total_log_prob, total_truncated
+
+
 if __name__ == '__main__':
     env_id = 'SuperMarioBros-v0'
     movement = COMPLEX_MOVEMENT
-    env = BinarySpaceToDiscreteSpaceEnv(
-        gym_super_mario_bros.make(env_id), movement)
-    input_size = env.observation_space.shape  # 4
-    output_size = env.action_space.n  # 2
-
-    env.close()
-
-    writer = SummaryWriter()
+    input_size, output_size = load_env_spec(env_id, movement)
+    # train on several stages at once, e.g. ['SuperMarioBros-1-1-v0',
+    # 'SuperMarioBros-1-2-v0'], rebalancing the workers between them every
+    # rebalance_every updates (None: env_id on every worker)
+    stages = None
+    rebalance_every = 10
+
+    # one learner per rank, see distributed.py
+    use_distributed = False
+    rank, world_size = 0, 1
+    if use_distributed:
+        rank, world_size = init_distributed()
+
+    writer = SummaryWriter(comment='' if rank == 0 else '_rank{}'.format(rank))
     use_cuda = True
     use_gae = True
     life_done = True
+    # end episodes after stuck_steps steps without progress (0: off),
+    # 'done' as a terminal or 'truncate', see mario_env.py
+    stuck_steps = 0
+    stuck_mode = 'truncate'
+    truncate = stuck_steps > 0 and stuck_mode == 'truncate'
+    # directory of archived progress points shared by all workers to start
+    # episodes from (None: off), see snapshot_archive.py
+    archive_path = None
 
     is_load_model = False
     is_training = True
 
     is_render = False
+    use_cpu_affinity = False
     use_standardization = True
     use_noisy_net = True
+    model_name = 'cnn'
+    use_amp = False
+    # 'call', 'update' or 'rollout'
+    noise_resample = 'call'
 
     model_path = 'models/{}_{}.model'.format(env_id,
                                              datetime.date.today().isoformat())
     load_model_path = 'models/SuperMarioBros-v0_2018-09-26.model'
 
+    # full training state, written in the background (see checkpoint.py)
+    checkpoint_dir = 'checkpoints'
+    keep_checkpoint = 3
+    resume = False
+
     lam = 0.95
     num_worker = 16
     num_step = 128
@@ -343,6 +389,22 @@ if __name__ == '__main__':
     alpha = 0.99
     gamma = 0.99
     clip_grad_norm = 0.5
+    reward_scale = 1
+
+    # per-phase wall-clock timing, see timer.py
+    use_timer = True
+    timing_log = 'timing.jsonl'
+    # scalars are also appended here, see metrics.py
+    metrics_csv = 'metrics.csv'
+    # rollout / model / optimizer / worker memory per update, see memory.py
+    use_memory_report = True
+    # kill -USR1 <pid> profiles the next profile_updates updates
+    profile_updates = 3
+    trace_dir = 'traces'
+
+    # collect the next rollout while training on the previous one
+    use_pipeline = False
+    max_policy_lag = 1
 
     agent = ActorAgent(
         input_size,
@@ -351,7 +413,12 @@ if __name__ == '__main__':
         num_step,
         gamma,
         use_cuda=use_cuda,
-        use_noisy_net=use_noisy_net)
+        use_noisy_net=use_noisy_net,
+        model_name=model_name,
+        use_amp=use_amp,
+        use_distributed=use_distributed,
+        seed=rank)
+    set_noise_resample(agent.model, noise_resample)
 
     if is_load_model:
         if use_cuda:
@@ -365,18 +432,32 @@ if __name__ == '__main__':
     if not is_training:
         agent.model.eval()
 
+    resources = ResourceManager(num_worker, enabled=use_cpu_affinity)
+    resources.apply_learner()
+
+    scheduler = StageScheduler(stages, num_worker) if stages else None
+
     works = []
     parent_conns = []
     child_conns = []
     for idx in range(num_worker):
         parent_conn, child_conn = Pipe()
-        work = MarioEnvironment(env_id, is_render, idx, child_conn)
+        work = MarioEnvironment(
+            scheduler.assignment[idx] if scheduler else env_id,
+            is_render, rank * num_worker + idx, child_conn,
+            cpu_set=resources.worker_cores(idx),
+            movement=movement,
+            life_done=life_done,
+            stuck_steps=stuck_steps,
+            stuck_mode=stuck_mode,
+            report_truncated=truncate,
+            archive_path=archive_path)
         work.start()
         works.append(work)
         parent_conns.append(parent_conn)
         child_conns.append(child_conn)
 
-    states = np.zeros([num_worker, 4, 84, 84])
+    states = wait_ready(parent_conns, works)
 
     sample_episode = 0
     sample_rall = 0
@@ -384,96 +465,147 @@ if __name__ == '__main__':
     sample_step = 0
     sample_env_idx = 0
     global_step = 0
+    episode_rall = np.zeros(num_worker)
+    episode_step = np.zeros(num_worker)
     recent_prob = deque(maxlen=10)
+    metrics = MetricsWriter(writer, metrics_csv)
+    timer = PhaseTimer(use_timer, metrics, timing_log)
+    profiler = ProfilerTrigger(
+        profile_updates, trace_dir, '{}_ppo_rank{}'.format(env_id, rank))
+
+    def training_state(rngs):
+        return {
+            'model': agent.model.state_dict(),
+            'optimizer': agent.optimizer.state_dict(),
+            'scaler': agent.amp.scaler.state_dict()
+            if agent.amp.scaler is not None else None,
+            'global_step': global_step,
+            'sample_episode': sample_episode,
+            # per rank, so every rank resumes its own action streams
+            'rng': rngs,
+        }
+
+    def rng_state():
+        return snapshot({
+            'sampler': agent.sampler.state_dict(),
+            'np_rng': np.random.get_state(),
+            'torch_rng': torch.get_rng_state(),
+        })
+
+    checkpointer = Checkpointer(
+        checkpoint_dir,
+        '{}_ppo'.format(env_id),
+        keep_checkpoint,
+        model_path)
+    # rank 0 reads the checkpoint and hands it to the other ranks, which
+    # need not see its filesystem
+    state = checkpointer.load() if resume and rank == 0 else None
+    if use_distributed and resume:
+        state = broadcast_object(state)
+    if state is not None:
+        agent.model.load_state_dict(state['model'])
+        agent.optimizer.load_state_dict(state['optimizer'])
+        if state['scaler'] is not None:
+            agent.amp.scaler.load_state_dict(state['scaler'])
+        global_step = state['global_step']
+        sample_episode = state['sample_episode']
+        # older checkpoints hold rank 0's RNG state only; other ranks (and
+        # ranks added since) keep their fresh seed=rank streams
+        rngs = state.get('rng') or [state]
+        if rank < len(rngs):
+            agent.sampler.load_state_dict(rngs[rank]['sampler'])
+            np.random.set_state(rngs[rank]['np_rng'])
+            torch.set_rng_state(rngs[rank]['torch_rng'])
+        print('resumed from {} at step {}'.format(
+            checkpointer.latest() if rank == 0 else 'rank 0', global_step))
+
+    if use_distributed:
+        # same starting weights everywhere, resumed or not
+        broadcast_parameters(agent.model)
+
+    if use_pipeline:
+        if scheduler is not None:
+            # the collector thread owns the pipes
+            raise ValueError('stages cannot be combined with use_pipeline')
+        pipeline = RolloutPipeline(agent.model, collect_rollout, max_policy_lag)
+        pipeline.start()
 
     while True:
-        total_state, total_reward, total_done, total_next_state, total_action = [], [], [], [], []
-        global_step += (num_worker * num_step)
-
-        for _ in range(num_step):
-            if not is_training:
-                time.sleep(0.05)
-
-            agent.model.eval()
-            actions = agent.get_action(states)
-
-            for parent_conn, action in zip(parent_conns, actions):
-                parent_conn.send(action)
-
-            next_states, rewards, dones, real_dones, log_rewards = [], [], [], [], []
-            for parent_conn in parent_conns:
-                s, r, d, rd, lr = parent_conn.recv()
-                next_states.append(s)
-                rewards.append(r)
-                dones.append(d)
-                real_dones.append(rd)
-                log_rewards.append(lr)
-
-            next_states = np.stack(next_states)
-            rewards = np.hstack(rewards) * reward_scale
-            dones = np.hstack(dones)
-            real_dones = np.hstack(real_dones)
-
-            total_state.append(states)
-            total_next_state.append(next_states)
-            total_reward.append(rewards)
-            total_done.append(dones)
-            total_action.append(actions)
-
-            states = next_states[:, :, :, :]
-
-            sample_rall += log_rewards[sample_env_idx]
-            sample_step += 1
-            if real_dones[sample_env_idx]:
-                sample_episode += 1
-                writer.add_scalar('data/reward', sample_rall, sample_episode)
-                writer.add_scalar('data/step', sample_step, sample_episode)
-                sample_rall = 0
-                sample_i_rall = 0
-                sample_step = 0
+        global_step += (num_worker * num_step * world_size)
+        if use_pipeline:
+            with timer.phase('rollout_wait'):
+                rollout, policy_lag = pipeline.get()
+            metrics.add_scalar('data/policy_lag', policy_lag, global_step)
+            metrics.add_scalar(
+                'data/learner_wait', pipeline.learner_wait, global_step)
+        else:
+            rollout = collect_rollout(agent.model)
+        total_state, total_reward, total_done, total_next_state, total_action, \
+            total_log_prob, total_truncated = rollout
 
         if is_training:
-            total_state = np.stack(total_state).transpose(
-                [1, 0, 2, 3, 4]).reshape([-1, 4, 84, 84])
-            total_next_state = np.stack(total_next_state).transpose(
-                [1, 0, 2, 3, 4]).reshape([-1, 4, 84, 84])
-            total_reward = np.stack(total_reward).transpose().reshape([-1])
-            total_action = np.stack(total_action).transpose().reshape([-1])
-            total_done = np.stack(total_done).transpose().reshape([-1])
-
-            value, next_value, policy = agent.forward_transition(
-                total_state, total_next_state)
+            with timer.phase('transpose'):
+                total_state = np.stack(total_state).transpose(
+                    [1, 0, 2, 3, 4]).reshape([-1, 4, 84, 84])
+                total_next_state = np.stack(total_next_state).transpose(
+                    [1, 0, 2, 3, 4]).reshape([-1, 4, 84, 84])
+                total_reward = np.stack(total_reward).transpose().reshape([-1])
+                total_action = np.stack(total_action).transpose().reshape([-1])
+                total_log_prob = np.stack(
+                    total_log_prob).transpose().reshape([-1])
+                total_done = np.stack(total_done).transpose().reshape([-1])
+                total_truncated = np.stack(
+                    total_truncated).transpose().reshape([-1])
+
+            with timer.phase('forward_transition'):
+                value, next_value, policy = agent.forward_transition(
+                    total_state, total_next_state)
 
             # logging utput to see how convergent it is.
             policy = policy.detach()
             m = F.softmax(policy, dim=-1)
-            recent_prob.append(m.max(1)[0].mean().cpu().numpy())
-            writer.add_scalar(
+            # kept on the device, read by the metrics writer thread
+            recent_prob.append(m.max(1)[0].mean())
+            metrics.add_scalar(
                 'data/max_prob',
-                np.mean(recent_prob),
+                torch.stack(list(recent_prob)).mean(),
                 sample_episode)
 
-            total_target = []
-            total_adv = []
-            for idx in range(num_worker):
-                target, adv = make_train_data(total_reward[idx * num_step:(idx + 1) * num_step],
-                                              total_done[idx *
-                                                         num_step:(idx + 1) * num_step],
-                                              value[idx *
-                                                    num_step:(idx + 1) * num_step],
-                                              next_value[idx * num_step:(idx + 1) * num_step])
-                total_target.append(target)
-                total_adv.append(adv)
+            with timer.phase('make_train_data'):
+                total_target = []
+                total_adv = []
+                for idx in range(num_worker):
+                    target, adv = make_train_data(total_reward[idx * num_step:(idx + 1) * num_step],
+                                                  total_done[idx *
+                                                             num_step:(idx + 1) * num_step],
+                                                  value[idx *
+                                                        num_step:(idx + 1) * num_step],
+                                                  next_value[idx * num_step:(idx + 1) * num_step],
+                                                  total_truncated[idx * num_step:(idx + 1) * num_step])
+                    total_target.append(target)
+                    total_adv.append(adv)
 
             if use_standardization:
                 adv = (adv - adv.mean()) / (adv.std() + stable_eps)
 
-            agent.train_model(
-                total_state,
-                total_next_state,
-                np.hstack(total_target),
-                total_action,
-                np.hstack(total_adv))
+            with timer.phase('train_model'):
+                agent.train_model(
+                    total_state,
+                    total_next_state,
+                    np.hstack(total_target),
+                    total_action,
+                    np.hstack(total_adv),
+                    # the rollout may come from weights up to
+                    # max_policy_lag updates old
+                    total_log_prob if use_pipeline else None)
+
+            if use_memory_report:
+                log_account(metrics, account(
+                    [rollout, total_state, total_next_state],
+                    [agent.model],
+                    agent.optimizer,
+                    works,
+                    agent.device), global_step)
 
             # adjust learning rate
             if lr_schedule:
@@ -481,8 +613,45 @@ if __name__ == '__main__':
                     (global_step / max_step) * learning_rate
                 for param_group in agent.optimizer.param_groups:
                     param_group['lr'] = new_learing_rate
-                    writer.add_scalar(
+                    metrics.add_scalar(
                         'data/lr', new_learing_rate, sample_episode)
 
-            if global_step % (num_worker * num_step * 100) == 0:
-                torch.save(agent.model.state_dict(), model_path)
+            if global_step % (num_worker * num_step * world_size * 100) == 0:
+                rngs = gather_object(rng_state())
+                if rank == 0:
+                    checkpointer.save(training_state(rngs), global_step)
+
+        if use_pipeline:
+            pipeline.update(agent.model)
+
+        timer.report(
+            global_step,
+            env_steps=num_worker * num_step,
+            samples=num_worker * num_step * epoch if is_training else 0)
+        if archive_path is not None:
+            archive = np.sum([work.archive_stats[:] for work in works], axis=0)
+            metrics.add_scalar('env/archive_starts', archive[0], global_step)
+            metrics.add_scalar('env/archive_replay_steps', archive[1],
+                               global_step)
+            metrics.add_scalar('env/archive_failed_replays', archive[2],
+                               global_step)
+        if stuck_steps:
+            stuck = np.sum([work.watchdog_stats[:] for work in works], axis=0)
+            metrics.add_scalar('env/stuck_episodes', stuck[0], global_step)
+            metrics.add_scalar('env/stuck_steps_saved', stuck[1], global_step)
+
+        if scheduler is not None:
+            scheduler.measure(works)
+            if global_step % (num_worker * num_step * world_size *
+                              rebalance_every) == 0:
+                moves = scheduler.rebalance()
+                for idx, stage in moves:
+                    parent_conns[idx].send(('set_env', stage))
+                for idx, stage in moves:
+                    states[idx] = parent_conns[idx].recv()
+                    episode_rall[idx] = 0
+                    episode_step[idx] = 0
+            scheduler.log(metrics, global_step)
+
+        metrics.flush(global_step)
+        profiler.step(global_step)
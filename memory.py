@@ -0,0 +1,157 @@
+"""Memory accounting of the training loop, and a dry-run peak estimate
+
+    python memory.py --num-worker 64 --num-step 256 --model cnn
+
+estimates the peak memory of a mario_ppo configuration before launching
+it. During training, `account` reports per update what the rollout
+storage, the model, its gradients and the optimizer hold, plus the RSS of
+the learner and of every env worker.
+"""
+import argparse
+import resource
+
+import numpy as np
+import torch
+
+MB = 2 ** 20
+
+
+def nbytes(obj):
+    """Bytes of the arrays / tensors in a (nested) container, shared once"""
+    seen = set()
+
+    def visit(o):
+        if isinstance(o, np.ndarray):
+            # views count as their base array
+            base = o.base if isinstance(o.base, np.ndarray) else o
+            if id(base) in seen:
+                return 0
+            seen.add(id(base))
+            return base.nbytes
+        if torch.is_tensor(o):
+            key = o.untyped_storage().data_ptr()
+            if key in seen:
+                return 0
+            seen.add(key)
+            return o.untyped_storage().nbytes()
+        if isinstance(o, dict):
+            return sum(visit(v) for v in o.values())
+        if isinstance(o, (list, tuple)):
+            return sum(visit(v) for v in o)
+        return 0
+
+    return visit(obj)
+
+
+def optimizer_bytes(optimizer):
+    return nbytes([list(state.values())
+                   for state in optimizer.state.values()])
+
+
+def read_status_kb(pid, field):
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return 0
+
+
+def account(storage, modules, optimizer, works=(), device=None):
+    """Bytes held right now, by kind
+
+    storage: the rollout arrays (any nesting), modules: the trained models,
+    works: the env worker processes.
+    """
+    params = [p for m in modules for p in m.parameters()]
+    report = {
+        'rollout': nbytes(storage),
+        'params': nbytes(params),
+        'grads': nbytes([p.grad for p in params if p.grad is not None]),
+        'optimizer': optimizer_bytes(optimizer),
+        'learner_rss': read_status_kb('self', 'VmRSS') * 1024,
+        # ru_maxrss is in kB on Linux
+        'learner_peak_rss':
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+    worker_rss = [read_status_kb(w.pid, 'VmRSS') * 1024 for w in works]
+    if worker_rss:
+        report['worker_rss_mean'] = float(np.mean(worker_rss))
+        report['worker_rss_max'] = max(worker_rss)
+        report['worker_rss_total'] = sum(worker_rss)
+    if device is not None and torch.device(device).type == 'cuda':
+        report['device_allocated'] = torch.cuda.memory_allocated(device)
+        report['device_peak'] = torch.cuda.max_memory_allocated(device)
+    return report
+
+
+def log_account(metrics, report, step):
+    for key, value in report.items():
+        metrics.add_scalar('memory/{}_mb'.format(key), value / MB, step)
+
+
+def estimate(num_worker, num_step, model_name='cnn', use_noisy_net=False,
+             batch_size=256, output_size=12, history_dtype=np.float64,
+             worker_rss_mb=0.):
+    """Predicted peak bytes of a mario_ppo update, by kind
+
+    Follows what the loop does: the rollout lists of states and next
+    states (`history_dtype`, float64 for mario_env) stay alive while their
+    stacked + transposed copies are built, one transient stack at a time;
+    forward_transition keeps the autograd graph of two full-batch forwards
+    and the float32 copies of both batches; train_model holds the float32
+    batches again plus one minibatch graph. Parameters, gradients and the
+    two Adam moments come on top. Worker memory is not modelled; pass the
+    per-worker RSS measured by bench_worker_memory.py.
+    """
+    from model import make_model
+    from profile_models import count_flops, input_size, make_input
+
+    model = make_model(model_name, input_size(model_name), output_size,
+                       use_noisy_net)
+    n = num_worker * num_step
+    state_shape = (4, 84, 84)
+    state_bytes = np.prod(state_shape) * np.dtype(history_dtype).itemsize
+    state_f32 = np.prod(state_shape) * 4
+    activation = count_flops(
+        model, make_input(model_name, 1))['activation_bytes']
+    param_bytes = nbytes(list(model.parameters()))
+
+    report = {
+        # lists + stacked arrays (state and next state) + one transient
+        'rollout': int(n * state_bytes * 5),
+        'forward_transition': int(2 * n * (state_f32 + activation)),
+        'train_batches': int(2 * n * state_f32),
+        'minibatch_graph': int(2 * batch_size * activation),
+        # parameters, gradients, Adam exp_avg and exp_avg_sq
+        'model_state': int(4 * param_bytes),
+        'workers': int(num_worker * worker_rss_mb * MB),
+    }
+    # the forward_transition graph is freed before train_model runs
+    report['peak'] = report['rollout'] + report['model_state'] + \
+        report['workers'] + max(
+            report['forward_transition'],
+            report['train_batches'] + report['minibatch_graph'])
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--num-worker', type=int, default=16)
+    parser.add_argument('--num-step', type=int, default=128)
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--model', default='cnn')
+    parser.add_argument('--noisy', action='store_true')
+    parser.add_argument('--output-size', type=int, default=12)
+    parser.add_argument('--history-dtype', default='float64')
+    parser.add_argument('--worker-rss-mb', type=float, default=0.)
+    args = parser.parse_args()
+
+    report = estimate(args.num_worker, args.num_step, args.model, args.noisy,
+                      args.batch_size, args.output_size,
+                      np.dtype(args.history_dtype), args.worker_rss_mb)
+    for key, value in report.items():
+        print('{:20s} {:10.1f} MB'.format(key, value / MB))
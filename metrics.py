@@ -0,0 +1,122 @@
+import csv
+import queue
+import threading
+import time
+
+import numpy as np
+
+PERCENTILES = [50, 90, 99]
+
+
+class _Values(object):
+    """Preallocated, growable buffer of the values of one tag"""
+    __slots__ = ('data', 'n')
+
+    def __init__(self, capacity):
+        self.data = np.empty(capacity, dtype=np.float64)
+        self.n = 0
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=np.float64).reshape(-1)
+        end = self.n + len(values)
+        if end > len(self.data):
+            data = np.empty(max(end, 2 * len(self.data)), dtype=np.float64)
+            data[:self.n] = self.data[:self.n]
+            self.data = data
+        self.data[self.n:end] = values
+        self.n = end
+
+    def take(self):
+        values = self.data[:self.n].copy()
+        self.n = 0
+        return values
+
+
+class MetricsWriter(object):
+    """Logging that never blocks the training loop
+
+    `add_scalar` has the SummaryWriter signature; the value may be a (CUDA)
+    tensor, which is only read on the writer thread, so logging never
+    forces a device sync in the loop. `add_values` accumulates per-env
+    values (episode rewards, lengths, ...) in a preallocated buffer. On
+    `flush(step)` the buffered values are handed to a background thread,
+    which reduces them to mean / percentiles / max and a histogram and
+    writes everything to TensorBoard and a CSV file (step, tag, value,
+    wall_time). If the thread falls behind, whole flushes are dropped and
+    counted in `dropped` instead of blocking.
+    """
+
+    def __init__(self, writer=None, csv_path=None, capacity=4096,
+                 max_pending=16):
+        self.writer = writer
+        self.capacity = capacity
+        self.csv_file = open(csv_path, 'a', newline='') if csv_path else None
+        self.csv = csv.writer(self.csv_file) if self.csv_file else None
+
+        self.lock = threading.Lock()
+        self.scalars = []
+        self.values = {}
+        self.dropped = 0
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def add_scalar(self, tag, value, step):
+        if hasattr(value, 'detach'):
+            value = value.detach()
+        with self.lock:
+            self.scalars.append((tag, value, step, time.time()))
+
+    def add_values(self, tag, values):
+        with self.lock:
+            buf = self.values.get(tag)
+            if buf is None:
+                buf = self.values[tag] = _Values(self.capacity)
+            buf.extend(values)
+
+    def flush(self, step):
+        with self.lock:
+            scalars, self.scalars = self.scalars, []
+            values = {tag: buf.take() for tag, buf in self.values.items()
+                      if buf.n}
+        try:
+            self.queue.put_nowait((step, time.time(), scalars, values))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.csv_file is not None:
+            self.csv_file.close()
+
+    def _write(self, tag, value, step, wall_time):
+        if self.writer is not None:
+            self.writer.add_scalar(tag, value, step, wall_time)
+        if self.csv is not None:
+            self.csv.writerow([step, tag, value, wall_time])
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            step, wall_time, scalars, values = item
+            for tag, value, scalar_step, scalar_time in scalars:
+                if hasattr(value, 'item'):
+                    value = value.item()
+                self._write(tag, float(value), scalar_step, scalar_time)
+
+            for tag, v in values.items():
+                self._write(tag + '/mean', float(v.mean()), step, wall_time)
+                self._write(tag + '/max', float(v.max()), step, wall_time)
+                for q, p in zip(PERCENTILES, np.percentile(v, PERCENTILES)):
+                    self._write('{}/p{}'.format(tag, q), float(p), step,
+                                wall_time)
+                if self.writer is not None:
+                    self.writer.add_histogram(tag, v, step, walltime=wall_time)
+            if self.dropped and self.writer is not None:
+                self.writer.add_scalar(
+                    'metrics/dropped_flushes', self.dropped, step)
+            if self.csv_file is not None:
+                self.csv_file.flush()
@@ -10,7 +10,88 @@ from torch.distributions.categorical import Categorical
 
 
 class NoisyLinear(nn.Module):
-    """Factorised Gaussian NoisyNet"""
+    """Factorised Gaussian NoisyNet
+
+    The rank-1 noise ``out_noise x in_noise`` is applied by scaling the input
+    and the output of the noisy branch, so the dense
+    ``out_features x in_features`` noise matrix is never built.
+
+    ``resample`` controls when the noise is redrawn:
+        'call'    - on every forward in training mode
+        'update'  - on ``resample_noise(model, 'update')``
+        'rollout' - on ``resample_noise(model, 'rollout')``
+    """
+
+    resample_modes = ('call', 'update', 'rollout')
+
+    def __init__(self, in_features, out_features, sigma0=0.5, resample='call'):
+        super().__init__()
+        assert resample in self.resample_modes
+        self.in_features = in_features
+        self.out_features = out_features
+        self.resample = resample
+        self.weight = nn.Parameter(torch.Tensor(out_features, in_features))
+        self.bias = nn.Parameter(torch.Tensor(out_features))
+        self.noisy_weight = nn.Parameter(
+            torch.Tensor(out_features, in_features))
+        self.noisy_bias = nn.Parameter(torch.Tensor(out_features))
+        self.noise_std = sigma0 / math.sqrt(self.in_features)
+
+        self.reset_parameters()
+        self.register_noise()
+        self.sample_noise()
+
+    def register_noise(self):
+        in_noise = torch.FloatTensor(self.in_features)
+        out_noise = torch.FloatTensor(self.out_features)
+        self.register_buffer('in_noise', in_noise)
+        self.register_buffer('out_noise', out_noise)
+
+    def sample_noise(self):
+        # in-place, so the buffers are reused between samples
+        self.in_noise.normal_(0, self.noise_std)
+        self.out_noise.normal_(0, self.noise_std)
+
+    def reset_parameters(self):
+        stdv = 1. / math.sqrt(self.weight.size(1))
+        self.weight.data.uniform_(-stdv, stdv)
+        self.noisy_weight.data.uniform_(-stdv, stdv)
+        if self.bias is not None:
+            self.bias.data.uniform_(-stdv, stdv)
+            self.noisy_bias.data.uniform_(-stdv, stdv)
+
+    def forward(self, x):
+        """
+        Note: noise will be updated if x is not volatile and resample is 'call'
+        """
+        normal_y = nn.functional.linear(x, self.weight, self.bias)
+        if self.training and self.resample == 'call':
+            self.sample_noise()
+
+        # (noisy_weight * (out_noise x in_noise)) x
+        #     == out_noise * (noisy_weight (in_noise * x))
+        noisy_y = nn.functional.linear(x * self.in_noise, self.noisy_weight)
+        noisy_y = (noisy_y + self.noisy_bias) * self.out_noise
+        return noisy_y + normal_y
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints of DenseNoisyLinear carry the materialised noise matrix
+        state_dict.pop(prefix + 'noise', None)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(' \
+            + 'in_features=' + str(self.in_features) \
+            + ', out_features=' + str(self.out_features) \
+            + ', resample=' + self.resample + ')'
+
+
+class DenseNoisyLinear(nn.Module):
+    """Factorised Gaussian NoisyNet with a materialised noise matrix
+
+    Previous implementation of NoisyLinear, kept as the reference for
+    bench_noisy.py.
+    """
 
     def __init__(self, in_features, out_features, sigma0=0.5):
         super().__init__()
@@ -68,6 +149,19 @@ class NoisyLinear(nn.Module):
             + ', out_features=' + str(self.out_features) + ')'
 
 
+def set_noise_resample(model, resample):
+    for m in model.modules():
+        if isinstance(m, NoisyLinear):
+            m.resample = resample
+
+
+def resample_noise(model, event):
+    """Redraw the noise of every NoisyLinear whose resample mode is `event`"""
+    for m in model.modules():
+        if isinstance(m, NoisyLinear) and m.resample == event:
+            m.sample_noise()
+
+
 class Flatten(nn.Module):
     def forward(self, input):
         return input.view(input.size(0), -1)
@@ -281,3 +375,18 @@ class CuriosityModel(nn.Module):
 
         real_next_state_feature = self.feature(next_state)
         return real_next_state_feature, pred_next_state_feature, pred_action
+
+
+# architectures selectable by name (see profile_models.py for their cost)
+MODELS = {
+    'mlp': BaseActorCriticNetwork,
+    'cnn': CnnActorCriticNetwork,
+    'deep_cnn': DeepCnnActorCriticNetwork,
+}
+
+
+def make_model(name, input_size, output_size, use_noisy_net=False):
+    if name not in MODELS:
+        raise KeyError('unknown model {!r}, choose from {}'.format(
+            name, sorted(MODELS)))
+    return MODELS[name](input_size, output_size, use_noisy_net)
@@ -0,0 +1,74 @@
+import copy
+import queue
+import threading
+import time
+
+
+class RolloutPipeline(object):
+    """Overlap rollout collection with learning
+
+    A background thread runs `collect_fn(policy)` on a snapshot of the
+    learner's model while the learner trains on the previous rollout. The
+    snapshot is refreshed from the latest weights at the start of every
+    rollout, and a new rollout is only started while at most
+    `max_policy_lag` rollouts are waiting for (or in) training, so no batch
+    is trained on with weights more than `max_policy_lag` updates old.
+    max_policy_lag=0 gives the strictly alternating loop.
+    """
+
+    def __init__(self, model, collect_fn, max_policy_lag=1):
+        self.policy = copy.deepcopy(model)
+        self.policy.eval()
+        self.collect_fn = collect_fn
+        self.max_policy_lag = max_policy_lag
+
+        self.version = 0
+        self.pending_state = None
+        self.outstanding = 0
+        self.cond = threading.Condition()
+        self.queue = queue.Queue()
+
+        self.collect_wait = 0.
+        self.learner_wait = 0.
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def _run(self):
+        try:
+            while True:
+                start = time.perf_counter()
+                with self.cond:
+                    while self.outstanding > self.max_policy_lag:
+                        self.cond.wait()
+                    if self.pending_state is not None:
+                        self.policy.load_state_dict(self.pending_state)
+                        self.pending_state = None
+                    version = self.version
+                    self.outstanding += 1
+                self.collect_wait += time.perf_counter() - start
+
+                rollout = self.collect_fn(self.policy)
+                self.queue.put((version, rollout, None))
+        except Exception as e:
+            self.queue.put((None, None, e))
+
+    def get(self):
+        """Next rollout and its policy lag in updates"""
+        start = time.perf_counter()
+        version, rollout, error = self.queue.get()
+        self.learner_wait += time.perf_counter() - start
+        if error is not None:
+            raise error
+        return rollout, self.version - version
+
+    def update(self, model):
+        """Publish the learner's weights after training on a rollout"""
+        state = {k: v.detach().clone() for k, v in model.state_dict().items()}
+        with self.cond:
+            self.pending_state = state
+            self.version += 1
+            self.outstanding -= 1
+            self.cond.notify()
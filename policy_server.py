@@ -0,0 +1,391 @@
+"""Serve a policy to many game sessions with dynamic batching
+
+    python policy_server.py --model exported/mario.pt \\
+        --socket /tmp/mario_policy.sock --max-batch 64 --max-latency-ms 5
+    python policy_server.py --bench-clients 32 --steps 500
+
+Clients connect over a Unix socket, one game session per connection, and
+send raw 240x256x3 RGB frames; the server keeps each session's frame stack
+(see export_policy.py) and replies with (action, value). Requests are
+queued and batched: a batch is run as soon as it has --max-batch requests
+or its oldest request has waited --max-latency-ms, plus whatever else is
+already queued at that point.
+
+--model takes an export_policy.py TorchScript file (.pt) or a state dict /
+checkpoint; without it a randomly initialised model is served. Queue
+depth, batch size and latency (arrival to reply) go to the MetricsWriter
+(mean/p50/p90/p99/max per --log-every seconds) and the 'stats' request.
+
+--bench-clients N runs the server in-process against N client processes
+playing the synthetic env and prints throughput and latencies; compare
+with --max-batch 1 for the unbatched baseline.
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+import queue
+import socket
+import struct
+import threading
+import time
+from collections import deque
+
+import numpy as np
+import torch
+from tensorboardX import SummaryWriter
+
+from export_policy import ExportedPolicy, build
+from metrics import MetricsWriter
+from model import make_model
+from profile_models import input_size
+from synthetic_env import SyntheticMarioEnv, H, W
+
+FRAME_SHAPE = (H, W, 3)
+FRAME_BYTES = H * W * 3
+
+# request: op, reset flag (+ frame for OP_ACT)
+REQUEST = struct.Struct('<cB')
+OP_ACT = b'A'
+OP_STATS = b'S'
+# reply to OP_ACT: action, value
+REPLY = struct.Struct('<if')
+LENGTH = struct.Struct('<I')
+
+
+def recv_exact(sock, buf):
+    view = memoryview(buf)
+    while len(view):
+        n = sock.recv_into(view)
+        if not n:
+            raise ConnectionError('connection closed')
+        view = view[n:]
+    return buf
+
+
+def load_policy(path, model_name, use_noisy_net, output_size):
+    if path is None:
+        model = make_model(model_name, input_size(model_name), output_size,
+                           use_noisy_net)
+        return ExportedPolicy(model).eval()
+    if path.endswith('.pt'):
+        return torch.jit.load(path)
+    return build(path, model_name, use_noisy_net, output_size)
+
+
+class Request(object):
+    __slots__ = ('session', 'frame', 'reset', 'arrival')
+
+    def __init__(self, session, frame, reset):
+        self.session = session
+        self.frame = frame
+        self.reset = reset
+        self.arrival = time.perf_counter()
+
+
+class PolicyServer(object):
+    def __init__(self, policy, path, max_batch=64, max_latency=0.005,
+                 metrics=None, log_every=10., sample=False, seed=0,
+                 window=10000):
+        self.policy = policy
+        self.path = path
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.metrics = metrics
+        self.log_every = log_every
+        self.sample = sample
+        self.generator = torch.Generator().manual_seed(seed)
+
+        self.queue = queue.Queue()
+        # session -> (connection, frame stack)
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.running = False
+
+        self.requests = 0
+        self.batches = 0
+        self.latency = deque(maxlen=window)
+        self.batch_size = deque(maxlen=window)
+        self.queue_depth = deque(maxlen=window)
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path)
+        self.listener.listen(256)
+        self.running = True
+        self.threads = [threading.Thread(target=self._accept, daemon=True),
+                        threading.Thread(target=self._batch, daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+    def close(self):
+        self.running = False
+        self.listener.close()
+        self.queue.put(None)
+        self.threads[1].join()
+        with self.lock:
+            for conn, _ in self.sessions.values():
+                conn.close()
+            self.sessions.clear()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _accept(self):
+        session = 0
+        while self.running:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                return
+            with self.lock:
+                self.sessions[session] = (conn, None)
+            threading.Thread(target=self._read, args=(session, conn),
+                             daemon=True).start()
+            session += 1
+
+    def _read(self, session, conn):
+        """Queue the session's requests; it waits for each reply"""
+        header = bytearray(REQUEST.size)
+        try:
+            while True:
+                op, reset = REQUEST.unpack(recv_exact(conn, header))
+                if op == OP_STATS:
+                    data = json.dumps(self.stats()).encode()
+                    conn.sendall(LENGTH.pack(len(data)) + data)
+                    continue
+                frame = np.empty(FRAME_SHAPE, dtype=np.uint8)
+                recv_exact(conn, frame.data.cast('B'))
+                self.queue.put(Request(session, frame, bool(reset)))
+        except (ConnectionError, OSError, struct.error):
+            pass
+        finally:
+            with self.lock:
+                self.sessions.pop(session, None)
+            conn.close()
+
+    def _collect(self):
+        first = self.queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = first.arrival + self.max_latency
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            try:
+                # past the deadline, only take what is already queued
+                item = self.queue.get(timeout=timeout) if timeout > 0 \
+                    else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self.queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _batch(self):
+        last_log = time.perf_counter()
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            depth = self.queue.qsize()
+            with self.lock:
+                live = [r for r in batch if r.session in self.sessions]
+                stacks = [self.sessions[r.session] for r in live]
+            if not live:
+                continue
+            # a session's first frame always starts a new stack
+            reset = torch.tensor([r.reset or s[1] is None
+                                  for r, s in zip(live, stacks)])
+            history = torch.stack([
+                s[1] if s[1] is not None else torch.zeros(4, 84, 84)
+                for s in stacks])
+            frame = torch.from_numpy(np.stack([r.frame for r in live]))
+
+            with torch.no_grad():
+                action, policy, value, history = self.policy(
+                    frame, history, reset)
+                if self.sample:
+                    u = torch.rand(policy.shape, generator=self.generator)
+                    action = (policy - (-u.clamp(min=1e-20).log()).log()) \
+                        .argmax(-1)
+
+            done = time.perf_counter()
+            with self.lock:
+                for i, r in enumerate(live):
+                    if r.session in self.sessions:
+                        # a view would keep the whole batch output alive
+                        self.sessions[r.session] = (
+                            stacks[i][0], history[i].clone())
+            latency = []
+            for i, r in enumerate(live):
+                try:
+                    stacks[i][0].sendall(REPLY.pack(
+                        int(action[i]), float(value[i])))
+                except OSError:
+                    continue
+                latency.append((done - r.arrival) * 1e3)
+
+            self.requests += len(live)
+            self.batches += 1
+            self.latency.extend(latency)
+            self.batch_size.append(len(live))
+            self.queue_depth.append(depth)
+            if self.metrics is not None:
+                self.metrics.add_values('server/latency_ms', latency)
+                self.metrics.add_values('server/batch_size', [len(live)])
+                self.metrics.add_values('server/queue_depth', [depth])
+                if done - last_log > self.log_every:
+                    self.metrics.add_scalar(
+                        'server/sessions', len(self.sessions), self.batches)
+                    self.metrics.flush(self.batches)
+                    last_log = done
+
+    def stats(self):
+        def summary(values):
+            if not values:
+                return None
+            values = np.array(values)
+            p50, p99 = np.percentile(values, [50, 99])
+            return {'mean': float(values.mean()), 'p50': float(p50),
+                    'p99': float(p99), 'max': float(values.max())}
+        return {
+            'sessions': len(self.sessions),
+            'requests': self.requests,
+            'batches': self.batches,
+            'queue_depth': self.queue.qsize(),
+            'latency_ms': summary(list(self.latency)),
+            'batch_size': summary(list(self.batch_size)),
+            'batch_queue_depth': summary(list(self.queue_depth)),
+        }
+
+
+class PolicyClient(object):
+    def __init__(self, path, timeout=30.):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        deadline = time.time() + timeout
+        # the server may still be starting
+        while True:
+            try:
+                self.sock.connect(path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.05)
+        self.reply = bytearray(REPLY.size)
+
+    def act(self, frame, reset=False):
+        """(action, value) for the session's next frame"""
+        self.sock.sendall(REQUEST.pack(OP_ACT, reset))
+        self.sock.sendall(np.ascontiguousarray(frame, dtype=np.uint8).data)
+        return REPLY.unpack(recv_exact(self.sock, self.reply))
+
+    def stats(self):
+        self.sock.sendall(REQUEST.pack(OP_STATS, 0))
+        length, = LENGTH.unpack(recv_exact(self.sock, bytearray(LENGTH.size)))
+        return json.loads(bytes(recv_exact(self.sock, bytearray(length))))
+
+    def close(self):
+        self.sock.close()
+
+
+def play(path, idx, steps, n_action, results):
+    """Bench client: a synthetic-env session driven by the server"""
+    env = SyntheticMarioEnv(n_action=n_action, seed=idx)
+    client = PolicyClient(path)
+    frame, reset = env.reset(), True
+    rtt = []
+    start = time.perf_counter()
+    for _ in range(steps):
+        t = time.perf_counter()
+        action, _ = client.act(frame, reset)
+        rtt.append(time.perf_counter() - t)
+        frame, _, done, _ = env.step(action)
+        reset = done
+        if done:
+            frame = env.reset()
+    elapsed = time.perf_counter() - start
+    client.close()
+    results.put((steps, elapsed, rtt))
+
+
+def bench(server, num_client, steps, n_action):
+    # fork the clients before the server threads run
+    ctx = mp.get_context('fork')
+    results = ctx.Queue()
+    clients = [ctx.Process(target=play, args=(
+        server.path, idx, steps, n_action, results), daemon=True)
+        for idx in range(num_client)]
+    for client in clients:
+        client.start()
+    server.start()
+    start = time.perf_counter()
+    outcomes = [results.get() for _ in clients]
+    elapsed = time.perf_counter() - start
+    for client in clients:
+        client.join()
+
+    stats = server.stats()
+    rtt = np.concatenate([o[2] for o in outcomes]) * 1e3
+    p50, p99 = np.percentile(rtt, [50, 99])
+    print('{} clients x {} steps: {:.0f} steps/s, client rtt p50 {:.2f} ms '
+          'p99 {:.2f} ms'.format(num_client, steps,
+                                 sum(o[0] for o in outcomes) / elapsed,
+                                 p50, p99))
+    print(json.dumps(stats, indent=2))
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--model')
+    parser.add_argument('--model-name', default='cnn',
+                        choices=['cnn', 'deep_cnn'])
+    parser.add_argument('--use-noisy-net', action='store_true')
+    parser.add_argument('--output-size', type=int, default=12)
+    parser.add_argument('--socket', default='/tmp/mario_policy.sock')
+    parser.add_argument('--max-batch', type=int, default=64)
+    parser.add_argument('--max-latency-ms', type=float, default=5.)
+    parser.add_argument('--sample', action='store_true',
+                        help='sample actions instead of argmax')
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--logdir', help='TensorBoard directory')
+    parser.add_argument('--metrics-csv')
+    parser.add_argument('--log-every', type=float, default=10.)
+    parser.add_argument('--bench-clients', type=int, default=0)
+    parser.add_argument('--steps', type=int, default=500,
+                        help='per bench client')
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    policy = load_policy(args.model, args.model_name, args.use_noisy_net,
+                         args.output_size)
+    writer = SummaryWriter(args.logdir) if args.logdir else None
+    metrics = MetricsWriter(writer, args.metrics_csv) \
+        if writer is not None or args.metrics_csv else None
+    server = PolicyServer(
+        policy, args.socket, args.max_batch, args.max_latency_ms / 1e3,
+        metrics, args.log_every, args.sample)
+
+    try:
+        if args.bench_clients:
+            bench(server, args.bench_clients, args.steps, args.output_size)
+        else:
+            server.start()
+            print('serving on {}'.format(args.socket))
+            while True:
+                time.sleep(args.log_every)
+                print(json.dumps(server.stats()))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if server.running:
+            server.close()
+        if metrics is not None:
+            metrics.close()
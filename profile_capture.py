@@ -0,0 +1,152 @@
+"""On-demand torch.profiler + Python sampling capture of a running job
+
+    kill -USR1 <pid of the training script>
+
+profiles the next `num_updates` updates (rollout and train_model) and
+writes two Chrome traces (open in chrome://tracing or ui.perfetto.dev):
+
+    <directory>/<prefix>_<step>_torch.json    torch.profiler ops
+    <directory>/<prefix>_<step>_python.json   sampled Python stacks of
+                                              every thread, as a flame chart
+
+Until a signal arrives the only cost is a flag check per update.
+"""
+import json
+import os
+import signal
+import sys
+import threading
+import time
+
+import torch
+
+
+class StackSampler(object):
+    """Samples the Python stacks of all threads into Chrome trace events
+
+    Consecutive samples with the same frames merge into one event per
+    frame, so the trace reads like a flame chart per thread.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.events = []
+        self.open = {}
+        self.thread_names = {}
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        now = self._now()
+        for tid in list(self.open):
+            self._close(tid, 0, now)
+        return self.events
+
+    def _now(self):
+        return time.perf_counter() * 1e6
+
+    def _close(self, tid, depth, now):
+        stack = self.open[tid]
+        while len(stack) > depth:
+            name, start = stack.pop()
+            self.events.append({
+                'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': tid,
+                'ts': start, 'dur': now - start,
+            })
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            now = self._now()
+            for thread in threading.enumerate():
+                self.thread_names[thread.ident] = thread.name
+            for tid, frame in sys._current_frames().items():
+                if tid == me:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append('{} ({}:{})'.format(
+                        code.co_name, os.path.basename(code.co_filename),
+                        code.co_firstlineno))
+                    frame = frame.f_back
+                frames.reverse()
+
+                stack = self.open.setdefault(tid, [])
+                depth = 0
+                while depth < min(len(stack), len(frames)) and \
+                        stack[depth][0] == frames[depth]:
+                    depth += 1
+                self._close(tid, depth, now)
+                stack.extend((name, now) for name in frames[depth:])
+
+    def trace(self):
+        meta = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(),
+                 'tid': tid, 'args': {'name': name}}
+                for tid, name in self.thread_names.items()]
+        return {'traceEvents': meta + self.events}
+
+
+class ProfilerTrigger(object):
+    def __init__(self, num_updates=3, directory='traces', prefix='trace',
+                 signum=signal.SIGUSR1, sample_interval=0.005):
+        if num_updates < 1:
+            raise ValueError(
+                'num_updates must be at least 1, got {}'.format(num_updates))
+        self.num_updates = num_updates
+        self.directory = directory
+        self.prefix = prefix
+        self.sample_interval = sample_interval
+        self.requested = False
+        self.profiler = None
+        self.sampler = None
+        self.remaining = 0
+        signal.signal(signum, self._handler)
+
+    def _handler(self, signum, frame):
+        # only set a flag: the capture starts at the next update boundary
+        self.requested = True
+
+    def _start(self, step):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profiler = torch.profiler.profile(activities=activities)
+        self.profiler.start()
+        self.sampler = StackSampler(self.sample_interval)
+        self.sampler.start()
+        self.remaining = self.num_updates
+        self.start_step = step
+        print('[Profiler] capturing {} updates from step {}'.format(
+            self.num_updates, step))
+
+    def _stop(self):
+        self.profiler.stop()
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, '{}_{}'.format(
+            self.prefix, self.start_step))
+        self.profiler.export_chrome_trace(path + '_torch.json')
+        self.sampler.stop()
+        with open(path + '_python.json', 'w') as f:
+            json.dump(self.sampler.trace(), f)
+        print('[Profiler] traces written to {}_{{torch,python}}.json'.format(
+            path))
+        self.profiler = None
+        self.sampler = None
+
+    def step(self, step):
+        """Call once per update, between updates"""
+        if self.profiler is not None:
+            self.remaining -= 1
+            if self.remaining == 0:
+                self._stop()
+        elif self.requested:
+            self.requested = False
+            self._start(step)
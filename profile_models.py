@@ -0,0 +1,178 @@
+import argparse
+import json
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from model import MODELS, NoisyLinear, DenseNoisyLinear, Flatten, make_model
+
+# observation shape each architecture is used with
+INPUT_SHAPES = {
+    'mlp': (4,),
+    'cnn': (4, 84, 84),
+    'deep_cnn': (4, 84, 84),
+}
+
+
+def input_size(name):
+    shape = INPUT_SHAPES[name]
+    return shape[0] if len(shape) == 1 else shape
+
+
+def make_input(name, batch, device='cpu'):
+    return torch.rand((batch,) + INPUT_SHAPES[name], device=device)
+
+
+def count_parameters(model):
+    return sum(p.numel() for p in model.parameters())
+
+
+def _leaf_modules(model):
+    return [m for m in model.modules() if len(list(m.children())) == 0]
+
+
+def count_flops(model, x):
+    """Forward FLOPs (multiply + add) and activation bytes for input `x`"""
+    stats = {'flops': 0, 'activation_bytes': 0}
+
+    def hook(m, inputs, output):
+        outputs = output if isinstance(output, (tuple, list)) else [output]
+        for o in outputs:
+            stats['activation_bytes'] += o.numel() * o.element_size()
+
+        if isinstance(m, nn.Conv2d):
+            kernel = m.in_channels // m.groups * \
+                m.kernel_size[0] * m.kernel_size[1]
+            stats['flops'] += 2 * output.numel() * kernel
+        elif isinstance(m, nn.Linear):
+            stats['flops'] += 2 * output.numel() * m.in_features
+        elif isinstance(m, (NoisyLinear, DenseNoisyLinear)):
+            # mean and noisy branch
+            stats['flops'] += 4 * output.numel() * m.in_features
+        elif not isinstance(m, Flatten):
+            # activations
+            stats['flops'] += output.numel()
+
+    handles = [m.register_forward_hook(hook) for m in _leaf_modules(model)]
+    try:
+        with torch.no_grad():
+            model(x)
+    finally:
+        for h in handles:
+            h.remove()
+    return stats
+
+
+def _sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def time_forward(model, x, n_iter=20, warmup=3):
+    model.eval()
+    with torch.no_grad():
+        for _ in range(warmup):
+            model(x)
+        _sync(x.device)
+        times = []
+        for _ in range(n_iter):
+            start = time.perf_counter()
+            model(x)
+            _sync(x.device)
+            times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def time_backward(model, x, n_iter=20, warmup=3):
+    """Median time of forward + backward of an actor-critic style loss"""
+    model.train()
+
+    def step():
+        model.zero_grad()
+        policy, value = model(x)
+        loss = -F.log_softmax(policy, dim=-1).mean() + value.pow(2).mean()
+        loss.backward()
+
+    for _ in range(warmup):
+        step()
+    _sync(x.device)
+    times = []
+    for _ in range(n_iter):
+        start = time.perf_counter()
+        step()
+        _sync(x.device)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def profile(name, batch_sizes, output_size=12, use_noisy_net=False,
+            device='cpu', n_iter=20):
+    device = torch.device(device)
+    model = make_model(
+        name, input_size(name), output_size, use_noisy_net).to(device)
+
+    stats = count_flops(model, make_input(name, 1, device))
+    report = {
+        'model': name,
+        'noisy': use_noisy_net,
+        'params': count_parameters(model),
+        'param_bytes': sum(p.numel() * p.element_size()
+                           for p in model.parameters()),
+        'flops_per_sample': stats['flops'],
+        'activation_bytes_per_sample': stats['activation_bytes'],
+        'batches': [],
+    }
+    for batch in batch_sizes:
+        x = make_input(name, batch, device)
+        report['batches'].append({
+            'batch': batch,
+            'activation_bytes': stats['activation_bytes'] * batch,
+            'forward_ms': time_forward(model, x, n_iter) * 1e3,
+            'forward_backward_ms': time_backward(model, x, n_iter) * 1e3,
+        })
+    return report
+
+
+def print_report(report):
+    print('{model} (noisy={noisy}): {params:,} params ({mb:.1f} MB), '
+          '{gflops:.3f} GFLOPs/sample, {act:.2f} MB activations/sample'.format(
+              mb=report['param_bytes'] / 2 ** 20,
+              gflops=report['flops_per_sample'] / 1e9,
+              act=report['activation_bytes_per_sample'] / 2 ** 20,
+              **report))
+    for b in report['batches']:
+        print('    batch {batch:4d}: forward {forward_ms:9.2f} ms   '
+              'forward+backward {forward_backward_ms:9.2f} ms   '
+              'activations {act:8.1f} MB'.format(
+                  act=b['activation_bytes'] / 2 ** 20, **b))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='parameter, FLOP, activation memory and latency report '
+                    'for the registered architectures')
+    parser.add_argument('--models', nargs='+', default=sorted(MODELS),
+                        choices=sorted(MODELS))
+    # num_worker (rollout) and batch_size (PPO minibatch) of the scripts
+    parser.add_argument('--batch-sizes', type=int, nargs='+',
+                        default=[16, 256])
+    parser.add_argument('--output-size', type=int, default=12)
+    parser.add_argument('--noisy', action='store_true')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--iter', type=int, default=20)
+    parser.add_argument('--json', help='also write the reports to this file')
+    args = parser.parse_args()
+
+    reports = []
+    for name in args.models:
+        report = profile(name, args.batch_sizes, args.output_size,
+                         args.noisy, args.device, args.iter)
+        print_report(report)
+        reports.append(report)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(reports, f, indent=2)
@@ -0,0 +1,91 @@
+import os
+import sys
+
+
+def format_cores(cores):
+    cores = sorted(cores)
+    ranges = []
+    start = prev = cores[0]
+    for c in cores[1:]:
+        if c != prev + 1:
+            ranges.append((start, prev))
+            start = c
+        prev = c
+    ranges.append((start, prev))
+    return ','.join(str(a) if a == b else '{}-{}'.format(a, b)
+                    for a, b in ranges)
+
+
+def set_thread_count(n):
+    """Size the thread pools of the libraries this process has loaded"""
+    # don't import torch into processes that don't use it
+    torch = sys.modules.get('torch')
+    if torch is not None:
+        torch.set_num_threads(n)
+    cv2 = sys.modules.get('cv2')
+    if cv2 is not None:
+        cv2.setNumThreads(n)
+    os.environ['OMP_NUM_THREADS'] = str(n)
+
+
+def pin_process(cores, name):
+    os.sched_setaffinity(0, cores)
+    set_thread_count(len(cores))
+    print('[Resource] {} (pid {}): cores {}, {} threads'.format(
+        name, os.getpid(), format_cores(cores), len(cores)))
+
+
+class ResourceManager(object):
+    """Assign core sets to the learner and to each env worker
+
+    Cores available to this process are first split between the learners
+    running on the node (LOCAL_RANK / LOCAL_WORLD_SIZE from torchrun). Each
+    worker then gets `worker_cores` dedicated cores and the learner the rest;
+    if there are not enough cores, the learner keeps a quarter and the
+    workers share the remainder round-robin.
+    """
+
+    def __init__(
+            self,
+            num_worker,
+            worker_cores=1,
+            enabled=True,
+            cores=None):
+        self.enabled = enabled
+        self.num_worker = num_worker
+        if not enabled:
+            return
+
+        if cores is None:
+            cores = sorted(os.sched_getaffinity(0))
+            local_rank = int(os.environ.get('LOCAL_RANK', 0))
+            local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+            per_rank = max(1, len(cores) // local_world_size)
+            cores = cores[local_rank * per_rank:(local_rank + 1) * per_rank] \
+                or cores[-per_rank:]
+        cores = list(cores)
+
+        if len(cores) > num_worker * worker_cores:
+            split = num_worker * worker_cores
+            self.learner = cores[split:]
+            self.workers = [cores[i * worker_cores:(i + 1) * worker_cores]
+                            for i in range(num_worker)]
+        else:
+            split = max(1, len(cores) // 4)
+            self.learner = cores[:split]
+            shared = cores[split:] or cores
+            self.workers = [[shared[i % len(shared)]]
+                            for i in range(num_worker)]
+
+    def worker_cores(self, idx):
+        if not self.enabled:
+            return None
+        return self.workers[idx]
+
+    def apply_learner(self):
+        if not self.enabled:
+            return
+        pin_process(self.learner, 'learner')
+        print('[Resource] {} workers on cores {}'.format(
+            self.num_worker,
+            format_cores(set(c for w in self.workers for c in w))))
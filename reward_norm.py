@@ -0,0 +1,91 @@
+import numpy as np
+import torch
+
+
+class RewardNormalizer(object):
+    """Scales rewards by the running std of their discounted forward sum
+
+    The vectorised form of RewardForwardFilter + RunningMeanStd: for a
+    (num_worker, num_step) reward block, the forward filter
+    R_t = gamma * R_{t-1} + r_t of every env is one matrix product per
+    `chunk` steps with a lower-triangular discount matrix, the batch
+    moments of R are merged into the running ones in one step, and all
+    state lives on `device`.
+    """
+
+    def __init__(self, num_worker, gamma, device='cpu', chunk=128,
+                 epsilon=1e-4):
+        self.gamma = gamma
+        self.device = torch.device(device)
+        self.chunk = chunk
+        self.dtype = dtype = torch.float64
+
+        steps = torch.arange(chunk, dtype=dtype, device=self.device)
+        # discount[t, k] = gamma ** (t - k) for k <= t
+        exponent = steps.view(-1, 1) - steps.view(1, -1)
+        self.discount = torch.where(
+            exponent >= 0, gamma ** exponent.clamp(min=0),
+            torch.zeros((), dtype=dtype, device=self.device))
+        self.decay = gamma ** (steps + 1)
+
+        # zero state: the first step's sum is its reward, as in
+        # RewardForwardFilter
+        self.rewems = torch.zeros(num_worker, dtype=dtype, device=self.device)
+        self.mean = torch.zeros((), dtype=dtype, device=self.device)
+        self.var = torch.ones((), dtype=dtype, device=self.device)
+        self.count = epsilon
+
+    def filter(self, rewards):
+        """Discounted forward sums of `rewards` (num_worker, num_step)"""
+        returns = torch.empty_like(rewards)
+        for start in range(0, rewards.shape[1], self.chunk):
+            block = rewards[:, start:start + self.chunk]
+            n = block.shape[1]
+            returns[:, start:start + n] = block @ self.discount[:n, :n].t() + \
+                self.rewems.view(-1, 1) * self.decay[:n]
+            self.rewems = returns[:, start + n - 1].clone()
+        return returns
+
+    def update_from_moments(self, batch_mean, batch_var, batch_count):
+        delta = batch_mean - self.mean
+        tot_count = self.count + batch_count
+        self.mean = self.mean + delta * batch_count / tot_count
+        m2 = self.var * self.count + batch_var * batch_count + \
+            delta ** 2 * self.count * batch_count / tot_count
+        self.var = m2 / tot_count
+        self.count = tot_count
+
+    def __call__(self, rewards, reduce_moments=None):
+        """Update the running moments with `rewards` and return them scaled
+
+        rewards: (num_worker, num_step) array. `reduce_moments`, e.g.
+        distributed.all_reduce_moments, combines the batch moments of all
+        ranks before they are merged.
+        """
+        x = torch.as_tensor(rewards).to(self.device, self.dtype)
+        returns = self.filter(x)
+        mean, var, count = returns.mean(), returns.var(unbiased=False), \
+            returns.numel()
+        if reduce_moments is not None:
+            mean, var, count = reduce_moments(
+                mean.item(), var.item(), count)
+            mean = torch.as_tensor(mean, dtype=self.dtype, device=self.device)
+            var = torch.as_tensor(var, dtype=self.dtype, device=self.device)
+        self.update_from_moments(mean, var, count)
+        return (x / self.var.sqrt()).cpu().numpy().astype(
+            np.asarray(rewards).dtype)
+
+    def state_dict(self):
+        return {
+            'rewems': self.rewems,
+            'mean': self.mean,
+            'var': self.var,
+            'count': self.count,
+        }
+
+    def load_state_dict(self, state):
+        self.rewems = torch.as_tensor(state['rewems']).to(
+            self.device, self.dtype)
+        self.mean = torch.as_tensor(state['mean']).to(self.device, self.dtype)
+        self.var = torch.as_tensor(state['var']).to(self.device, self.dtype)
+        self.count = state['count']
@@ -0,0 +1,59 @@
+import torch
+import torch.nn.functional as F
+
+
+class ActionSampler(object):
+    """Gumbel-max action sampling on the model's device
+
+    Env i draws from its own generator seeded with `seed * num_env + i`, so
+    each env's action stream is reproducible and independent of the others.
+    Gumbel noise is generated `chunk` steps ahead to keep the per-env
+    generator calls off the per-step path.
+    """
+
+    def __init__(self, num_env, output_size, device, seed=0, chunk=128):
+        self.num_env = num_env
+        self.output_size = output_size
+        self.device = torch.device(device)
+        self.chunk = chunk
+        self.generators = []
+        for i in range(num_env):
+            g = torch.Generator(device=self.device)
+            g.manual_seed(seed * num_env + i)
+            self.generators.append(g)
+
+        self.noise = torch.empty(
+            num_env, chunk, output_size, device=self.device)
+        self.pos = chunk
+
+    def _refill(self):
+        for i, g in enumerate(self.generators):
+            self.noise[i].uniform_(generator=g)
+        # Gumbel(0, 1) = -log(-log(U))
+        self.noise.clamp_(min=1e-20).log_().neg_().log_().neg_()
+        self.pos = 0
+
+    def sample(self, logits):
+        if self.pos == self.chunk:
+            self._refill()
+        gumbel = self.noise[:len(logits), self.pos]
+        self.pos += 1
+        return (logits.detach() + gumbel).argmax(dim=-1)
+
+    @staticmethod
+    def log_prob(logits, action):
+        return F.log_softmax(logits, dim=-1).gather(
+            1, action.view(-1, 1)).squeeze(1)
+
+    def state_dict(self):
+        return {
+            'generators': [g.get_state() for g in self.generators],
+            'noise': self.noise,
+            'pos': self.pos,
+        }
+
+    def load_state_dict(self, state):
+        for g, g_state in zip(self.generators, state['generators']):
+            g.set_state(g_state.cpu())
+        self.noise.copy_(state['noise'])
+        self.pos = state['pos']
@@ -0,0 +1,141 @@
+"""Convergence smoke test for mixed precision training
+
+Trains a small in-process A2C agent with and without MixedPrecision on
+CartPole and on a synthetic pixel task, and exits non-zero if either run
+fails to reach the target return.
+"""
+import argparse
+import sys
+
+import gym
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torch.optim as optim
+from torch.distributions.categorical import Categorical
+
+from amp import MixedPrecision
+from model import make_model
+
+
+class PixelTargetEnv(object):
+    """One-step task: the action must match the column of a bright bar"""
+
+    def __init__(self, n_action=4, h=84, w=84, seed=0):
+        self.n_action = n_action
+        self.h = h
+        self.w = w
+        self.rng = np.random.RandomState(seed)
+        self.target = 0
+
+    def reset(self):
+        self.target = self.rng.randint(self.n_action)
+        obs = self.rng.rand(4, self.h, self.w).astype(np.float32) * 0.1
+        width = self.w // self.n_action
+        obs[:, :, self.target * width:(self.target + 1) * width] += 0.8
+        return obs
+
+    def step(self, action):
+        reward = 1. if action == self.target else 0.
+        return self.reset(), reward, True, {}
+
+
+def train(env_fns, model_name, input_size, output_size, use_amp, n_update,
+          num_step=8, gamma=0.99, lr=7e-4, seed=0):
+    torch.manual_seed(seed)
+    envs = [fn() for fn in env_fns]
+    device = torch.device('cpu')
+    model = make_model(model_name, input_size, output_size).to(device)
+    optimizer = optim.Adam(model.parameters(), lr=lr)
+    amp = MixedPrecision(device, use_amp)
+
+    states = np.stack([env.reset() for env in envs]).astype(np.float32)
+    rall = np.zeros(len(envs))
+    returns = []
+    for _ in range(n_update):
+        total_state, total_reward, total_done, total_action = [], [], [], []
+        for _ in range(num_step):
+            with torch.no_grad():
+                policy, _ = model(torch.from_numpy(states))
+            actions = Categorical(logits=policy.float()).sample().numpy()
+
+            next_states, rewards, dones = [], [], []
+            for i, (env, action) in enumerate(zip(envs, actions)):
+                s, r, d, _ = env.step(action)
+                rall[i] += r
+                if d:
+                    returns.append(rall[i])
+                    rall[i] = 0
+                    s = env.reset()
+                next_states.append(s)
+                rewards.append(r)
+                dones.append(d)
+
+            total_state.append(states)
+            total_reward.append(rewards)
+            total_done.append(dones)
+            total_action.append(actions)
+            states = np.stack(next_states).astype(np.float32)
+
+        with torch.no_grad():
+            _, next_value = model(torch.from_numpy(states))
+        running_add = next_value.float().numpy().squeeze(1)
+        target = np.zeros([num_step, len(envs)])
+        for t in range(num_step - 1, -1, -1):
+            running_add = np.array(total_reward[t]) + gamma * \
+                running_add * (1 - np.array(total_done[t]))
+            target[t] = running_add
+
+        s_batch = torch.from_numpy(
+            np.concatenate(total_state)).float()
+        y_batch = torch.from_numpy(np.concatenate(total_action)).long()
+        target_batch = torch.from_numpy(target.reshape(-1)).float()
+
+        with amp.autocast():
+            policy, value = model(s_batch)
+        policy, value = policy.float(), value.float()
+        m = Categorical(F.softmax(policy, dim=-1))
+        adv = (target_batch - value.sum(1)).detach()
+        loss = -(m.log_prob(y_batch) * adv).mean() + \
+            0.5 * F.mse_loss(value.sum(1), target_batch) - \
+            0.01 * m.entropy().mean()
+
+        optimizer.zero_grad()
+        amp.backward(loss)
+        amp.step(optimizer, model.parameters(), 0.5)
+
+    return float(np.mean(returns[-50:]))
+
+
+def cartpole(use_amp, n_update):
+    return train(
+        [lambda: gym.make('CartPole-v1') for _ in range(16)],
+        'mlp', 4, 2, use_amp, n_update)
+
+
+def pixel(use_amp, n_update):
+    return train(
+        [lambda i=i: PixelTargetEnv(seed=i) for i in range(16)],
+        'cnn', (4, 84, 84), 4, use_amp, n_update, num_step=4)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--cartpole-updates', type=int, default=1500)
+    parser.add_argument('--cartpole-target', type=float, default=100.)
+    parser.add_argument('--pixel-updates', type=int, default=300)
+    parser.add_argument('--pixel-target', type=float, default=0.8)
+    args = parser.parse_args()
+
+    failed = False
+    for name, fn, n_update, target in [
+            ('CartPole', cartpole, args.cartpole_updates, args.cartpole_target),
+            ('pixel', pixel, args.pixel_updates, args.pixel_target)]:
+        for use_amp in [False, True]:
+            ret = fn(use_amp, n_update)
+            ok = ret >= target
+            failed |= not ok
+            print('{:8s} amp={!s:5s} mean return {:8.2f} (target {}) {}'.format(
+                name, use_amp, ret, target, 'ok' if ok else 'FAILED'))
+
+    sys.exit(1 if failed else 0)
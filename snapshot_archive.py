@@ -0,0 +1,131 @@
+"""Archive of episode start points, keyed by world, stage and x_pos bucket
+
+nes_py can save the emulator state only into the running process (there
+is no serialisable snapshot), so an entry is the action trace from
+env.reset() to the point; restoring it replays the trace, which is
+deterministic for the NES games. Entries are shared between workers
+through one JSON file; writers lock it with flock and replace it
+atomically, so readers need no lock.
+
+Per (world, stage, x_pos // bucket) only the shortest trace is kept, as
+it is the cheapest to replay. Beyond `capacity` entries the ones furthest
+behind the frontier (lowest world, stage, then x_pos) are evicted.
+`sample` favours entries this worker rarely chose (weight
+1 / sqrt(1 + visits)); visits are counted per worker, so sampling never
+writes the file.
+"""
+import base64
+import fcntl
+import json
+import os
+from contextlib import contextmanager
+
+import numpy as np
+
+
+def encode_actions(actions):
+    return base64.b64encode(bytes(bytearray(actions))).decode('ascii')
+
+
+def decode_actions(data):
+    return list(bytearray(base64.b64decode(data)))
+
+
+class SnapshotArchive(object):
+    def __init__(self, path, capacity=256, bucket=256):
+        self.path = path
+        self.capacity = capacity
+        self.bucket = bucket
+        self.entries = {}
+        self.visits = {}
+        self.version = None
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def key(self, world, stage, x_pos):
+        return '{}:{}:{}'.format(world, stage, x_pos // self.bucket)
+
+    @contextmanager
+    def _locked(self):
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read(self):
+        # mtimes are too coarse to tell two writes in the same tick apart,
+        # but every os.replace installs a new inode
+        try:
+            with open(self.path) as f:
+                st = os.fstat(f.fileno())
+                version = (st.st_ino, st.st_size, st.st_mtime_ns)
+                if version == self.version:
+                    return
+                entries = json.load(f)
+        except OSError:
+            self.entries, self.version = {}, None
+            return
+        # entries of archives written before worlds were recorded
+        self.entries = {k: e for k, e in entries.items() if 'world' in e}
+        self.version = version
+
+    def _write(self):
+        tmp_path = '{}.{}'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
+        st = os.stat(self.path)
+        self.version = (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def add(self, world, stage, x_pos, actions):
+        """Store the trace reaching x_pos of world-stage, if new or shorter"""
+        world, stage, x_pos = int(world), int(stage), int(x_pos)
+        key = self.key(world, stage, x_pos)
+        entry = self.entries.get(key)
+        # cheap check on the cached copy before taking the lock
+        if entry is not None and entry['length'] <= len(actions):
+            return False
+        with self._locked():
+            self._read()
+            entry = self.entries.get(key)
+            if entry is not None and entry['length'] <= len(actions):
+                return False
+            self.entries[key] = {
+                'world': world,
+                'stage': stage,
+                'x_pos': x_pos,
+                'length': len(actions),
+                'actions': encode_actions([int(a) for a in actions]),
+            }
+            if len(self.entries) > self.capacity:
+                order = sorted(self.entries, key=lambda k: (
+                    self.entries[k]['world'], self.entries[k]['stage'],
+                    self.entries[k]['x_pos']))
+                for k in order[:len(self.entries) - self.capacity]:
+                    del self.entries[k]
+            self._write()
+        return True
+
+    def sample(self, rng):
+        """(world, stage, x_pos, actions) of a sampled entry, or None"""
+        self._read()
+        if not self.entries:
+            return None
+        keys = sorted(self.entries)
+        weights = np.array([
+            1. / np.sqrt(1. + self.visits.get(k, 0)) for k in keys])
+        key = keys[rng.choice(len(keys), p=weights / weights.sum())]
+        self.visits[key] = self.visits.get(key, 0) + 1
+        entry = self.entries[key]
+        return entry['world'], entry['stage'], entry['x_pos'], \
+            decode_actions(entry['actions'])
+
+    def remove(self, world, stage, x_pos):
+        with self._locked():
+            self._read()
+            if self.entries.pop(
+                    self.key(world, stage, x_pos), None) is not None:
+                self._write()
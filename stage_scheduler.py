@@ -0,0 +1,123 @@
+"""Spread the env workers over several stages and rebalance them
+
+    scheduler = StageScheduler(['SuperMarioBros-1-1-v0',
+                                'SuperMarioBros-1-2-v0'], num_worker)
+
+Workers start round-robin over the stages. `rebalance` gives each stage a
+share of the workers proportional to its learning progress (the change of
+its mean episode return between the older and the newer half of its
+recent episodes) per second of env step time, with at least `min_workers`
+per stage, and returns the moves needed to get there. The step times come
+from the workers' shared step_stats counters (see mario_env.py).
+"""
+from collections import deque
+
+import numpy as np
+
+
+class StageScheduler(object):
+    def __init__(self, stages, num_worker, min_workers=1, window=50,
+                 max_moves=None):
+        if len(stages) * min_workers > num_worker:
+            raise ValueError('{} workers cannot give {} stages {} each'.format(
+                num_worker, len(stages), min_workers))
+        self.stages = list(stages)
+        self.num_worker = num_worker
+        self.min_workers = min_workers
+        self.max_moves = max_moves
+        self.assignment = [self.stages[i % len(self.stages)]
+                           for i in range(num_worker)]
+        self.returns = {s: deque(maxlen=window) for s in self.stages}
+        self.lengths = {s: deque(maxlen=window) for s in self.stages}
+        self.steps = {s: 0. for s in self.stages}
+        self.step_time = {s: 0. for s in self.stages}
+        self.last_stats = np.zeros([num_worker, 2])
+
+    def workers(self, stage):
+        return [i for i, s in enumerate(self.assignment) if s == stage]
+
+    def record(self, dones, returns, lengths):
+        """Episodes that ended this step: per-env done mask and totals"""
+        for idx in np.flatnonzero(dones):
+            stage = self.assignment[idx]
+            self.returns[stage].append(float(returns[idx]))
+            self.lengths[stage].append(float(lengths[idx]))
+
+    def measure(self, works):
+        """Accumulate the env steps / step time of each worker's stage"""
+        stats = np.array([work.step_stats[:] for work in works])
+        delta = stats - self.last_stats
+        self.last_stats = stats
+        for idx, (steps, seconds) in enumerate(delta):
+            stage = self.assignment[idx]
+            self.steps[stage] += steps
+            self.step_time[stage] += seconds
+
+    def step_cost(self, stage):
+        if not self.steps[stage]:
+            return None
+        return self.step_time[stage] / self.steps[stage]
+
+    def progress(self, stage):
+        returns = list(self.returns[stage])
+        if len(returns) < 4:
+            return None
+        half = len(returns) // 2
+        return abs(np.mean(returns[half:]) - np.mean(returns[:half]))
+
+    def targets(self):
+        """Number of workers each stage should have"""
+        costs = [self.step_cost(s) for s in self.stages]
+        known = [c for c in costs if c]
+        mean_cost = np.mean(known) if known else 1.
+        progress = [self.progress(s) for s in self.stages]
+        known = [p for p in progress if p is not None]
+        # unmeasured stages get the mean, so they keep being sampled
+        mean_progress = np.mean(known) if known else 1.
+        priority = np.array([
+            ((p if p is not None else mean_progress) + 1e-8) /
+            (c if c else mean_cost)
+            for p, c in zip(progress, costs)])
+
+        free = self.num_worker - self.min_workers * len(self.stages)
+        share = priority / priority.sum() * free
+        counts = np.floor(share).astype(int)
+        # hand out the remainder by the largest fractional parts
+        for i in np.argsort(counts - share)[:free - counts.sum()]:
+            counts[i] += 1
+        return dict(zip(self.stages, counts + self.min_workers))
+
+    def rebalance(self):
+        """[(worker index, new stage)] and apply them to the assignment"""
+        targets = self.targets()
+        surplus = []
+        for stage in self.stages:
+            surplus += self.workers(stage)[targets[stage]:]
+        moves = []
+        for stage in self.stages:
+            missing = targets[stage] - len(self.workers(stage))
+            for _ in range(max(missing, 0)):
+                if not surplus or (self.max_moves is not None and
+                                   len(moves) >= self.max_moves):
+                    break
+                idx = surplus.pop()
+                self.assignment[idx] = stage
+                moves.append((idx, stage))
+        return moves
+
+    def log(self, metrics, step):
+        for stage in self.stages:
+            tag = 'stage/{}/'.format(stage)
+            metrics.add_scalar(tag + 'workers', len(self.workers(stage)), step)
+            if self.step_time[stage]:
+                metrics.add_scalar(
+                    tag + 'steps_per_sec',
+                    self.steps[stage] / self.step_time[stage], step)
+            if self.returns[stage]:
+                metrics.add_scalar(
+                    tag + 'return', np.mean(self.returns[stage]), step)
+                metrics.add_scalar(
+                    tag + 'episode_length', np.mean(self.lengths[stage]), step)
+            progress = self.progress(stage)
+            if progress is not None:
+                metrics.add_scalar(tag + 'progress', progress, step)
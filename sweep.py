@@ -0,0 +1,263 @@
+"""Train several mario_ppo configurations at once on one shared env pool
+
+    python sweep.py --configs sweep.json --num-worker 16
+
+sweep.json is a list of objects, each with a "name" and any of the
+hyperparameters in DEFAULTS (e.g. learning_rate, entropy_coef, ppo_eps,
+num_step). Envs are handed out in contiguous slices (a config's own
+"num_worker", or an even split of --num-worker), so the emulator cost
+depends on the total number of envs, not on the number of configs.
+"""
+import argparse
+import json
+import os
+import time
+from collections import deque
+
+import numpy as np
+from torch.multiprocessing import Pipe
+from tensorboardX import SummaryWriter
+
+from gym_super_mario_bros.actions import COMPLEX_MOVEMENT
+
+import mario_ppo
+from env_startup import load_env_spec, wait_ready
+from mario_ppo import ActorAgent, make_train_data
+from mario_env import MarioEnvironment
+
+# the settings of mario_ppo.py's __main__
+DEFAULTS = {
+    'learning_rate': 0.0001,
+    'entropy_coef': 0.02,
+    'ppo_eps': 0.1,
+    'epoch': 3,
+    'batch_size': 256,
+    'num_step': 128,
+    'gamma': 0.99,
+    'lam': 0.95,
+    'use_gae': True,
+    'clip_grad_norm': 0.5,
+    'reward_scale': 1,
+    'use_noisy_net': True,
+    'model_name': 'cnn',
+}
+
+
+class SweepRun(object):
+    def __init__(
+            self,
+            idx,
+            config,
+            parent_conns,
+            input_size,
+            output_size,
+            use_cuda,
+            log_dir):
+        self.name = config['name']
+        self.config = dict(DEFAULTS)
+        self.config.update(config)
+        self.parent_conns = parent_conns
+        self.num_worker = len(parent_conns)
+        self.num_step = self.config['num_step']
+
+        self.apply()
+        self.agent = ActorAgent(
+            input_size,
+            output_size,
+            self.num_worker,
+            self.num_step,
+            self.config['gamma'],
+            lam=self.config['lam'],
+            use_gae=self.config['use_gae'],
+            use_cuda=use_cuda,
+            use_noisy_net=self.config['use_noisy_net'],
+            model_name=self.config['model_name'],
+            seed=idx)
+        self.writer = SummaryWriter(os.path.join(log_dir, self.name))
+
+        self.states = np.zeros([self.num_worker, 4, 84, 84])
+        self.reset_storage()
+        self.rall = np.zeros(self.num_worker)
+        self.recent_rall = deque(maxlen=100)
+
+        self.env_steps = 0
+        self.updates = 0
+        self.busy_time = 0.
+        self.curve = []
+
+    def apply(self):
+        # ActorAgent.train_model and make_train_data read these as
+        # module globals of mario_ppo
+        vars(mario_ppo).update(
+            (k, v) for k, v in self.config.items()
+            if k not in ('name', 'num_worker'))
+
+    def reset_storage(self):
+        self.total_state, self.total_reward, self.total_done = [], [], []
+        self.total_next_state, self.total_action = [], []
+
+    def act(self):
+        start = time.perf_counter()
+        self.apply()
+        self.agent.model.eval()
+        self.actions = self.agent.get_action(self.states)
+        for parent_conn, action in zip(self.parent_conns, self.actions):
+            parent_conn.send(action)
+        self.busy_time += time.perf_counter() - start
+
+    def observe(self):
+        next_states, rewards, dones, real_dones, log_rewards = [], [], [], [], []
+        for parent_conn in self.parent_conns:
+            s, r, d, rd, lr = parent_conn.recv()
+            next_states.append(s)
+            rewards.append(r)
+            dones.append(d)
+            real_dones.append(rd)
+            log_rewards.append(lr)
+
+        start = time.perf_counter()
+        next_states = np.stack(next_states)
+        self.total_state.append(self.states)
+        self.total_next_state.append(next_states)
+        self.total_reward.append(
+            np.hstack(rewards) * self.config['reward_scale'])
+        self.total_done.append(np.hstack(dones))
+        self.total_action.append(self.actions)
+        self.states = next_states
+        self.env_steps += self.num_worker
+
+        self.rall += log_rewards
+        for i in np.flatnonzero(real_dones):
+            self.recent_rall.append(self.rall[i])
+            self.writer.add_scalar('data/reward', self.rall[i], self.env_steps)
+            self.rall[i] = 0
+
+        if len(self.total_state) == self.num_step:
+            self.train()
+        self.busy_time += time.perf_counter() - start
+
+    def train(self):
+        num_worker, num_step = self.num_worker, self.num_step
+        total_state = np.stack(self.total_state).transpose(
+            [1, 0, 2, 3, 4]).reshape([-1, 4, 84, 84])
+        total_next_state = np.stack(self.total_next_state).transpose(
+            [1, 0, 2, 3, 4]).reshape([-1, 4, 84, 84])
+        total_reward = np.stack(self.total_reward).transpose().reshape([-1])
+        total_action = np.stack(self.total_action).transpose().reshape([-1])
+        total_done = np.stack(self.total_done).transpose().reshape([-1])
+        self.reset_storage()
+
+        self.apply()
+        value, next_value, policy = self.agent.forward_transition(
+            total_state, total_next_state)
+
+        total_target = []
+        total_adv = []
+        for idx in range(num_worker):
+            sl = slice(idx * num_step, (idx + 1) * num_step)
+            target, adv = make_train_data(
+                total_reward[sl], total_done[sl], value[sl], next_value[sl])
+            total_target.append(target)
+            total_adv.append(adv)
+
+        self.agent.train_model(
+            total_state,
+            total_next_state,
+            np.hstack(total_target),
+            total_action,
+            np.hstack(total_adv))
+        self.updates += 1
+
+        mean_rall = float(np.mean(self.recent_rall)) \
+            if self.recent_rall else 0.
+        self.curve.append([self.env_steps, mean_rall])
+        self.writer.add_scalar('data/recent_reward', mean_rall, self.env_steps)
+
+    def report(self, elapsed):
+        return {
+            'name': self.name,
+            'config': self.config,
+            'num_worker': self.num_worker,
+            'env_steps': self.env_steps,
+            'updates': self.updates,
+            'env_steps_per_sec': self.env_steps / elapsed,
+            'busy_share': self.busy_time / elapsed,
+            'recent_reward': self.curve[-1][1] if self.curve else None,
+            'curve': self.curve,
+        }
+
+
+def split_workers(configs, num_worker):
+    sizes = [c.get('num_worker') for c in configs]
+    free = num_worker - sum(s for s in sizes if s)
+    n_auto = sum(1 for s in sizes if not s)
+    if n_auto:
+        if free < n_auto:
+            raise ValueError('not enough workers for {} configs'.format(
+                len(configs)))
+        auto = [free // n_auto + (1 if i < free % n_auto else 0)
+                for i in range(n_auto)]
+        sizes = [s if s else auto.pop(0) for s in sizes]
+    return sizes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--configs', required=True)
+    parser.add_argument('--env-id', default='SuperMarioBros-v0')
+    parser.add_argument('--num-worker', type=int, default=16)
+    parser.add_argument('--max-step', type=float, default=1e7,
+                        help='env steps per config')
+    parser.add_argument('--use-cuda', action='store_true')
+    parser.add_argument('--log-dir', default='runs/sweep')
+    parser.add_argument('--out', default='sweep_results.json')
+    parser.add_argument('--report-every', type=float, default=60.)
+    args = parser.parse_args()
+
+    with open(args.configs) as f:
+        configs = json.load(f)
+
+    input_size, output_size = load_env_spec(args.env_id, COMPLEX_MOVEMENT)
+
+    sizes = split_workers(configs, args.num_worker)
+    works = []
+    parent_conns = []
+    for idx in range(sum(sizes)):
+        parent_conn, child_conn = Pipe()
+        work = MarioEnvironment(args.env_id, False, idx, child_conn)
+        work.start()
+        works.append(work)
+        parent_conns.append(parent_conn)
+    states = wait_ready(parent_conns, works)
+
+    runs = []
+    offset = 0
+    for idx, (config, size) in enumerate(zip(configs, sizes)):
+        run = SweepRun(
+            idx, config, parent_conns[offset:offset + size],
+            input_size, output_size, args.use_cuda, args.log_dir)
+        run.states = states[offset:offset + size]
+        runs.append(run)
+        offset += size
+
+    start = last_report = time.perf_counter()
+    while any(run.env_steps < args.max_step for run in runs):
+        active = [run for run in runs if run.env_steps < args.max_step]
+        for run in active:
+            run.act()
+        for run in active:
+            run.observe()
+
+        now = time.perf_counter()
+        if now - last_report > args.report_every:
+            last_report = now
+            for run in runs:
+                r = run.report(now - start)
+                print('[Sweep {name}] steps {env_steps}  updates {updates}  '
+                      '{env_steps_per_sec:.1f} steps/s  recent reward '
+                      '{recent_reward}'.format(**r))
+
+    elapsed = time.perf_counter() - start
+    with open(args.out, 'w') as f:
+        json.dump([run.report(elapsed) for run in runs], f, indent=2)
@@ -0,0 +1,130 @@
+"""ROM-free stand-in for the Mario env, for throughput benchmarks
+
+Same interface as BinarySpaceToDiscreteSpaceEnv(gym_super_mario_bros.make()):
+240x256x3 uint8 RGB frames, a Discrete action space and an info dict with
+life, world, stage, x_pos, flag_get and time. Only needs NumPy and gym.spaces, so
+it can be built in the torch-free env workers (see mario_env.py).
+
+    step_cost     CPU seconds burnt per step (busy loop), the emulator's cost
+    entropy       fraction of each frame (0..1) overwritten with noise; the
+                  rest is a scrolling background
+    episode_length, episode_length_dist
+                  mean episode length in steps, drawn per episode from
+                  'fixed', 'uniform' (0.5x - 1.5x) or 'exponential'
+"""
+import time
+
+import numpy as np
+from gym import spaces
+
+H, W = 240, 256
+STAGE_LENGTH = 3000
+
+
+class SyntheticMarioEnv(object):
+    def __init__(
+            self,
+            n_action=12,
+            step_cost=0.,
+            entropy=0.1,
+            episode_length=400,
+            episode_length_dist='exponential',
+            lives=3,
+            seed=0):
+        if episode_length_dist not in ('fixed', 'uniform', 'exponential'):
+            raise ValueError('unknown episode_length_dist: {}'.format(
+                episode_length_dist))
+        self.observation_space = spaces.Box(
+            low=0, high=255, shape=(H, W, 3), dtype=np.uint8)
+        self.action_space = spaces.Discrete(n_action)
+        self.step_cost = step_cost
+        self.entropy = entropy
+        self.episode_length = episode_length
+        self.episode_length_dist = episode_length_dist
+        self.lives = lives
+        self.rng = np.random.RandomState(seed)
+
+        # a level twice the screen wide, scrolled by x_pos
+        self.level = self.rng.randint(
+            0, 256, size=(H // 16, 2 * W // 16, 3)).astype(np.uint8)
+        self.level = np.repeat(np.repeat(self.level, 16, 0), 16, 1)
+        self.noise = self.rng.randint(
+            0, 256, size=(2 * H, W, 3)).astype(np.uint8)
+        self.frame = np.empty((H, W, 3), dtype=np.uint8)
+
+    def _draw_length(self):
+        if self.episode_length_dist == 'fixed':
+            length = self.episode_length
+        elif self.episode_length_dist == 'uniform':
+            length = self.rng.uniform(0.5, 1.5) * self.episode_length
+        else:
+            length = self.rng.exponential(self.episode_length)
+        return max(int(length), self.lives)
+
+    def _render_frame(self):
+        offset = self.x_pos % W
+        self.frame[:, :W - offset] = self.level[:, offset:W]
+        self.frame[:, W - offset:] = self.level[:, W:W + offset]
+        rows = int(self.entropy * H)
+        if rows:
+            start = self.rng.randint(0, H - rows + 1)
+            src = self.rng.randint(0, H)
+            self.frame[start:start + rows] = self.noise[src:src + rows]
+        return self.frame.copy()
+
+    def reset(self):
+        self.t = 0
+        self.length = self._draw_length()
+        self.life = self.lives - 1
+        self.world = 1
+        self.stage = 1
+        self.x_pos = 40
+        return self._render_frame()
+
+    def step(self, action):
+        if self.step_cost > 0:
+            deadline = time.perf_counter() + self.step_cost
+            while time.perf_counter() < deadline:
+                pass
+
+        self.t += 1
+        # right-moving actions move further on average
+        dx = int(self.rng.randint(-1, 4)) + int(action) % 3
+        self.x_pos = max(self.x_pos + dx, 0)
+        reward = float(np.clip(dx, -15, 15))
+
+        flag_get = False
+        if self.x_pos >= STAGE_LENGTH:
+            flag_get = True
+            # four stages per world, like the real game
+            if self.stage == 4:
+                self.world += 1
+                self.stage = 1
+            else:
+                self.stage += 1
+            self.x_pos = 40
+            reward += 15.
+
+        # lives are lost evenly over the episode, the last one ends it
+        life = self.lives - 1 - (self.t * self.lives) // self.length
+        done = self.t >= self.length
+        if life < self.life:
+            reward -= 15.
+        self.life = max(life, 0)
+
+        info = {
+            'life': self.life,
+            'world': self.world,
+            'stage': self.stage,
+            'x_pos': self.x_pos,
+            'flag_get': flag_get,
+            # in-game timer, one tick per 24 steps like the real game
+            'time': max(400 - self.t // 24, 0),
+        }
+        return self._render_frame(), float(np.clip(reward, -15, 15)), done, info
+
+    def render(self, mode='human'):
+        return self.frame
+
+    def close(self):
+        pass
@@ -0,0 +1,100 @@
+import json
+import threading
+import time
+from collections import defaultdict
+
+
+class _Phase(object):
+    __slots__ = ('timer', 'name', 'start')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        with self.timer.lock:
+            self.timer.totals[self.name] += elapsed
+            self.timer.counts[self.name] += 1
+
+
+class _NullPhase(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+class PhaseTimer(object):
+    """Named wall-clock timers around the phases of the training loop
+
+        with timer.phase('train_model'):
+            agent.train_model(...)
+
+    Each phase is a preallocated context manager around two perf_counter
+    calls. `report` aggregates everything since the last report, writes it
+    to TensorBoard and a JSON lines file, and resets the totals.
+
+    Phases may be timed from several threads (the rollout collector of
+    use_pipeline); each thread gets its own context managers, and a report
+    covers every phase that ended since the previous one.
+    """
+
+    def __init__(self, enabled=True, writer=None, jsonl_path=None):
+        self.enabled = enabled
+        self.writer = writer
+        self.jsonl = open(jsonl_path, 'a') if enabled and jsonl_path else None
+        self.lock = threading.Lock()
+        self.totals = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.local = threading.local()
+        self.null_phase = _NullPhase()
+        self.last_report = time.perf_counter()
+
+    def phase(self, name):
+        if not self.enabled:
+            return self.null_phase
+        phases = getattr(self.local, 'phases', None)
+        if phases is None:
+            phases = self.local.phases = {}
+        phase = phases.get(name)
+        if phase is None:
+            phase = phases[name] = _Phase(self, name)
+        return phase
+
+    def report(self, step, env_steps, samples, updates=1):
+        if not self.enabled:
+            return None
+        with self.lock:
+            totals, counts = self.totals, self.counts
+            self.totals = defaultdict(float)
+            self.counts = defaultdict(int)
+        now = time.perf_counter()
+        elapsed = now - self.last_report
+        self.last_report = now
+
+        record = {
+            'step': step,
+            'elapsed': elapsed,
+            'env_steps_per_sec': env_steps / elapsed,
+            'updates_per_sec': updates / elapsed,
+            'samples_per_sec': samples / elapsed,
+            'phases': {name: {'sec': total,
+                              'share': total / elapsed,
+                              'count': counts[name]}
+                       for name, total in totals.items()},
+        }
+        if self.writer is not None:
+            for key in ['env_steps_per_sec', 'updates_per_sec',
+                        'samples_per_sec']:
+                self.writer.add_scalar('perf/' + key, record[key], step)
+            for name, total in totals.items():
+                self.writer.add_scalar('time/' + name, total, step)
+        if self.jsonl is not None:
+            self.jsonl.write(json.dumps(record) + '\n')
+            self.jsonl.flush()
+        return record